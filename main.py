@@ -36,21 +36,30 @@ print("\nStarting up...\n")
 
 import git
 import asyncio
+import atexit
+import concurrent.futures
+import copy
 import csv
 import datetime
 import functools
-import glob
+import hashlib
 import html # Import for send_lyrics html escaping
+import itertools
 import json
 import logging
+import logging.handlers
 import os
 import platform
+import queue
 import re
 import shutil
 import subprocess
+import threading
+import time
 import traceback
+from importlib import metadata as importlib_metadata
 from io import BytesIO
-from typing import Any, Dict, List, Optional, Tuple, Type, Union
+from typing import Any, Dict, List, Optional, Set, Tuple, Type, Union
 from urllib.parse import urlparse
 
 import psutil
@@ -63,18 +72,44 @@ from telethon import errors as telethon_errors
 from ytmusicapi import YTMusic
 import dotenv # Added for pydotenv
 
+try: # Optional: faster JSON (de)serialization, stdlib json is used otherwise
+    import orjson
+    _HAS_ORJSON = True
+except ImportError:
+    _HAS_ORJSON = False
+
+try: # Optional: non-blocking HTTP for thumbnails, the pooled requests session is used otherwise
+    import aiohttp
+    _HAS_AIOHTTP = True
+except ImportError:
+    _HAS_AIOHTTP = False
+
+try: # Optional: libvips for thumbnail cropping, Pillow is used otherwise
+    import pyvips
+    _HAS_PYVIPS = True
+except (ImportError, OSError): # OSError: the Python binding is installed but the libvips shared library isn't
+    _HAS_PYVIPS = False
+
 # --- Load .env file ---
 dotenv.load_dotenv()
 
 # --- Logging Setup ---
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("bot_log.txt", mode='w', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+# Records are only enqueued on the calling thread (event loop included); a listener thread does the actual file/console I/O
+_log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_log_output_handlers = [
+    logging.FileHandler("bot_log.txt", mode='w', encoding='utf-8'),
+    logging.StreamHandler()
+]
+for _log_output_handler in _log_output_handlers: _log_output_handler.setFormatter(_log_formatter)
+_LOG_QUEUE: queue.Queue = queue.Queue(-1)
+_log_queue_handler = logging.handlers.QueueHandler(_LOG_QUEUE)
+_log_queue_handler.setFormatter(logging.Formatter('%(message)s')) # Final formatting is done by the output handlers
+logging.basicConfig(level=logging.INFO, handlers=[_log_queue_handler])
+LOG_LISTENER = logging.handlers.QueueListener(_LOG_QUEUE, *_log_output_handlers, respect_handler_level=True)
+LOG_LISTENER.start()
+# Drained and stopped at interpreter exit, so records logged outside main() (e.g. the config exit(1) paths below) are
+# still written; registered after logging's own atexit hook, so it runs before logging.shutdown() closes the handlers
+atexit.register(LOG_LISTENER.stop)
 logger = logging.getLogger(__name__)
 
 # --- Helper function for absolute paths ---
@@ -110,7 +145,43 @@ except Exception as e:
     logger.critical(f"CRITICAL ERROR: Failed to initialize TelegramClient: {e}")
     exit(1)
 
+# --- Parsed JSON config cache ---
+# Absolute path -> (mtime, size, parsed data); a file is re-parsed only when its stat changes
+_CONFIG_CACHE: Dict[str, Tuple[float, int, Any]] = {}
+
+def _read_json_cached(absolute_path: str) -> Any:
+    """
+    Returns the parsed JSON content of a config file, re-reading it only if it changed on disk.
+    Returns a deep copy so callers can mutate the result freely.
+    Raises the same errors as open()/json.loads (FileNotFoundError, json.JSONDecodeError, ...);
+    orjson's decode error is a json.JSONDecodeError subclass.
+    """
+    st = os.stat(absolute_path)
+    cached = _CONFIG_CACHE.get(absolute_path)
+    if cached and cached[0] == st.st_mtime and cached[1] == st.st_size:
+        logger.debug("Using cached parse of %s", absolute_path)
+        return copy.deepcopy(cached[2])
+    with open(absolute_path, 'rb') as f:
+        raw = f.read() # Parsing one buffer is cheaper than json.load's file-object path
+    data = orjson.loads(raw) if _HAS_ORJSON else json.loads(raw)
+    _CONFIG_CACHE[absolute_path] = (st.st_mtime, st.st_size, data)
+    return copy.deepcopy(data)
+
+def clear_config_cache():
+    """Drops all cached config parses, forcing the next load to read from disk."""
+    _CONFIG_CACHE.clear()
+
 # --- yt-dlp Options ---
+@functools.lru_cache(maxsize=1)
+def _find_ffmpeg() -> Optional[str]:
+    """Looks up ffmpeg in PATH once; the result is reused for the lifetime of the process."""
+    return shutil.which('ffmpeg')
+
+def _needs_ffmpeg(opts: Dict) -> bool:
+    """True if the yt-dlp options use any step that requires FFmpeg (cheap flag checks before the postprocessor scan)."""
+    return bool(opts.get('embed_metadata') or opts.get('embed_thumbnail') or
+                any(pp.get('key', '').startswith('FFmpeg') for pp in opts.get('postprocessors') or ()))
+
 def load_ydl_opts(config_file: str = 'dlp.conf') -> Dict:
     default_opts = {
         'format': 'bestaudio[ext=m4a]/best[ext=m4a]',
@@ -145,9 +216,8 @@ def load_ydl_opts(config_file: str = 'dlp.conf') -> Dict:
     logger.info(f"Attempting to load yt-dlp options from: {absolute_config_path}")
     opts = {}
     try:
-        with open(absolute_config_path, 'r', encoding='utf-8') as f:
-            opts = json.load(f)
-            logger.info(f"Loaded yt-dlp options from {absolute_config_path}")
+        opts = _read_json_cached(absolute_config_path)
+        logger.info(f"Loaded yt-dlp options from {absolute_config_path}")
     except FileNotFoundError:
         logger.warning(f"yt-dlp config file '{absolute_config_path}' not found. Using default options.")
     except json.JSONDecodeError as e:
@@ -158,27 +228,24 @@ def load_ydl_opts(config_file: str = 'dlp.conf') -> Dict:
     merged_opts = default_opts.copy()
     merged_opts.update(opts)
 
-    if 'outtmpl' in merged_opts and not os.path.isabs(merged_opts['outtmpl']):
-         outtmpl_path = merged_opts['outtmpl']
-         if not os.path.splitdrive(outtmpl_path)[0] and not os.path.isabs(outtmpl_path):
-             merged_opts['outtmpl'] = os.path.join(SCRIPT_DIR, merged_opts['outtmpl'])
+    outtmpl_path = merged_opts.get('outtmpl')
+    if outtmpl_path:
+         if not (os.path.isabs(outtmpl_path) or os.path.splitdrive(outtmpl_path)[0]):
+             merged_opts['outtmpl'] = os.path.join(SCRIPT_DIR, outtmpl_path)
              logger.info(f"Made yt-dlp outtmpl relative path absolute: {merged_opts['outtmpl']}")
          else:
-              logger.debug(f"yt-dlp outtmpl already seems absolute or uses a drive: {outtmpl_path}")
+              logger.debug("yt-dlp outtmpl already seems absolute or uses a drive: %s", outtmpl_path)
 
-    needs_ffmpeg = any(pp.get('key', '').startswith('FFmpeg') for pp in merged_opts.get('postprocessors', [])) or \
-                   merged_opts.get('embed_metadata') or \
-                   merged_opts.get('embed_thumbnail')
-    ffmpeg_path = merged_opts.get('ffmpeg_location') or shutil.which('ffmpeg')
-    if needs_ffmpeg and not ffmpeg_path:
+    ffmpeg_path = merged_opts.get('ffmpeg_location') or _find_ffmpeg()
+    if not ffmpeg_path and _needs_ffmpeg(merged_opts):
          logger.warning("FFmpeg is needed for audio extraction/embedding but not found in PATH and 'ffmpeg_location' is not set. These features might fail.")
     elif ffmpeg_path:
          merged_opts['ffmpeg_location'] = ffmpeg_path
-         logger.debug(f"Using FFmpeg found at: {ffmpeg_path}")
+         logger.debug("Using FFmpeg found at: %s", ffmpeg_path)
 
     return merged_opts
 
-YDL_OPTS = load_ydl_opts()
+YDL_OPTS: Dict = {} # Loaded in main(), in a thread overlapped with the Telegram login
 
 # --- Bot Configuration (UBOT.cfg) ---
 DEFAULT_CONFIG = {
@@ -194,6 +261,7 @@ DEFAULT_CONFIG = {
     "recommendations_limit": 8,
     "history_limit": 10,
     "liked_songs_limit": 15,
+    "album_download_concurrency": 4,
 }
 
 def load_config(config_file: str = 'UBOT.cfg') -> Dict:
@@ -201,16 +269,15 @@ def load_config(config_file: str = 'UBOT.cfg') -> Dict:
     logger.info(f"Attempting to load bot config from: {absolute_config_path}")
     config = DEFAULT_CONFIG.copy()
     try:
-        with open(absolute_config_path, 'r', encoding='utf-8') as f:
-            loaded_config = json.load(f)
-            config.update(loaded_config)
-            added_keys = [key for key in DEFAULT_CONFIG if key not in loaded_config]
-            if added_keys: logger.warning(f"Added missing default keys to config: {', '.join(added_keys)}")
-            if "whitelist_enabled" in config:
-                 del config["whitelist_enabled"]
-                 logger.warning("Removed 'whitelist_enabled' from active config as it's deprecated.")
-
-            logger.info(f"Loaded configuration from {absolute_config_path}")
+        loaded_config = _read_json_cached(absolute_config_path)
+        config.update(loaded_config)
+        added_keys = [key for key in DEFAULT_CONFIG if key not in loaded_config]
+        if added_keys: logger.warning(f"Added missing default keys to config: {', '.join(added_keys)}")
+        if "whitelist_enabled" in config:
+             del config["whitelist_enabled"]
+             logger.warning("Removed 'whitelist_enabled' from active config as it's deprecated.")
+
+        logger.info(f"Loaded configuration from {absolute_config_path}")
     except FileNotFoundError:
         logger.warning(f"Bot config file '{absolute_config_path}' not found. Using default configuration.")
     except json.JSONDecodeError as e:
@@ -229,17 +296,23 @@ def save_config(config_to_save: Dict, config_file: str = 'UBOT.cfg'):
     if "whitelist_enabled" in config_copy: del config_copy["whitelist_enabled"]
 
     try:
-        with open(absolute_config_path, 'w', encoding='utf-8') as f:
-            json.dump(config_copy, f, indent=4, ensure_ascii=False)
+        payload = json.dumps(config_copy, indent=4, ensure_ascii=False).encode('utf-8')
+        with open(absolute_config_path, 'wb') as f:
+            f.write(payload) # Single write instead of json.dump's many small ones
         logger.info(f"Configuration saved to {absolute_config_path}")
     except Exception as e:
         logger.error(f"Error saving configuration to {absolute_config_path}: {e}")
 
-config = load_config()
+config: Dict = DEFAULT_CONFIG.copy() # Replaced by load_config() in main(), before any command is accepted
 
-# --- Constants derived from Config ---
+# --- Constants derived from Config (refreshed in main() once the config is loaded) ---
 BOT_CREDIT = config.get("bot_credit", "")
 DEFAULT_SEARCH_LIMIT = config.get("default_search_limit", 8)
+# Read on every message/command, so kept as plain globals instead of per-call config.get()
+BOT_ENABLED = config.get("bot_enabled", True)
+COMMAND_PREFIX = config.get("prefix", ",")
+AUTO_CLEAR = config.get("auto_clear", True)
+USE_PROGRESS_MESSAGES = config.get("progress_messages", True)
 MAX_SEARCH_RESULTS_DISPLAY = 6
 
 
@@ -252,6 +325,22 @@ ytmusic_authenticated = False
 BOT_OWNER_ID: Optional[int] = None
 
 
+# Dedicated pool for blocking ytmusicapi calls, so they can't starve (or be starved by) other executor work like yt-dlp downloads
+_YTM_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="ytmusic")
+# Bounded default executor for everything else offloaded with asyncio.to_thread / run_in_executor(None, ...):
+# file I/O, image decoding/cropping, cache maintenance. Installed at the start of main(), shut down by asyncio.run()
+_DEFAULT_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="worker")
+
+async def _ytm(func, *args, **kwargs):
+    """Runs a blocking ytmusicapi callable in the ytmusic thread pool."""
+    return await asyncio.get_running_loop().run_in_executor(_YTM_POOL, functools.partial(func, *args, **kwargs))
+
+# Shared session for every YTMusic client we build (including re-inits), so API calls reuse pooled TLS connections
+YTM_SESSION = requests.Session()
+YTM_SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_connections=20, pool_maxsize=20)) # Sized above _YTM_POOL; @retry handles retries
+_make_ytmusic = functools.partial(YTMusic, requests_session=YTM_SESSION)
+
+
 async def initialize_ytmusic_client():
     """Initializes or re-initializes the YTMusic API client."""
     global ytmusic, ytmusic_authenticated
@@ -261,22 +350,22 @@ async def initialize_ytmusic_client():
     try:
         if os.path.exists(YT_MUSIC_AUTH_FILE):
             logger.info(f"Found YTMusic auth file: '{auth_file_base}'. Attempting to initialize with it.")
-            temp_ytmusic = await current_loop.run_in_executor(None, YTMusic, YT_MUSIC_AUTH_FILE)
+            temp_ytmusic = await current_loop.run_in_executor(_YTM_POOL, _make_ytmusic, YT_MUSIC_AUTH_FILE)
             logger.debug("Checking YTMusic authentication status by fetching history...")
             try:
-                await current_loop.run_in_executor(None, temp_ytmusic.get_history)
+                await current_loop.run_in_executor(_YTM_POOL, temp_ytmusic.get_history)
                 ytmusic = temp_ytmusic
                 ytmusic_authenticated = True
                 logger.info("YTMusic authentication successful with file.")
             except Exception as e_auth_check:
                 logger.warning(f"YTMusic authentication with '{auth_file_base}' failed or cookies may be expired: {type(e_auth_check).__name__} - {e_auth_check}. Falling back to unauthenticated mode.")
                 # Fallback to unauthenticated if auth check fails
-                ytmusic = await current_loop.run_in_executor(None, YTMusic)
+                ytmusic = await current_loop.run_in_executor(_YTM_POOL, _make_ytmusic)
                 ytmusic_authenticated = False
                 logger.info("YTMusic API initialized in unauthenticated mode after auth file check failed.")
         else:
             logger.warning(f"YTMusic auth file '{auth_file_base}' not found. Initializing in unauthenticated mode.")
-            ytmusic = await current_loop.run_in_executor(None, YTMusic)
+            ytmusic = await current_loop.run_in_executor(_YTM_POOL, _make_ytmusic)
             ytmusic_authenticated = False
             logger.info("YTMusic API initialized in unauthenticated mode.")
 
@@ -285,7 +374,7 @@ async def initialize_ytmusic_client():
         # Attempt a final fallback to unauthenticated if primary init (even with file) fails badly
         try:
             logger.warning("Attempting final fallback to unauthenticated YTMusic initialization due to earlier critical error.")
-            ytmusic = await current_loop.run_in_executor(None, YTMusic)
+            ytmusic = await current_loop.run_in_executor(_YTM_POOL, _make_ytmusic)
             ytmusic_authenticated = False
             logger.info("YTMusic API initialized in unauthenticated mode as a final fallback.")
         except Exception as e_final_fallback:
@@ -321,60 +410,122 @@ def require_ytmusic_auth(func):
 #                            DATA MANAGEMENT (Last Tracks)
 # =============================================================================
 
-LAST_TRACKS_FILE = os.path.join(SCRIPT_DIR, 'last.csv')
+LAST_TRACKS_FILE = os.path.join(SCRIPT_DIR, 'last.json')
+LEGACY_LAST_TRACKS_FILE = os.path.join(SCRIPT_DIR, 'last.csv') # Pre-JSON format, migrated on first load
 HELP_FILE = os.path.join(SCRIPT_DIR, 'help.txt')
 
-# New header: Track Title,Artists,Video ID,Track URL,Duration Seconds,Timestamp
-# Old header: track,creator,browseid,tt:tt-dd-mm
+# Entry columns: Track Title, Artists, Video ID, Track URL, Duration Seconds, Timestamp
+# last.json stores a list of such rows; legacy last.csv has them ';'-separated with a header
+# Old CSV header: track,creator,browseid,tt:tt-dd-mm
 EXPECTED_LAST_TRACKS_COLUMNS = 6
 
 def load_last_tracks() -> List[List[str]]:
-    """Loads the history of recently downloaded tracks from last.csv."""
+    """Loads the history of recently downloaded tracks from last.json (migrating last.csv if needed)."""
     tracks: List[List[str]] = []
     if not os.path.exists(LAST_TRACKS_FILE):
+        if os.path.exists(LEGACY_LAST_TRACKS_FILE):
+            tracks = _load_legacy_last_tracks()
+            if tracks:
+                logger.info(f"Migrating {len(tracks)} last tracks entries from {LEGACY_LAST_TRACKS_FILE} to {LAST_TRACKS_FILE}")
+                save_last_tracks(tracks)
+            return tracks
         logger.info(f"Last tracks file not found: {LAST_TRACKS_FILE}. History is empty.")
         return tracks
     try:
-        with open(LAST_TRACKS_FILE, 'r', encoding='utf-8', newline='') as csvfile:
+        with open(LAST_TRACKS_FILE, 'rb') as f_last:
+            raw_last = f_last.read()
+        data_last = (orjson.loads(raw_last) if _HAS_ORJSON else json.loads(raw_last)) if raw_last.strip() else []
+        if not isinstance(data_last, list):
+            logger.warning(f"Unexpected content in {LAST_TRACKS_FILE} (expected a list of entries). History is empty.")
+            return tracks
+        tracks = [[str(cell) for cell in row] for row in data_last if isinstance(row, list) and len(row) >= EXPECTED_LAST_TRACKS_COLUMNS]
+        if len(tracks) < len(data_last):
+            logger.warning(f"Skipped {len(data_last) - len(tracks)} malformed entries (less than {EXPECTED_LAST_TRACKS_COLUMNS} columns) in {LAST_TRACKS_FILE}.")
+        logger.info(f"Loaded {len(tracks)} valid last tracks entries from {LAST_TRACKS_FILE}")
+    except Exception as e:
+        logger.error(f"Error loading last tracks from {LAST_TRACKS_FILE}: {e}")
+    return tracks
+
+# Header written by the old CSV-based save_last_tracks
+LEGACY_LAST_TRACKS_HEADER = ('Track Title', 'Artists', 'Video ID', 'Track URL', 'Duration Seconds', 'Timestamp')
+
+def _load_legacy_last_tracks() -> List[List[str]]:
+    """Loads the history of recently downloaded tracks from the legacy last.csv."""
+    tracks: List[List[str]] = []
+    try:
+        with open(LEGACY_LAST_TRACKS_FILE, 'r', encoding='utf-8', newline='') as csvfile:
             reader = csv.reader(csvfile, delimiter=';')
             header = next(reader, None)
-            # A loose check for the new header structure
-            expected_header_parts = ['title', 'artist', 'video', 'url', 'duration', 'timestamp']
             if header:
-                header_str_lower = ''.join(header).lower().replace(' ', '').replace('-', '').replace('(', '').replace(')', '')
-                if not all(part in header_str_lower for part in expected_header_parts):
-                    logger.warning(f"Unexpected header in {LAST_TRACKS_FILE}: {header}. Expected something like 'Track Title;Artists;Video ID;Track URL;Duration Seconds;Timestamp'.")
+                if tuple(cell.strip() for cell in header) != LEGACY_LAST_TRACKS_HEADER:
+                    logger.warning(f"Unexpected header in {LEGACY_LAST_TRACKS_FILE}: {header}. Expected something like 'Track Title;Artists;Video ID;Track URL;Duration Seconds;Timestamp'.")
             else: # No header means it's an old file or empty
-                logger.warning(f"{LAST_TRACKS_FILE} is empty or has no header. Assuming old format or empty.")
+                logger.warning(f"{LEGACY_LAST_TRACKS_FILE} is empty or has no header. Assuming old format or empty.")
 
 
-            tracks = [row for row in reader if len(row) >= EXPECTED_LAST_TRACKS_COLUMNS]
-            try:
-                with open(LAST_TRACKS_FILE, 'r', encoding='utf-8', newline='') as f_count:
-                    original_row_count = sum(1 for row in csv.reader(f_count, delimiter=';') if row) - (1 if header else 0)
-                if len(tracks) < original_row_count:
-                    logger.warning(f"Skipped {original_row_count - len(tracks)} malformed rows (less than {EXPECTED_LAST_TRACKS_COLUMNS} columns) in {LAST_TRACKS_FILE}.")
-            except Exception: pass
+            # Count non-empty rows in the same pass instead of re-reading the file
+            original_row_count = 0
+            for row in reader:
+                if not row: continue
+                original_row_count += 1
+                if len(row) >= EXPECTED_LAST_TRACKS_COLUMNS:
+                    tracks.append(row)
+            if len(tracks) < original_row_count:
+                logger.warning(f"Skipped {original_row_count - len(tracks)} malformed rows (less than {EXPECTED_LAST_TRACKS_COLUMNS} columns) in {LEGACY_LAST_TRACKS_FILE}.")
 
-        logger.info(f"Loaded {len(tracks)} valid last tracks entries from {LAST_TRACKS_FILE}")
+        logger.info(f"Loaded {len(tracks)} valid last tracks entries from {LEGACY_LAST_TRACKS_FILE}")
     except StopIteration:
-        logger.info(f"{LAST_TRACKS_FILE} is empty or contains only a header.")
+        logger.info(f"{LEGACY_LAST_TRACKS_FILE} is empty or contains only a header.")
     except Exception as e:
-        logger.error(f"Error loading last tracks from {LAST_TRACKS_FILE}: {e}")
+        logger.error(f"Error loading last tracks from {LEGACY_LAST_TRACKS_FILE}: {e}")
     return tracks
 
 def save_last_tracks(tracks: List[List[str]]):
-    """Saves the recent tracks history (keeping only the latest 5) to last.csv."""
+    """Saves the recent tracks history (keeping only the latest 5) to last.json."""
     try:
-        tracks_to_save = tracks[:5] # Keep only top 5
-        with open(LAST_TRACKS_FILE, 'w', encoding='utf-8', newline='') as csvfile:
-            writer = csv.writer(csvfile, delimiter=';')
-            writer.writerow(['Track Title', 'Artists', 'Video ID', 'Track URL', 'Duration Seconds', 'Timestamp'])
-            writer.writerows(tracks_to_save)
+        tracks_to_save = [[str(cell) for cell in row] for row in tracks[:5]] # Keep only top 5
+        payload_last = orjson.dumps(tracks_to_save) if _HAS_ORJSON else json.dumps(tracks_to_save, ensure_ascii=False).encode('utf-8')
+        tmp_last_path = LAST_TRACKS_FILE + '.tmp'
+        with open(tmp_last_path, 'wb') as f_last:
+            f_last.write(payload_last)
+        os.replace(tmp_last_path, LAST_TRACKS_FILE) # Atomic swap, a crash mid-write can't corrupt the history
         logger.info(f"Saved {len(tracks_to_save)} last tracks to {LAST_TRACKS_FILE}")
     except Exception as e:
         logger.error(f"Error saving last tracks to {LAST_TRACKS_FILE}: {e}")
 
+# --- Persistent Lyrics Cache ---
+# Lyrics for a browse ID don't change, so they (and the video ID -> lyrics browse ID mapping) survive restarts
+LYRICS_CACHE_FILE = os.path.join(SCRIPT_DIR, 'lyrics_cache.json')
+LYRICS_CACHE_TTL = 30 * 86400 # Seconds
+LYRICS_CACHE_MAX_ENTRIES = 500 # Per section, oldest entries are dropped first
+_LYRICS_CACHE_SECTIONS = ("lyrics", "browse_ids") # browse ID -> lyrics data, video ID -> lyrics browse ID
+
+def load_lyrics_cache() -> Dict[str, Dict[str, list]]:
+    """Loads the lyrics cache ({section: {key: [saved_at, value]}}) from disk, empty if missing or unreadable."""
+    cache_data: Dict[str, Dict[str, list]] = {section: {} for section in _LYRICS_CACHE_SECTIONS}
+    try:
+        with open(LYRICS_CACHE_FILE, 'rb') as f_cache:
+            raw = f_cache.read()
+        loaded = orjson.loads(raw) if _HAS_ORJSON else json.loads(raw)
+        for section in _LYRICS_CACHE_SECTIONS:
+            if isinstance(loaded.get(section), dict): cache_data[section] = loaded[section]
+        logger.info(f"Loaded lyrics cache from {LYRICS_CACHE_FILE}: {len(cache_data['lyrics'])} lyrics, {len(cache_data['browse_ids'])} IDs")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Could not load lyrics cache {LYRICS_CACHE_FILE}: {e}. Starting with an empty cache.")
+    return cache_data
+
+def save_lyrics_cache(payload: bytes):
+    """Writes an already serialized lyrics cache to disk (atomic replace)."""
+    try:
+        tmp_cache_path = LYRICS_CACHE_FILE + '.tmp'
+        with open(tmp_cache_path, 'wb') as f_cache:
+            f_cache.write(payload)
+        os.replace(tmp_cache_path, LYRICS_CACHE_FILE)
+    except Exception as e:
+        logger.error(f"Error saving lyrics cache to {LYRICS_CACHE_FILE}: {e}")
+
 # =============================================================================
 #                            CORE UTILITIES (with enhanced retry)
 # =============================================================================
@@ -397,6 +548,8 @@ def retry(max_tries: int = 3, delay: float = 2.0, exceptions: Optional[Tuple[Typ
         actual_exceptions.append(Exception)
 
     actual_exceptions_tuple = tuple(actual_exceptions)
+    last_attempt = max_tries - 1
+    waits = tuple(delay * (2 ** i) for i in range(max(last_attempt, 0))) # Exponential backoff, fixed per decoration
 
     def decorator(func):
         @functools.wraps(func)
@@ -415,11 +568,11 @@ def retry(max_tries: int = 3, delay: float = 2.0, exceptions: Optional[Tuple[Typ
                     elif empty_result_check == "{}" and result == {}: is_empty_result = True
 
                     if is_empty_result:
-                        if attempt == max_tries - 1:
+                        if attempt == last_attempt:
                             logger.warning(f"'{func.__name__}' returned empty result ('{empty_result_check}') after {max_tries} attempts. Returning empty result.")
                             return result
                         else:
-                            wait_time = delay * (2 ** attempt)
+                            wait_time = waits[attempt]
                             logger.warning(f"Attempt {attempt + 1}/{max_tries} of '{func.__name__}' returned empty result. Retrying in {wait_time:.2f}s...")
                             await asyncio.sleep(wait_time)
                             attempt += 1
@@ -447,11 +600,11 @@ def retry(max_tries: int = 3, delay: float = 2.0, exceptions: Optional[Tuple[Typ
                             # or let it fail if the next attempt still uses the (now unauthenticated) client.
                             # For simplicity, we let the retry loop continue. If auth is truly lost, subsequent retries will also fail.
 
-                    if attempt == max_tries - 1:
+                    if attempt == last_attempt:
                         logger.error(f"'{func.__name__}' failed after {max_tries} attempts. Last error: {e}", exc_info=True if not is_http_auth_error else False)
                         raise # Re-raise the last exception
                     else:
-                        wait_time = delay * (2 ** attempt)
+                        wait_time = waits[attempt]
                         logger.warning(f"Retrying '{func.__name__}' in {wait_time:.2f}s...")
                         await asyncio.sleep(wait_time)
                         attempt += 1
@@ -464,6 +617,66 @@ def retry(max_tries: int = 3, delay: float = 2.0, exceptions: Optional[Tuple[Typ
     return decorator
 
 
+def async_ttl_cache(ttl: float, maxsize: int = 256, negative_ttl: float = 60.0):
+    """
+    Decorator caching an async function's results per arguments for `ttl` seconds (empty results - None, [], {} - only for `negative_ttl`).
+    Concurrent calls with the same arguments share one in-flight call, run as its own task so a cancelled
+    caller doesn't cancel it for the others; exceptions are never cached.
+    Callers get a deep copy, so mutating a result can't corrupt the cache.
+    """
+    def decorator(func):
+        cache: Dict[Any, Tuple[Optional[float], asyncio.Future]] = {} # key -> (expiry or None while in flight, task); insertion order = LRU order
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            key = (args, tuple(sorted(kwargs.items())))
+            entry = cache.pop(key, None)
+            if entry and (entry[0] is None or entry[0] > loop.time()):
+                cache[key] = entry # Re-insert as most recently used
+                return copy.deepcopy(await asyncio.shield(entry[1]))
+
+            task = loop.create_task(func(*args, **kwargs))
+            cache[key] = (None, task)
+            while len(cache) > maxsize: del cache[next(iter(cache))] # Evict least recently used
+            _background_tasks.add(task) # Keeps it alive even if evicted while its first caller is gone
+
+            def settle(done: asyncio.Task):
+                _background_tasks.discard(done)
+                if cache.get(key, (None, None))[1] is not done: return # Evicted or cleared meanwhile
+                if done.cancelled() or done.exception() is not None: del cache[key] # Also marks the exception as retrieved
+                else: cache[key] = (loop.time() + (ttl if done.result() else negative_ttl), done)
+            task.add_done_callback(settle)
+            # Cancelling this caller only cancels its wait; the shared task keeps running for the other waiters
+            return copy.deepcopy(await asyncio.shield(task))
+
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    return decorator
+
+
+# Precompiled ID/URL patterns (hot path: every link or ID passed to a command)
+_ID_RE = re.compile(r'[A-Za-z0-9_-]{11}') # Standard YouTube video ID (use with fullmatch)
+_TOPIC_RE = re.compile(r'\s*-\s*Topic$') # Auto-generated "Artist - Topic" channel suffix
+# All supported link shapes in one alternation; the matched group name tells which kind of ID was found.
+# "youtube.com/..." also covers the music.youtube.com variants (search, not match).
+_ID_URL_RE = re.compile(
+    r"(?:youtube\.com/watch\?v=|youtu\.be/)(?P<video>[A-Za-z0-9_-]{11})" # YouTube/YTMusic video
+    r"|youtube\.com/playlist\?list=(?P<playlist>[A-Za-z0-9_-]+)"          # YouTube/YTMusic playlist
+    r"|(?:music\.youtube\.com/browse/|youtube\.com/channel/)(?P<browse>[A-Za-z0-9_-]+)" # YTMusic album/artist browse, YouTube channel
+)
+# Playlist (PL/VL/OLAK5uy_), album/release (MPRE/MPLA/RDAM) and channel/artist (UC) ID prefixes
+_ID_PREFIXES = ('PL', 'VL', 'OLAK5uy_', 'MPRE', 'MPLA', 'RDAM', 'UC')
+# Entity type from ID shape in one match; the group name is the type. The 11-char video ID is tried first (VL is also used for auto-generated "album" like playlists)
+_ID_KIND_RE = re.compile(r'(?P<track>[A-Za-z0-9_-]{11}\Z)|(?P<playlist>PL|VL)|(?P<album>OLAK5uy_|MPRE|MPLA|RDAM)|(?P<artist>UC)')
+# Removes playlist index placeholders from an output template (single track downloads)
+_PLAYLIST_IDX_RE = re.compile(r'[\[\(]?%?\(playlist_index\)[0-9]*[ds]?[-_\. ]?[\]\)]?')
+
+def _classify_id(entity_id: str) -> Optional[str]:
+    """Infers the entity type ('track', 'playlist', 'album' or 'artist') from the shape of an ID, None if unknown."""
+    m = _ID_KIND_RE.match(entity_id)
+    return m.lastgroup if m else None
+
 def extract_entity_id(link_or_id: str) -> Optional[str]:
     """
     Extracts YouTube Music video ID, playlist ID, album/artist browse ID from a URL or returns the input if it looks like an ID.
@@ -472,84 +685,93 @@ def extract_entity_id(link_or_id: str) -> Optional[str]:
     if not isinstance(link_or_id, str): return None
     link_or_id = link_or_id.strip()
 
-    # Direct ID patterns
-    if re.fullmatch(r'[A-Za-z0-9_-]{11}', link_or_id): # Standard YouTube video ID
-        return link_or_id
-    # YTMusic specific IDs (often longer or prefixed)
-    if link_or_id.startswith(('PL', 'VL', 'OLAK5uy_')): return link_or_id # Playlist IDs (VL can be for auto-generated "album" playlists)
-    if link_or_id.startswith(('MPRE', 'MPLA', 'RDAM')): return link_or_id # Album/release IDs
-    if link_or_id.startswith('UC'): return link_or_id # Channel/Artist IDs
-
-    # URL patterns
-    id_patterns = [
-        r"(?:youtube\.com/watch\?v=|youtu\.be/)([A-Za-z0-9_-]{11})", # Standard YouTube video
-        r"(?:music\.youtube\.com/watch\?v=)([A-Za-z0-9_-]{11})",    # YTMusic video
-        r"(?:music\.youtube\.com/playlist\?list=|youtube\.com/playlist\?list=)([A-Za-z0-9_-]+)", # YTMusic/YouTube Playlist
-        r"(?:music\.youtube\.com/browse/|youtube\.com/channel/)([A-Za-z0-9_-]+)", # YTMusic Album/Artist browse, YouTube Channel
-    ]
-    for pattern in id_patterns:
-        match = re.search(pattern, link_or_id)
-        if match:
-            extracted_id = match.group(1)
-            logger.debug(f"Extracted ID '{extracted_id}' using pattern '{pattern}' from link: {link_or_id}")
-            return extracted_id
+    # Direct ID patterns: YTMusic specific IDs (often longer or prefixed), then standard YouTube video ID
+    if link_or_id.startswith(_ID_PREFIXES): return link_or_id
+    if _ID_RE.fullmatch(link_or_id): return link_or_id
+
+    # URL patterns (only worth trying on something that looks like a link)
+    if '/' not in link_or_id:
+        logger.warning(f"Could not extract a valid ID from input: {link_or_id}")
+        return None
+    match = _ID_URL_RE.search(link_or_id)
+    if match:
+        extracted_id = match.group(match.lastgroup)
+        logger.debug("Extracted %s ID '%s' from link: %s", match.lastgroup, extracted_id, link_or_id)
+        return extracted_id
 
     logger.warning(f"Could not extract a valid ID from input: {link_or_id}")
     return None
 
+def _strip_topic(name: str) -> str:
+    """Removes the auto-generated ' - Topic' channel suffix from an artist name."""
+    if name.endswith(' - Topic'): return name[:-8].rstrip()
+    if name.endswith('Topic'): return _TOPIC_RE.sub('', name).strip() # Irregular spacing around the dash
+    return name
+
 def format_artists(data: Optional[Union[List[Dict], Dict, str]]) -> str:
     """Formats artist names from various ytmusicapi structures."""
-    names = []
     if isinstance(data, list):
-        names = [a.get('name', '').strip() for a in data if isinstance(a, dict) and a.get('name')]
+        names = (a.get('name') for a in data if isinstance(a, dict))
     elif isinstance(data, dict):
-        name = data.get('name', data.get('artist', '')).strip()
-        if name: names.append(name)
+        names = (data.get('name', data.get('artist', '')),)
     elif isinstance(data, str):
-        names.append(data.strip())
-    cleaned_names = [re.sub(r'\s*-\s*Topic$', '', name).strip() for name in names if name]
-    return ', '.join(filter(None, cleaned_names)) or 'Неизвестно'
+        names = (data,)
+    else:
+        return 'Неизвестно'
+    # Single pass: strip, drop the Topic suffix and skip empties while joining
+    return ', '.join(n for n in (_strip_topic(name.strip()) for name in names if name) if n) or 'Неизвестно'
+
+def unique_file_suffix() -> str:
+    """Short unique token for temporary file names: nanosecond clock plus random bytes (distinct even within one clock tick)."""
+    return f"{time.time_ns():x}{os.urandom(3).hex()}"
 
 # =============================================================================
 #                       YOUTUBE MUSIC API INTERACTION (with wrappers)
 # =============================================================================
 
+@async_ttl_cache(ttl=900, maxsize=512)
 @retry(max_tries=3, delay=2.0, empty_result_check='[]')
 async def _api_search(query: str, filter_type: Optional[str], limit: int) -> List[Dict]:
      if not ytmusic: raise RuntimeError("YTMusic API client not initialized")
-     logger.debug(f"Calling ytmusic.search(query='{query[:50]}...', filter='{filter_type}', limit={limit})")
-     return await asyncio.to_thread(ytmusic.search, query, filter=filter_type, limit=limit, ignore_spelling=True) # Added ignore_spelling
+     logger.debug("Calling ytmusic.search(query='%.50s...', filter='%s', limit=%s)", query, filter_type, limit)
+     return await _ytm(ytmusic.search, query, filter=filter_type, limit=limit, ignore_spelling=True) # Added ignore_spelling
 
 @retry(max_tries=3, delay=2.0, empty_result_check='None')
 async def _api_get_watch_playlist(video_id: str, **kwargs) -> Optional[Dict]:
      if not ytmusic: raise RuntimeError("YTMusic API client not initialized")
-     logger.debug(f"Calling ytmusic.get_watch_playlist(videoId='{video_id}', radio={kwargs.get('radio', False)}, limit={kwargs.get('limit', 1)})")
-     return await asyncio.to_thread(ytmusic.get_watch_playlist, videoId=video_id, **kwargs)
+     logger.debug("Calling ytmusic.get_watch_playlist(videoId='%s', radio=%s, limit=%s)", video_id, kwargs.get('radio', False), kwargs.get('limit', 1))
+     return await _ytm(ytmusic.get_watch_playlist, videoId=video_id, **kwargs)
+
+@async_ttl_cache(ttl=3600)
+async def _get_track_watch_info(video_id: str) -> Optional[Dict]:
+    """get_watch_playlist(limit=1) for a single video, shared by the get_entity_info fallback and the lyrics lookup."""
+    return await _api_get_watch_playlist(video_id, limit=1)
 
 @retry(max_tries=3, delay=2.0, empty_result_check='None')
 async def _api_get_song(video_id: str) -> Optional[Dict]:
      if not ytmusic: raise RuntimeError("YTMusic API client not initialized")
-     logger.debug(f"Calling ytmusic.get_song(videoId='{video_id}')")
-     return await asyncio.to_thread(ytmusic.get_song, videoId=video_id)
+     logger.debug("Calling ytmusic.get_song(videoId='%s')", video_id)
+     return await _ytm(ytmusic.get_song, videoId=video_id)
 
 @retry(max_tries=3, delay=2.0, empty_result_check='None')
 async def _api_get_album(browse_id: str) -> Optional[Dict]:
      if not ytmusic: raise RuntimeError("YTMusic API client not initialized")
-     logger.debug(f"Calling ytmusic.get_album(browseId='{browse_id}')")
-     return await asyncio.to_thread(ytmusic.get_album, browseId=browse_id)
+     logger.debug("Calling ytmusic.get_album(browseId='%s')", browse_id)
+     return await _ytm(ytmusic.get_album, browseId=browse_id)
 
 @retry(max_tries=3, delay=2.0, empty_result_check='None')
 async def _api_get_playlist(playlist_id: str, limit: Optional[int] = None) -> Optional[Dict]:
      if not ytmusic: raise RuntimeError("YTMusic API client not initialized")
-     logger.debug(f"Calling ytmusic.get_playlist(playlistId='{playlist_id}', limit={limit})")
-     return await asyncio.to_thread(ytmusic.get_playlist, playlistId=playlist_id, limit=limit)
+     logger.debug("Calling ytmusic.get_playlist(playlistId='%s', limit=%s)", playlist_id, limit)
+     return await _ytm(ytmusic.get_playlist, playlistId=playlist_id, limit=limit)
 
 @retry(max_tries=3, delay=2.0, empty_result_check='None')
 async def _api_get_artist(channel_id: str) -> Optional[Dict]:
      if not ytmusic: raise RuntimeError("YTMusic API client not initialized")
-     logger.debug(f"Calling ytmusic.get_artist(channelId='{channel_id}')")
-     return await asyncio.to_thread(ytmusic.get_artist, channelId=channel_id)
+     logger.debug("Calling ytmusic.get_artist(channelId='%s')", channel_id)
+     return await _ytm(ytmusic.get_artist, channelId=channel_id)
 
+@async_ttl_cache(ttl=3600)
 @retry(max_tries=3, delay=2.0, empty_result_check='None')
 async def get_entity_info(entity_id: str, entity_type_hint: Optional[str] = None) -> Optional[Dict]:
     """
@@ -564,15 +786,10 @@ async def get_entity_info(entity_id: str, entity_type_hint: Optional[str] = None
             return None
 
 
-    logger.debug(f"Fetching entity info for ID: {entity_id}, Hint: {entity_type_hint}")
+    logger.debug("Fetching entity info for ID: %s, Hint: %s", entity_id, entity_type_hint)
     try:
-        inferred_type = None
         if isinstance(entity_id, str):
-            if re.fullmatch(r'[A-Za-z0-9_-]{11}', entity_id): inferred_type = "track"
-            elif entity_id.startswith(('PL', 'VL')): inferred_type = "playlist" # VL prefix used for some auto-generated "album" like playlists
-            elif entity_id.startswith('OLAK5uy_'): inferred_type = "album" # Often used for albums by YTMusic
-            elif entity_id.startswith(('MPRE', 'MPLA', 'RDAM')): inferred_type = "album"
-            elif entity_id.startswith('UC'): inferred_type = "artist"
+            inferred_type = _classify_id(entity_id) # Computed once, reused by the generic checks below
         else:
             logger.warning(f"Invalid entity_id type provided: {type(entity_id)}.")
             return None
@@ -623,10 +840,10 @@ async def get_entity_info(entity_id: str, entity_type_hint: Optional[str] = None
                                  processed_info['thumbnails'] = (info.get('thumbnail') or {}).get('thumbnails')
                              if 'artists' not in processed_info and 'artists' in info: # artists from root of get_song
                                  processed_info['artists'] = info['artists']
-                             if 'lyrics' not in processed_info and 'lyrics' in info: # lyrics from root of get_song
-                                 processed_info['lyricsBrowseId'] = info['lyrics'] # Store browseId
-                                 # We might need to fetch lyrics content separately if only ID is here.
-                                 # For get_entity_info, we mostly care about metadata, not full content.
+                             # Always expose the lyrics browseId (None if get_song had none), callers pass it to get_lyrics_for_track
+                             # so it doesn't have to look it up again via get_watch_playlist
+                             if not processed_info.get('lyricsBrowseId'):
+                                 processed_info['lyricsBrowseId'] = processed_info.get('lyrics') or info.get('lyrics')
                              info = processed_info # This is the main dictionary for track details
                          else:
                               logger.warning(f"API call for {current_hint} '{entity_id}' lacked 'videoDetails'. Structure may be inconsistent.")
@@ -642,24 +859,10 @@ async def get_entity_info(entity_id: str, entity_type_hint: Optional[str] = None
                   logger.warning(f"API call for hint/inferred type '{current_hint}' failed for {entity_id}: {e_hint}. Trying generic checks.")
 
 
-        # Order of generic checks: track, playlist, album, artist (common to specific)
-        generic_check_order_funcs = [
-             ("track", _api_get_song),
-             ("playlist", _api_get_playlist),
-             ("album", _api_get_album),
-             ("artist", _api_get_artist),
-        ]
-
-        for type_name, api_func in generic_check_order_funcs:
-            # Skip if this was already tried via hint
-            if current_hint and current_hint == type_name: continue
-
-            # Basic sanity checks for ID format against type
-            if type_name == "track" and not re.fullmatch(r'[A-Za-z0-9_-]{11}', entity_id): continue
-            if type_name == "album" and not entity_id.startswith(('MPRE', 'MPLA', 'RDAM', 'OLAK5uy_')): continue # OLAK also for albums
-            if type_name == "artist" and not entity_id.startswith('UC'): continue
-            if type_name == "playlist" and not entity_id.startswith(('PL', 'VL')): continue # VL also for playlists
-
+        # Generic check: only the type the ID's shape points to (any other API call would be doomed),
+        # and only if the hinted call above wasn't already that type
+        if inferred_type and inferred_type != current_hint:
+            type_name, api_func = inferred_type, api_calls_by_type[inferred_type]
             try:
                 logger.debug(f"Trying generic API call for type '{type_name}' for {entity_id}")
                 api_arg_generic = entity_id # Default to passing the ID directly
@@ -672,14 +875,14 @@ async def get_entity_info(entity_id: str, entity_type_hint: Optional[str] = None
                         if 'videoDetails' not in result and 'title' in result and 'videoId' in result:
                              temp_res = {'videoDetails': result.copy()}
                              if 'thumbnails' not in temp_res and 'thumbnail' in result: temp_res['thumbnails'] = (result.get('thumbnail') or {}).get('thumbnails')
-                             if 'lyrics' not in temp_res and 'lyrics' in result: temp_res['lyricsBrowseId'] = result['lyrics']
+                             if 'lyrics' in result: temp_res['lyrics'] = result['lyrics']
                              final_info = temp_res
 
                         if final_info.get('videoDetails'):
                             processed_info_generic = final_info['videoDetails']
                             if 'thumbnails' not in processed_info_generic and 'thumbnail' in final_info: processed_info_generic['thumbnails'] = (final_info.get('thumbnail') or {}).get('thumbnails')
                             if 'artists' not in processed_info_generic and 'artists' in final_info: processed_info_generic['artists'] = final_info['artists']
-                            if 'lyrics' not in processed_info_generic and 'lyrics' in final_info: processed_info_generic['lyricsBrowseId'] = final_info['lyrics']
+                            if not processed_info_generic.get('lyricsBrowseId'): processed_info_generic['lyricsBrowseId'] = processed_info_generic.get('lyrics') or final_info.get('lyrics')
                             final_info = processed_info_generic
                         else:
                              logger.warning(f"Generic check {type_name} for {entity_id} lacked 'videoDetails'. Structure may be inconsistent.")
@@ -691,17 +894,20 @@ async def get_entity_info(entity_id: str, entity_type_hint: Optional[str] = None
                     return final_info
             except Exception as e_generic_check:
                  logger.debug(f"Generic check for type '{type_name}' for {entity_id} failed: {e_generic_check}")
-                 pass # Silently try next
+                 pass # Fall through to the watch playlist fallback
 
 
         # Final fallback for track-like IDs using get_watch_playlist if get_song failed
-        if (inferred_type == "track" or re.fullmatch(r'[A-Za-z0-9_-]{11}', entity_id)) and (not entity_type_hint or entity_type_hint == "track"):
+        if inferred_type == "track" and (not entity_type_hint or entity_type_hint == "track"): # _classify_id already ran the video ID match
              logger.debug(f"Final fallback: Trying get_watch_playlist for potential track ID {entity_id}")
              try:
-                 watch_info = await _api_get_watch_playlist(entity_id, limit=1) # Get info for the video itself
+                 watch_info = await _get_track_watch_info(entity_id) # Get info for the video itself
                  if watch_info and watch_info.get('tracks') and len(watch_info['tracks']) > 0:
                       # The first track in get_watch_playlist(videoId=X) is usually X itself.
                       track_data = watch_info['tracks'][0]
+                      artists = track_data.get('artists')
+                      author = format_artists(artists) # Shared by the top level and videoDetails
+                      channel_id = artists[0].get('id') if artists and artists[0] else None
                       # Standardize to look like get_song's videoDetails structure
                       standardized_info = {
                           '_entity_type': 'track',
@@ -716,8 +922,8 @@ async def get_entity_info(entity_id: str, entity_type_hint: Optional[str] = None
                           'lyricsBrowseId': watch_info.get('lyrics'), # Lyrics browse ID for the *main* video
                           # Reconstruct a basic videoDetails-like structure
                           # This is a bit redundant but helps standardize
-                          'author': format_artists(track_data.get('artists')), # For compatibility
-                          'channelId': (track_data.get('artists')[0].get('id') if track_data.get('artists') and track_data.get('artists')[0] else None),
+                          'author': author, # For compatibility
+                          'channelId': channel_id,
                           'viewCount': track_data.get('views'),
                           # Ensure videoDetails compatibility
                           'videoDetails': { # Add this for consistency with how get_song structures it
@@ -725,8 +931,8 @@ async def get_entity_info(entity_id: str, entity_type_hint: Optional[str] = None
                                 'title': track_data.get('title'),
                                 'lengthSeconds': track_data.get('lengthSeconds'),
                                 'thumbnails': track_data.get('thumbnail'),
-                                'author': format_artists(track_data.get('artists')),
-                                'channelId': (track_data.get('artists')[0].get('id') if track_data.get('artists') and track_data.get('artists')[0] else None),
+                                'author': author,
+                                'channelId': channel_id,
                                 'lyricsBrowseId': watch_info.get('lyrics'),
                                 'viewCount': track_data.get('views')
                           }
@@ -751,21 +957,45 @@ async def get_entity_info(entity_id: str, entity_type_hint: Optional[str] = None
         return None
 
 
-@retry(max_tries=3, delay=2.0, empty_result_check='None')
-async def _api_get_watch_playlist_for_lyrics(video_id: str) -> Optional[Dict]:
-    """Wrapper for get_watch_playlist specifically for finding lyrics browse ID."""
-    if not ytmusic: raise RuntimeError("YTMusic API client not initialized")
-    logger.debug(f"Calling ytmusic.get_watch_playlist(videoId='{video_id}', limit=1) for lyrics lookup")
-    return await asyncio.to_thread(ytmusic.get_watch_playlist, videoId=video_id, limit=1)
-
 @retry(max_tries=3, delay=2.0, empty_result_check='None')
 async def _api_get_lyrics_content(browse_id: str) -> Optional[Dict[str, str]]:
     """Wrapper for get_lyrics to fetch the lyrics content."""
     if not ytmusic: raise RuntimeError("YTMusic API client not initialized")
     logger.debug(f"Calling ytmusic.get_lyrics(browseId='{browse_id}')")
-    return await asyncio.to_thread(ytmusic.get_lyrics, browseId=browse_id)
+    return await _ytm(ytmusic.get_lyrics, browseId=browse_id)
+
 
+_lyrics_cache: Optional[Dict[str, Dict[str, list]]] = None # Loaded on first lyrics request
+_lyrics_cache_lock: Optional[asyncio.Lock] = None # Created on first use, inside the running loop
 
+def _get_lyrics_cache_lock() -> asyncio.Lock:
+    global _lyrics_cache_lock
+    if _lyrics_cache_lock is None: _lyrics_cache_lock = asyncio.Lock()
+    return _lyrics_cache_lock
+
+async def _lyrics_cache_get(section: str, key: str) -> Optional[Any]:
+    """Returns a non-expired value from the persistent lyrics cache, or None."""
+    global _lyrics_cache
+    async with _get_lyrics_cache_lock():
+        if _lyrics_cache is None: _lyrics_cache = await asyncio.to_thread(load_lyrics_cache)
+        entry = _lyrics_cache[section].get(key)
+    if entry and datetime.datetime.now().timestamp() - entry[0] < LYRICS_CACHE_TTL:
+        return entry[1]
+    return None
+
+async def _lyrics_cache_put(section: str, key: str, value: Any):
+    """Stores a value in the persistent lyrics cache and writes it to disk in the background."""
+    global _lyrics_cache
+    async with _get_lyrics_cache_lock():
+        if _lyrics_cache is None: _lyrics_cache = await asyncio.to_thread(load_lyrics_cache)
+        section_entries = _lyrics_cache[section]
+        section_entries.pop(key, None) # Re-insert so dict order stays oldest-first
+        section_entries[key] = [datetime.datetime.now().timestamp(), value]
+        while len(section_entries) > LYRICS_CACHE_MAX_ENTRIES: del section_entries[next(iter(section_entries))]
+        payload = orjson.dumps(_lyrics_cache, default=str) if _HAS_ORJSON else json.dumps(_lyrics_cache, ensure_ascii=False, default=str).encode('utf-8')
+        await asyncio.to_thread(save_lyrics_cache, payload) # Under the lock, so writes can't land out of order
+
+@async_ttl_cache(ttl=3600)
 async def get_lyrics_for_track(video_id: Optional[str], lyrics_browse_id: Optional[str] = None) -> Optional[Dict[str, str]]:
     """
     Fetches lyrics for a track using its video ID or lyrics browse ID, using wrapped API calls.
@@ -786,11 +1016,15 @@ async def get_lyrics_for_track(video_id: Optional[str], lyrics_browse_id: Option
     track_id_for_log = video_id or lyrics_browse_id # Use video_id for logging if available, else browse_id
 
     try:
+        if not final_lyrics_browse_id and video_id:
+             final_lyrics_browse_id = await _lyrics_cache_get("browse_ids", video_id)
+             if final_lyrics_browse_id: logger.debug(f"Found lyrics browse ID in persistent cache: {final_lyrics_browse_id} for video {video_id}")
+
         # If we don't have a lyrics_browse_id, try to get it from get_watch_playlist
         if not final_lyrics_browse_id and video_id:
              logger.debug(f"No explicit lyrics browse ID. Attempting to find via watch playlist for video: {video_id}")
              try:
-                 watch_info = await _api_get_watch_playlist_for_lyrics(video_id)
+                 watch_info = await _get_track_watch_info(video_id)
                  # 'lyrics' key in get_watch_playlist result is the browseId for lyrics
                  final_lyrics_browse_id = watch_info.get('lyrics') if watch_info else None
 
@@ -799,12 +1033,17 @@ async def get_lyrics_for_track(video_id: Optional[str], lyrics_browse_id: Option
                       # It's possible the track has no lyrics, so this is not necessarily an error yet.
                  else:
                      logger.debug(f"Found lyrics browse ID via watch_playlist: {final_lyrics_browse_id} for video {video_id}")
+                     await _lyrics_cache_put("browse_ids", video_id, final_lyrics_browse_id)
              except Exception as e_watch_lookup:
                   logger.warning(f"Failed to get watch playlist info for lyrics browse ID lookup ({video_id}) after retries: {e_watch_lookup}")
                   # Proceed without it, get_lyrics might fail or return None.
 
         # If we have a lyrics_browse_id (either passed in or found), fetch the lyrics
         if final_lyrics_browse_id:
+             cached_lyrics = await _lyrics_cache_get("lyrics", final_lyrics_browse_id)
+             if cached_lyrics:
+                 logger.info(f"Using persistently cached lyrics for browse ID {final_lyrics_browse_id} (track: {track_id_for_log})")
+                 return cached_lyrics
              logger.info(f"Fetching lyrics content using browse ID: {final_lyrics_browse_id} (for track: {track_id_for_log})")
              try:
                  lyrics_data = await _api_get_lyrics_content(final_lyrics_browse_id)
@@ -814,6 +1053,7 @@ async def get_lyrics_for_track(video_id: Optional[str], lyrics_browse_id: Option
                      if not lyrics_data.get('lyrics') and lyrics_data.get('description'):
                          lyrics_data['lyrics'] = lyrics_data['description']
                          logger.info(f"Used 'description' field as lyrics for {track_id_for_log}")
+                     await _lyrics_cache_put("lyrics", final_lyrics_browse_id, lyrics_data)
                      return lyrics_data
                  else:
                       logger.info(f"API call for lyrics content succeeded but returned no lyrics for browse ID {final_lyrics_browse_id} (track: {track_id_for_log})")
@@ -836,21 +1076,21 @@ async def _api_get_history():
     if not ytmusic: raise RuntimeError("YTMusic API client not initialized")
     if not ytmusic_authenticated: raise RuntimeError("YTMusic client not authenticated for get_history")
     logger.debug("Calling ytmusic.get_history()")
-    return await asyncio.to_thread(ytmusic.get_history)
+    return await _ytm(ytmusic.get_history)
 
 @retry(max_tries=3, delay=2.0, empty_result_check='None') # Liked songs can return a dict with 'tracks' or None
 async def _api_get_liked_songs(limit):
     if not ytmusic: raise RuntimeError("YTMusic API client not initialized")
     if not ytmusic_authenticated: raise RuntimeError("YTMusic client not authenticated for get_liked_songs")
     logger.debug(f"Calling ytmusic.get_liked_songs(limit={limit})")
-    return await asyncio.to_thread(ytmusic.get_liked_songs, limit=limit)
+    return await _ytm(ytmusic.get_liked_songs, limit=limit)
 
 @retry(max_tries=3, delay=2.0, empty_result_check='[]')
 async def _api_get_home(limit):
     if not ytmusic: raise RuntimeError("YTMusic API client not initialized")
     # get_home does not strictly require auth but works better with it
     logger.debug(f"Calling ytmusic.get_home(limit={limit})")
-    return await asyncio.to_thread(ytmusic.get_home, limit=limit)
+    return await _ytm(ytmusic.get_home, limit=limit)
 
 
 # =============================================================================
@@ -862,26 +1102,17 @@ def extract_track_metadata(info: Dict) -> Tuple[str, str, int]:
     Extracts Title, Performer, and Duration from yt-dlp's info dictionary.
     """
     title = info.get('track') or info.get('title') or 'Неизвестно'
-    performer = 'Неизвестно'
-    if info.get('artist'): # Usually from --add-metadata
-        performer = info['artist']
-    elif info.get('artists') and isinstance(info['artists'], list): # From ytmusicapi structures if merged
-         artist_names = [a['name'] for a in info['artists'] if isinstance(a, dict) and a.get('name')]
-         if artist_names: performer = ', '.join(artist_names)
-    elif info.get('creator'): # Fallback from yt-dlp
-         performer = info['creator']
-    elif info.get('uploader'): # Fallback from yt-dlp
-         performer = re.sub(r'\s*-\s*Topic$', '', info['uploader']).strip()
-
-    # If performer is still default and 'channel' exists (often for - Topic channels)
-    if performer in [None, "", "Неизвестно"] and info.get('channel'):
-         performer = re.sub(r'\s*-\s*Topic$', '', info['channel']).strip()
-
-    if performer in [None, "", "Неизвестно"]: # Final default
-        performer = 'Неизвестно'
-
-    # Clean " - Topic" suffix again, just in case
-    performer = re.sub(r'\s*-\s*Topic$', '', performer).strip()
+    artists_list = info.get('artists')
+    # First non-empty source wins; later ones are never evaluated
+    performer = (info.get('artist') # Usually from --add-metadata
+                 or (', '.join(filter(None, (a.get('name') for a in artists_list if isinstance(a, dict)))) # From ytmusicapi structures if merged
+                     if isinstance(artists_list, list) else None)
+                 or info.get('creator') # Fallback from yt-dlp
+                 or info.get('uploader') # Fallback from yt-dlp
+                 or info.get('channel')) # Often "<Artist> - Topic" channels
+    # Clean " - Topic" suffix (uploader/channel, but artist/creator can carry it too)
+    performer = _strip_topic(performer.strip()) if performer else ''
+    if not performer: performer = 'Неизвестно'
 
 
     duration = 0
@@ -898,6 +1129,49 @@ def extract_track_metadata(info: Dict) -> Tuple[str, str, int]:
     return title, performer, duration
 
 
+# Per-thread YoutubeDL instances keyed by options: building one registers every extractor and
+# postprocessor, and an instance isn't safe to share between the parallel album download threads
+_ydl_local = threading.local()
+# Dedicated pool for yt-dlp work (downloads + ffmpeg postprocessing, playlist analysis); also bounds the number of cached instances
+_YDL_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="ytdlp")
+_YDL_INSTANCES: List['yt_dlp.YoutubeDL'] = [] # Every instance created, closed on shutdown
+_YDL_INSTANCES_LOCK = threading.Lock()
+
+def _get_ydl(opts: Dict) -> 'yt_dlp.YoutubeDL':
+    """Returns the calling thread's YoutubeDL for these options, creating it on first use."""
+    key = json.dumps(opts, sort_keys=True, default=str)
+    thread_instances = getattr(_ydl_local, 'instances', None)
+    if thread_instances is None: thread_instances = _ydl_local.instances = {}
+    ydl = thread_instances.get(key)
+    if ydl is None:
+        ydl = thread_instances[key] = yt_dlp.YoutubeDL(opts)
+        with _YDL_INSTANCES_LOCK: _YDL_INSTANCES.append(ydl)
+    return ydl
+
+def close_ydl_instances():
+    """Closes all cached YoutubeDL instances (saves cookies, releases connections)."""
+    with _YDL_INSTANCES_LOCK:
+        instances, _YDL_INSTANCES[:] = list(_YDL_INSTANCES), []
+    for ydl in instances:
+        try: ydl.close()
+        except Exception as e_close: logger.warning(f"Error closing YoutubeDL instance: {e_close}")
+
+_AUDIO_EXTS = frozenset(('m4a', 'mp3', 'opus', 'ogg', 'flac', 'aac', 'wav')) # Final audio file extensions (without the dot)
+
+def _find_audio_file(base_path: str) -> Optional[str]:
+    """Returns a file named base_path + '.<audio ext>' using a single directory scan, None if there is none."""
+    base_dir, base_name = os.path.split(base_path)
+    prefix = base_name + '.'
+    try:
+        with os.scandir(base_dir or '.') as dir_entries:
+            for dir_entry in dir_entries:
+                entry_name = dir_entry.name
+                if entry_name.startswith(prefix) and entry_name[len(prefix):] in _AUDIO_EXTS and dir_entry.is_file():
+                    return dir_entry.path
+    except OSError as e_scan:
+        logger.warning(f"Could not scan '{base_dir}' for the downloaded file: {e_scan}")
+    return None
+
 def download_track(track_link: str) -> Tuple[Optional[Dict], Optional[str]]:
     """
     Downloads a single track using yt-dlp with configured options.
@@ -912,78 +1186,85 @@ def download_track(track_link: str) -> Tuple[Optional[Dict], Optional[str]]:
         current_ydl_opts['noplaylist'] = True
         tmpl = current_ydl_opts.get('outtmpl', '%(title)s.%(ext)s')
         # Remove playlist index from template for single track downloads
-        tmpl = re.sub(r'[\[\(]?%?\(playlist_index\)[0-9]*[ds]?[-_\. ]?[\]\)]?', '', tmpl).strip()
+        tmpl = _PLAYLIST_IDX_RE.sub('', tmpl).strip()
         current_ydl_opts['outtmpl'] = tmpl if tmpl else '%(title)s.%(ext)s'
 
 
-        with yt_dlp.YoutubeDL(current_ydl_opts) as ydl:
-            # Download=True will trigger postprocessors
-            info = ydl.extract_info(track_link, download=True)
-
-            if not info:
-                logger.error(f"yt-dlp extract_info returned empty/None for {track_link}")
-                return None, None
-
-            # Determine the final file path after post-processing
-            final_filepath = None
-            # 'requested_downloads' might contain info about the file *after* postprocessing
-            if info.get('requested_downloads') and isinstance(info['requested_downloads'], list):
-                 # The last entry in requested_downloads for an audio format is usually the final one
-                 final_download_info = next((d for d in reversed(info['requested_downloads'])
-                                             if d.get('filepath') and os.path.exists(d['filepath']) and d.get('ext') in ['m4a', 'mp3', 'opus', 'ogg', 'flac', 'aac', 'wav']), None) # Added common audio exts
-                 if final_download_info:
-                      final_filepath = final_download_info.get('filepath')
-                      logger.debug(f"Found final path in 'requested_downloads': {final_filepath}")
-
-            # Fallback to 'filepath' from the main info dict if not in requested_downloads
-            # This 'filepath' might be before postprocessing, so further checks are needed.
-            if not final_filepath and info.get('filepath'):
-                 final_filepath = info.get('filepath') # This might be the path *before* postprocessing like audio conversion
-                 logger.debug(f"Using top-level 'filepath' key: {final_filepath}. Verifying existence and format.")
-
-
-            # If the path from info dict exists and is a file, use it.
-            # This could be the final path if no significant postprocessing changed the name/ext.
-            if final_filepath and os.path.exists(final_filepath) and os.path.isfile(final_filepath):
-                 logger.info(f"Download and postprocessing successful. Final file (verified from info): {final_filepath}")
-                 info['filepath'] = final_filepath # Ensure this is set for return
-                 return info, final_filepath
-            else:
-                # If the filepath from info is not the final one (e.g., after FFmpegExtractAudio)
-                # we need to deduce the correct path.
-                logger.warning(f"File at '{final_filepath}' (from info dict) not found or not a file. Attempting to locate final processed file.")
-                # ydl.prepare_filename(info) *after* download should give the path considering postprocessor changes (like .m4a)
-                try:
-                    # This should reflect the filename after postprocessing if 'outtmpl' and 'postprocessors' are set correctly
-                    potential_path_after_pp = ydl.prepare_filename(info)
-                    logger.debug(f"Path based on prepare_filename after download: {potential_path_after_pp}")
-
-                    if os.path.exists(potential_path_after_pp) and os.path.isfile(potential_path_after_pp):
-                         logger.info(f"Located final file via prepare_filename: {potential_path_after_pp}")
-                         info['filepath'] = potential_path_after_pp # Update info with the correct path
-                         return info, potential_path_after_pp
-                    else:
-                        # If prepare_filename doesn't yield the correct one (e.g., if ext changed by PP but not reflected)
-                        # Try to guess based on preferred codec.
-                        base_potential, _ = os.path.splitext(potential_path_after_pp)
-                        preferred_codec = None
-                        for pp_cfg in current_ydl_opts.get('postprocessors', []):
-                            if pp_cfg.get('key') == 'FFmpegExtractAudio':
-                                preferred_codec = pp_cfg.get('preferredcodec')
-                                break
-                        if preferred_codec:
-                            check_path_with_codec = base_potential + "." + preferred_codec
-                            if os.path.exists(check_path_with_codec) and os.path.isfile(check_path_with_codec):
-                                logger.info(f"Located final file via preferred codec check: {check_path_with_codec}")
-                                info['filepath'] = check_path_with_codec
-                                return info, check_path_with_codec
-
-                        logger.error(f"Could not locate the final processed audio file for {track_link} even after prepare_filename and codec check. Path from prepare_filename: {potential_path_after_pp}")
-                        return info, None # Return info but no valid path
-
-                except Exception as e_locate:
-                    logger.error(f"Error trying to locate final file for {track_link}: {e_locate}", exc_info=True)
-                    return info, None # Return info (which might be partial) but no path
+        ydl = _get_ydl(current_ydl_opts) # Reused across calls on this thread (extractors, cookies, connections)
+        # Download=True will trigger postprocessors
+        info = ydl.extract_info(track_link, download=True)
+
+        if not info:
+            logger.error(f"yt-dlp extract_info returned empty/None for {track_link}")
+            return None, None
+
+        # Determine the final file path after post-processing
+        final_filepath = None
+        # 'requested_downloads' might contain info about the file *after* postprocessing
+        if info.get('requested_downloads') and isinstance(info['requested_downloads'], list):
+             # The last entry in requested_downloads for an audio format is usually the final one
+             final_download_info = next((d for d in reversed(info['requested_downloads'])
+                                         if d.get('filepath') and os.path.isfile(d['filepath']) and d.get('ext') in _AUDIO_EXTS), None)
+             if final_download_info:
+                  final_filepath = final_download_info.get('filepath')
+                  logger.debug(f"Found final path in 'requested_downloads': {final_filepath}")
+
+        # Fallback to 'filepath' from the main info dict if not in requested_downloads
+        # This 'filepath' might be before postprocessing, so further checks are needed.
+        if not final_filepath and info.get('filepath'):
+             final_filepath = info.get('filepath') # This might be the path *before* postprocessing like audio conversion
+             logger.debug(f"Using top-level 'filepath' key: {final_filepath}. Verifying existence and format.")
+
+
+        # If the path from info dict exists and is a file, use it.
+        # This could be the final path if no significant postprocessing changed the name/ext.
+        if final_filepath and os.path.isfile(final_filepath):
+             logger.info(f"Download and postprocessing successful. Final file (verified from info): {final_filepath}")
+             info['filepath'] = final_filepath # Ensure this is set for return
+             return info, final_filepath
+        else:
+            # If the filepath from info is not the final one (e.g., after FFmpegExtractAudio)
+            # we need to deduce the correct path.
+            logger.warning(f"File at '{final_filepath}' (from info dict) not found or not a file. Attempting to locate final processed file.")
+            # ydl.prepare_filename(info) *after* download should give the path considering postprocessor changes (like .m4a)
+            try:
+                # This should reflect the filename after postprocessing if 'outtmpl' and 'postprocessors' are set correctly
+                potential_path_after_pp = ydl.prepare_filename(info)
+                logger.debug(f"Path based on prepare_filename after download: {potential_path_after_pp}")
+
+                if os.path.isfile(potential_path_after_pp):
+                     logger.info(f"Located final file via prepare_filename: {potential_path_after_pp}")
+                     info['filepath'] = potential_path_after_pp # Update info with the correct path
+                     return info, potential_path_after_pp
+                else:
+                    # If prepare_filename doesn't yield the correct one (e.g., if ext changed by PP but not reflected)
+                    # Try to guess based on preferred codec.
+                    base_potential, _ = os.path.splitext(potential_path_after_pp)
+                    preferred_codec = None
+                    for pp_cfg in current_ydl_opts.get('postprocessors', []):
+                        if pp_cfg.get('key') == 'FFmpegExtractAudio':
+                            preferred_codec = pp_cfg.get('preferredcodec')
+                            break
+                    if preferred_codec:
+                        check_path_with_codec = base_potential + "." + preferred_codec
+                        if os.path.isfile(check_path_with_codec):
+                            logger.info(f"Located final file via preferred codec check: {check_path_with_codec}")
+                            info['filepath'] = check_path_with_codec
+                            return info, check_path_with_codec
+
+                    # Last resort: one directory listing, matching the base name with any audio extension
+                    located_path = _find_audio_file(base_potential)
+                    if located_path:
+                        logger.info(f"Located final file via directory scan: {located_path}")
+                        info['filepath'] = located_path
+                        return info, located_path
+
+                    logger.error(f"Could not locate the final processed audio file for {track_link} even after prepare_filename and codec check. Path from prepare_filename: {potential_path_after_pp}")
+                    return info, None # Return info but no valid path
+
+            except Exception as e_locate:
+                logger.error(f"Error trying to locate final file for {track_link}: {e_locate}", exc_info=True)
+                return info, None # Return info (which might be partial) but no path
 
     except yt_dlp.utils.DownloadError as e:
         # Specific yt-dlp download errors (network, unavailable, etc.)
@@ -998,9 +1279,30 @@ def download_track(track_link: str) -> Tuple[Optional[Dict], Optional[str]]:
         return None, None
 
 
+@async_ttl_cache(ttl=600, maxsize=64)
+async def _analyze_playlist(analysis_url: str, playlist_end: Optional[int] = None) -> Optional[Dict]:
+    """Lists a playlist/album's entries with yt-dlp (flat, no download); cached briefly per URL."""
+    # yt-dlp options for extracting playlist/album info without downloading
+    analysis_opts = {
+        'extract_flat': 'in_playlist', # Get info for each item in playlist/album
+        'skip_download': True,
+        'quiet': True,
+        'ignoreerrors': True, # Skip problematic tracks
+        'noplaylist': False, # We *want* playlist/album items
+        'cookiefile': YDL_OPTS.get('cookiefile'), # Use cookies if available
+    }
+    if playlist_end: analysis_opts['playlistend'] = playlist_end
+    loop = asyncio.get_running_loop()
+    # Run synchronous yt-dlp call in an executor
+    playlist_dict = await loop.run_in_executor(_YDL_POOL, functools.partial(yt_dlp.YoutubeDL(analysis_opts).extract_info, analysis_url, download=False))
+    if playlist_dict and playlist_dict.get('entries') is not None:
+        playlist_dict['entries'] = list(playlist_dict['entries']) # Materialize (may be lazy) so the result can be cached
+    return playlist_dict
+
+
 async def download_album_tracks(album_browse_id: str, progress_callback=None) -> List[Tuple[Dict, str]]:
     """
-    Downloads all tracks from a given album browse ID using yt-dlp sequentially.
+    Downloads all tracks from a given album browse ID using yt-dlp, several at a time (album_download_concurrency).
     Uses wrapped API calls for metadata and runs synchronous download_track in executor.
     """
     if not ytmusic:
@@ -1012,7 +1314,7 @@ async def download_album_tracks(album_browse_id: str, progress_callback=None) ->
             return []
 
 
-    logger.info(f"Attempting to download album/playlist sequentially: {album_browse_id}")
+    logger.info(f"Attempting to download album/playlist: {album_browse_id}")
     downloaded_files: List[Tuple[Dict, str]] = []
     album_info, total_tracks, album_title = None, 0, album_browse_id
 
@@ -1022,10 +1324,9 @@ async def download_album_tracks(album_browse_id: str, progress_callback=None) ->
         entity_type_for_api = None # 'album' or 'playlist'
 
         # Determine if it's an album or playlist based on ID prefix
-        if album_browse_id.startswith(('MPRE', 'MPLA', 'RDAM', 'OLAK5uy_')):
-            entity_type_for_api = "album"
-        elif album_browse_id.startswith(('PL', 'VL')):
-            entity_type_for_api = "playlist"
+        id_kind = _classify_id(album_browse_id)
+        if id_kind in ("album", "playlist"):
+            entity_type_for_api = id_kind
         else:
             logger.info(f"ID {album_browse_id} type is ambiguous based on prefix. Will rely on yt-dlp analysis if API metadata fails.")
             # We can still try to fetch as album first, then playlist, or let yt-dlp handle it if both fail.
@@ -1073,9 +1374,9 @@ async def download_album_tracks(album_browse_id: str, progress_callback=None) ->
                  # Construct full URL for yt-dlp if it's just an ID
                  analysis_url = album_browse_id
                  if not album_browse_id.startswith("http"):
-                     if entity_type_for_api == "album" or album_browse_id.startswith(('MPRE', 'MPLA', 'RDAM', 'OLAK5uy_')):
+                     if entity_type_for_api == "album":
                          analysis_url = f"https://music.youtube.com/browse/{album_browse_id}"
-                     elif entity_type_for_api == "playlist" or album_browse_id.startswith(('PL', 'VL')):
+                     elif entity_type_for_api == "playlist":
                          analysis_url = f"https://music.youtube.com/playlist?list={album_browse_id}"
                      # If it's a video ID, yt-dlp will treat it as a single item, which is fine, download_track will handle it.
                      # This function is more for albums/playlists.
@@ -1084,18 +1385,8 @@ async def download_album_tracks(album_browse_id: str, progress_callback=None) ->
                           logger.warning(f"ID '{album_browse_id}' type still unknown, trying browse URL for yt-dlp analysis.")
 
 
-                 # yt-dlp options for extracting playlist/album info without downloading
-                 analysis_opts = {
-                     'extract_flat': 'in_playlist', # Get info for each item in playlist/album
-                     'skip_download': True,
-                     'quiet': True,
-                     'ignoreerrors': True, # Skip problematic tracks
-                     'noplaylist': False, # We *want* playlist/album items
-                     'cookiefile': YDL_OPTS.get('cookiefile') # Use cookies if available
-                 }
-                 loop = asyncio.get_running_loop()
-                 # Run synchronous yt-dlp call in an executor
-                 playlist_dict = await loop.run_in_executor(None, functools.partial(yt_dlp.YoutubeDL(analysis_opts).extract_info, analysis_url, download=False))
+                 # If the API told us how many tracks there are, yt-dlp can stop enumerating there
+                 playlist_dict = await _analyze_playlist(analysis_url, total_tracks or None)
 
                  if playlist_dict and playlist_dict.get('entries'):
                      # Convert yt-dlp entries to the structure expected by the download loop
@@ -1140,66 +1431,89 @@ async def download_album_tracks(album_browse_id: str, progress_callback=None) ->
 
         downloaded_count = 0
         loop = asyncio.get_running_loop() # Get current loop for run_in_executor
-
-        for i, track_api_info in enumerate(tracks_to_download):
+        concurrency = max(1, int(config.get("album_download_concurrency", 4) or 1))
+        download_semaphore = asyncio.Semaphore(concurrency) # Caps parallel yt-dlp/ffmpeg workers
+        callback_queue: asyncio.Queue = asyncio.Queue() # (status_key, kwargs) updates; None stops the consumer
+
+        def report(status_key: str, **kwargs_report):
+            """Queues a progress update without waiting for it (the callback may be a slow message edit)."""
+            if progress_callback: callback_queue.put_nowait((status_key, kwargs_report))
+
+        async def run_callbacks():
+            # Single consumer, so updates are still applied in the order they were reported
+            while True:
+                item = await callback_queue.get()
+                if item is None: return
+                try: await progress_callback(item[0], **item[1])
+                except Exception as e_callback: logger.warning(f"Album progress callback '{item[0]}' failed: {e_callback}")
+
+        async def download_one(i: int, track_api_info: Dict) -> Optional[Tuple[Dict, str]]:
+            nonlocal downloaded_count
             current_track_num = i + 1
             video_id = track_api_info.get('videoId')
             # Use title/artists from API info if available, otherwise use defaults
             track_title_from_list = track_api_info.get('title') or f'Трек {current_track_num}'
-            # 'artists' in API info is usually a list of dicts. format_artists handles it.
-            track_artists_from_list = format_artists(track_api_info.get('artists')) # format_artists returns "Неизвестно" if None/empty
 
             if not video_id:
                 logger.warning(f"Skipping track {current_track_num}/{total_tracks} ('{track_title_from_list}') due to missing videoId.")
-                if progress_callback:
-                     await progress_callback("track_failed", current=current_track_num, total=total_tracks, title=f"{track_title_from_list} (No ID)")
-                continue
+                report("track_failed", current=current_track_num, total=total_tracks, title=f"{track_title_from_list} (No ID)")
+                return None
 
             download_link = f"https://music.youtube.com/watch?v={video_id}"
 
-            if progress_callback:
-                 perc = int(((current_track_num) / total_tracks) * 100) if total_tracks else 0
-                 display_track_title = (track_title_from_list[:25] + '...') if len(track_title_from_list) > 28 else track_title_from_list
-                 await progress_callback("track_downloading",
-                                       current=current_track_num,
-                                       total=total_tracks,
-                                       percentage=perc,
-                                       title=display_track_title)
+            async with download_semaphore:
+                perc = int(((current_track_num) / total_tracks) * 100) if total_tracks else 0
+                display_track_title = (track_title_from_list[:25] + '...') if len(track_title_from_list) > 28 else track_title_from_list
+                report("track_downloading",
+                      current=current_track_num,
+                      total=total_tracks,
+                      percentage=perc,
+                      title=display_track_title)
 
-            try:
-                # download_track is synchronous, run in executor
-                # functools.partial helps pass arguments to the function run in executor
-                info_dict_from_dl, file_path_from_dl = await loop.run_in_executor(None, functools.partial(download_track, download_link))
-
-                if file_path_from_dl and info_dict_from_dl:
-                    actual_filename = os.path.basename(file_path_from_dl)
-                    # Use title from yt-dlp's more detailed info if available
-                    final_track_title = info_dict_from_dl.get('title', track_title_from_list)
-                    logger.info(f"Successfully downloaded and processed track {current_track_num}/{total_tracks}: {actual_filename}")
-                    downloaded_files.append((info_dict_from_dl, file_path_from_dl)) # Store detailed info from download
-                    downloaded_count += 1
-                    if progress_callback:
-                         # Pass the title from the detailed info_dict_from_dl
-                         await progress_callback("track_downloaded", current=downloaded_count, total=total_tracks, title=final_track_title)
-                else:
-                    logger.error(f"Failed to download/process track {current_track_num}/{total_tracks}: '{track_title_from_list}' ({video_id})")
-                    if progress_callback:
-                         await progress_callback("track_failed", current=current_track_num,
-                                               total=total_tracks, title=track_title_from_list, reason="Ошибка загрузки")
-
-            except Exception as e_track_dl:
-                logger.error(f"Error during download process for track {current_track_num} ('{track_title_from_list}'): {e_track_dl}", exc_info=True)
-                if progress_callback:
-                     await progress_callback("track_failed", current=current_track_num, total=total_tracks, title=f"{track_title_from_list} (Error)")
+                try:
+                    # download_track is synchronous, run in executor
+                    # functools.partial helps pass arguments to the function run in executor
+                    info_dict_from_dl, file_path_from_dl = await loop.run_in_executor(_YDL_POOL, functools.partial(download_track, download_link))
+                except Exception as e_track_dl:
+                    logger.error(f"Error during download process for track {current_track_num} ('{track_title_from_list}'): {e_track_dl}", exc_info=True)
+                    report("track_failed", current=current_track_num, total=total_tracks, title=f"{track_title_from_list} (Error)")
+                    return None
+
+            if file_path_from_dl and info_dict_from_dl:
+                actual_filename = os.path.basename(file_path_from_dl)
+                # Use title from yt-dlp's more detailed info if available
+                final_track_title = info_dict_from_dl.get('title', track_title_from_list)
+                logger.info(f"Successfully downloaded and processed track {current_track_num}/{total_tracks}: {actual_filename}")
+                downloaded_count += 1 # No await between the increment and the report, so counts stay in order
+                # Pass the title from the detailed info_dict_from_dl
+                report("track_downloaded", current=downloaded_count, total=total_tracks, title=final_track_title)
+                return info_dict_from_dl, file_path_from_dl # Store detailed info from download
+
+            logger.error(f"Failed to download/process track {current_track_num}/{total_tracks}: '{track_title_from_list}' ({video_id})")
+            report("track_failed", current=current_track_num,
+                   total=total_tracks, title=track_title_from_list, reason="Ошибка загрузки")
+            return None
 
-            await asyncio.sleep(0.3) # Small delay between downloads
+        # All tracks are submitted at once, the semaphore (not a fixed sleep) throttles them; results keep album order
+        callback_task = asyncio.create_task(run_callbacks()) if progress_callback else None
+        try:
+            results = await asyncio.gather(*(download_one(i, t) for i, t in enumerate(tracks_to_download)), return_exceptions=True)
+        finally:
+            if callback_task: # Let queued updates finish so none are lost before the caller moves on
+                callback_queue.put_nowait(None)
+                await callback_task
+        for result in results:
+            if isinstance(result, BaseException):
+                logger.error(f"Unexpected error in album track worker for {album_browse_id}: {result}")
+            elif result:
+                downloaded_files.append(result)
 
     except Exception as e_album_outer:
         logger.error(f"Error during album processing loop for {album_browse_id}: {e_album_outer}", exc_info=True)
         if progress_callback:
             await progress_callback("album_error", error=f"Outer error: {str(e_album_outer)[:50]}")
 
-    logger.info(f"Finished sequential album download for '{album_title or album_browse_id}'. Successfully saved {len(downloaded_files)} out of {total_tracks or 'Unknown'} tracks attempted.")
+    logger.info(f"Finished album download for '{album_title or album_browse_id}'. Successfully saved {len(downloaded_files)} out of {total_tracks or 'Unknown'} tracks attempted.")
     return downloaded_files
 
 
@@ -1214,6 +1528,64 @@ async def download_album_tracks(album_browse_id: str, progress_callback=None) ->
 #                           THUMBNAIL HANDLING
 # =============================================================================
 
+# Shared HTTP session: keeps TCP/TLS connections to the thumbnail hosts (i.ytimg.com, lh3.googleusercontent.com) alive between downloads
+HTTP_SESSION = requests.Session()
+_http_adapter = requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=64) # No adapter-level retries, @retry handles those
+HTTP_SESSION.mount('https://', _http_adapter)
+HTTP_SESSION.mount('http://', _http_adapter)
+# Async counterpart, created in main() when aiohttp is available (needs a running loop)
+AIOHTTP_SESSION: Optional['aiohttp.ClientSession'] = None
+_AIOHTTP_ERRORS: Tuple[Type[BaseException], ...] = (aiohttp.ClientError, asyncio.TimeoutError) if _HAS_AIOHTTP else ()
+
+_UNSAFE_THUMB_NAME_RE = re.compile(r'[^\w.\-]')
+
+def _thumbnail_name_parts(url: str) -> Tuple[str, str]:
+    """Derives a filesystem-safe base name and a simple extension (default '.jpg') for a thumbnail from its URL."""
+    try:
+        parsed_url = urlparse(url)
+        base_name_from_url = os.path.basename(parsed_url.path) if parsed_url.path else "thumb"
+    except Exception as parse_e:
+        logger.warning(f"Could not parse URL path for thumbnail naming: {parse_e}. Using default 'thumb'.")
+        base_name_from_url = "thumb"
+
+    base_name, potential_ext = os.path.splitext(base_name_from_url)
+    # Ensure extension is simple (e.g., .jpg, .png, .webp)
+    if potential_ext and 1 < len(potential_ext) <= 5 and potential_ext[1:].isalnum(): # [1:] to skip dot
+         ext = potential_ext.lower()
+    else: ext = '.jpg' # Default extension
+
+    if not base_name or base_name == potential_ext: base_name = "thumb" # Handle cases like ".jpg" as basename
+    # Sanitize base_name for filesystem
+    safe_base_name = _UNSAFE_THUMB_NAME_RE.sub('_', base_name)
+    max_len = 40 # Limit length of base name part
+    safe_base_name = (safe_base_name[:max_len] + '...') if len(safe_base_name) > max_len + 3 else safe_base_name
+    return safe_base_name, ext
+
+
+MAX_CONCURRENT_THUMBNAIL_FETCHES = 8 # Keeps bursts (e.g. album sends) from tying up every executor thread / pooled connection
+_thumb_fetch_semaphore: Optional[asyncio.Semaphore] = None # Created on first use, inside the running loop
+
+def _get_thumb_fetch_semaphore() -> asyncio.Semaphore:
+    global _thumb_fetch_semaphore
+    if _thumb_fetch_semaphore is None: _thumb_fetch_semaphore = asyncio.Semaphore(MAX_CONCURRENT_THUMBNAIL_FETCHES)
+    return _thumb_fetch_semaphore
+
+async def fetch_thumbnail_bytes(url: str) -> bytes:
+    """Fetches an image into memory: on the event loop via aiohttp when available, else via the shared requests session in a thread."""
+    async with _get_thumb_fetch_semaphore():
+        if AIOHTTP_SESSION is not None and not AIOHTTP_SESSION.closed:
+            async with AIOHTTP_SESSION.get(url, timeout=aiohttp.ClientTimeout(total=25)) as aio_response:
+                aio_response.raise_for_status()
+                return await aio_response.read()
+        # Run the GET in an executor as it's a blocking I/O call
+        response = await asyncio.get_running_loop().run_in_executor(None, lambda: HTTP_SESSION.get(url, timeout=25))
+        try:
+            response.raise_for_status() # Check for HTTP errors
+            return response.content
+        finally:
+            response.close()
+
+
 @retry(max_tries=3, delay=1.0, exceptions=(requests.exceptions.RequestException, Exception))
 async def download_thumbnail(url: str, output_dir: str = SCRIPT_DIR) -> Optional[str]:
     """
@@ -1226,58 +1598,31 @@ async def download_thumbnail(url: str, output_dir: str = SCRIPT_DIR) -> Optional
 
     logger.debug(f"Attempting to download thumbnail: {url}")
     temp_file_path = None
-    response = None # Initialize response to None
 
     try:
-        try:
-            parsed_url = urlparse(url)
-            base_name_from_url = os.path.basename(parsed_url.path) if parsed_url.path else "thumb"
-        except Exception as parse_e:
-            logger.warning(f"Could not parse URL path for thumbnail naming: {parse_e}. Using default 'thumb'.")
-            base_name_from_url = "thumb"
-
-        base_name, potential_ext = os.path.splitext(base_name_from_url)
-        # Ensure extension is simple (e.g., .jpg, .png, .webp)
-        if potential_ext and 1 < len(potential_ext) <= 5 and potential_ext[1:].isalnum(): # [1:] to skip dot
-             ext = potential_ext.lower()
-        else: ext = '.jpg' # Default extension
-
-        if not base_name or base_name == potential_ext: base_name = "thumb" # Handle cases like ".jpg" as basename
-        # Sanitize base_name for filesystem
-        safe_base_name = re.sub(r'[^\w.\-]', '_', base_name)
-        max_len = 40 # Limit length of base name part
-        safe_base_name = (safe_base_name[:max_len] + '...') if len(safe_base_name) > max_len + 3 else safe_base_name
-
-        timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
-        temp_filename = f"temp_thumb_{safe_base_name}_{timestamp}{ext}"
-        temp_file_path = os.path.join(output_dir, temp_filename)
+        base_name, ext = _thumbnail_name_parts(url)
+        temp_file_path = os.path.join(output_dir, f"temp_thumb_{base_name}_{unique_file_suffix()}{ext}")
 
         loop = asyncio.get_running_loop()
-        # Run requests.get in an executor as it's a blocking I/O call
-        response = await loop.run_in_executor(None, lambda: requests.get(url, stream=True, timeout=25))
-        response.raise_for_status() # Check for HTTP errors
+        # The body is kept in memory (thumbnails are small): verified there, then written to disk once
+        thumb_bytes = await fetch_thumbnail_bytes(url)
 
-        # Save the content to file (also blocking I/O)
-        await loop.run_in_executor(None, functools.partial(save_response_to_file, response, temp_file_path))
-
-        logger.debug(f"Thumbnail downloaded to temporary file: {temp_file_path}")
-
-        # Verify image integrity (Pillow operations are blocking)
+        # Verify image integrity before anything touches the disk (Pillow operations are blocking)
         try:
-            await loop.run_in_executor(None, functools.partial(verify_image_file, temp_file_path))
-            logger.debug(f"Thumbnail verified as valid image: {temp_file_path}")
+            await loop.run_in_executor(None, functools.partial(save_verified_image, thumb_bytes, temp_file_path, url.startswith(_TRUSTED_THUMB_URL_PREFIXES)))
+            logger.debug(f"Thumbnail verified and saved to temporary file: {temp_file_path}")
             return temp_file_path
-        except (FileNotFoundError, UnidentifiedImageError, SyntaxError, OSError, ValueError) as img_e:
-             logger.error(f"Downloaded file is not a valid image ({url}): {img_e}. Deleting.")
-             if os.path.exists(temp_file_path):
-                 try: asyncio.create_task(cleanup_files(temp_file_path)) # Schedule cleanup
-                 except Exception as rm_e: logger.warning(f"Could not remove invalid temp thumb {temp_file_path}: {rm_e}")
-             return None # Return None if image is invalid
+        except (UnidentifiedImageError, SyntaxError, OSError, ValueError) as img_e: # OSError: truncated/broken image data (or a failed write)
+             logger.error(f"Downloaded file is not a valid image ({url}): {img_e}. Discarding.")
+             if os.path.exists(temp_file_path): # Only a failed write can leave a partial file behind
+                 try: asyncio.create_task(cleanup_files(temp_file_path))
+                 except Exception as rm_e: logger.warning(f"Could not remove partial temp thumb {temp_file_path}: {rm_e}")
+             return None
 
     except requests.exceptions.Timeout:
         logger.error(f"Timeout occurred while downloading thumbnail: {url}")
         raise # Re-raise to be caught by @retry or caller
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, *_AIOHTTP_ERRORS) as e:
         logger.error(f"Network error downloading thumbnail {url}: {e}")
         if temp_file_path and os.path.exists(temp_file_path): # Cleanup partially downloaded file
             try: asyncio.create_task(cleanup_files(temp_file_path))
@@ -1289,100 +1634,169 @@ async def download_thumbnail(url: str, output_dir: str = SCRIPT_DIR) -> Optional
             try: asyncio.create_task(cleanup_files(temp_file_path))
             except Exception as rm_e: logger.warning(f"Could not remove temp thumb {temp_file_path} after error: {rm_e}")
         raise # Re-raise
-    finally:
-        if response: # Ensure response is closed
-            try: response.close()
-            except Exception as close_e: logger.warning(f"Error closing response for {url}: {close_e}")
 
 
-def save_response_to_file(response: requests.Response, filepath: str):
-    """Synchronously saves a requests response stream to a file."""
+def save_bytes_to_file(data: bytes, filepath: str):
+    """Synchronously writes an already downloaded payload to a file."""
     with open(filepath, 'wb') as out_file:
-        shutil.copyfileobj(response.raw, out_file)
+        out_file.write(data)
+
 
+# Google image CDNs the thumbnails come from: their payloads only get a magic-bytes check instead of a Pillow verify()
+_TRUSTED_THUMB_URL_PREFIXES = ('https://i.ytimg.com/', 'https://lh3.googleusercontent.com/', 'https://yt3.ggpht.com/')
+_IMAGE_MAGIC_PREFIXES = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n') # JPEG, PNG
 
-def verify_image_file(filepath: str):
-    """Synchronously verifies if a file is a valid image."""
-    with Image.open(filepath) as img:
-        img.verify() # verify() is a basic check, might raise on corrupt images
+def _has_image_magic(data: bytes) -> bool:
+    """Checks the file signature for JPEG, PNG or WebP (RIFF....WEBP)."""
+    return data.startswith(_IMAGE_MAGIC_PREFIXES) or (data[:4] == b'RIFF' and data[8:12] == b'WEBP')
 
 
-@retry(max_tries=2, delay=1.0, exceptions=(UnidentifiedImageError, OSError, ValueError, Exception))
-async def crop_thumbnail(image_path: str) -> Optional[str]:
+def save_verified_image(data: bytes, filepath: str, trusted_source: bool = False):
     """
-    Crops an image to a square aspect ratio (center crop) and saves it as JPEG.
-    This is an async function designed to run directly with await.
+    Synchronously verifies that an in-memory payload is a valid image, then writes it to a file.
+    Payloads from a trusted source that carry a known image signature skip the Pillow parse.
+    """
+    if not (trusted_source and _has_image_magic(data)):
+        with Image.open(BytesIO(data)) as img:
+            img.verify() # verify() is a basic check, might raise on corrupt images
+    save_bytes_to_file(data, filepath)
+
+
+def save_square_jpeg(img: Image.Image, output_path: str):
+    """Synchronously center-crops an image to a square and saves it as JPEG (transparency is flattened onto white)."""
+    img_rgb = img
+    if img.mode != 'RGB':
+        logger.debug(f"Image mode is '{img.mode}', converting to RGB for cropping.")
+        try:
+            if img.mode == 'P' and 'transparency' in img.info:
+                img = img.convert('RGBA') # Palette transparency becomes a real alpha band
+            if img.mode in ('RGBA', 'LA', 'PA'):
+                # Create a white background for transparency handling, pasted through the alpha band only (getchannel, not split())
+                bg = Image.new("RGB", img.size, (255, 255, 255))
+                bg.paste(img, mask=img.getchannel('A'))
+                img_rgb = bg
+            else: # No alpha (P, L, CMYK, ...): a plain conversion, no background image needed
+                img_rgb = img.convert('RGB')
+        except Exception as conv_e:
+            logger.warning(f"Could not convert image from {img.mode} to RGB using background paste: {conv_e}. Attempting basic conversion.")
+            img_rgb = img.convert('RGB')
+
+    width, height = img_rgb.size
+    min_dim = min(width, height)
+    left = (width - min_dim) / 2
+    top = (height - min_dim) / 2
+    right = (width + min_dim) / 2
+    bottom = (height + min_dim) / 2
+    crop_box = tuple(map(int, (left, top, right, bottom))) # Ensure integer coordinates
+    # Baseline 4:2:0 JPEG, single-pass Huffman coding: the cheapest encode at this quality
+    img_rgb.crop(crop_box).save(output_path, "JPEG", quality=90, subsampling=2, optimize=False, progressive=False)
+
+
+def crop_image_bytes(data: bytes, output_path: str):
+    """Synchronously decodes an in-memory image once and writes its square JPEG crop (decoding doubles as validation)."""
+    if _HAS_PYVIPS:
+        try:
+            header = pyvips.Image.new_from_buffer(data, "") # Only parses the header, pixels are decoded lazily
+            side = min(header.width, header.height) # Same square as the Pillow path, no resizing
+            img = pyvips.Image.thumbnail_buffer(data, side, height=side, crop='centre')
+            if img.hasalpha(): img = img.flatten(background=255) # White background for transparency, like the Pillow path
+            img.write_to_file(output_path, Q=90)
+            return
+        except pyvips.Error as vips_e:
+            logger.debug(f"pyvips could not crop thumbnail ({vips_e}), falling back to Pillow.")
+    with Image.open(BytesIO(data)) as img:
+        save_square_jpeg(img, output_path)
+
+
+# On-disk cache of cropped thumbnails keyed by URL hash, so repeat tracks skip both the download and the crop.
+# Entries are hard-linked out to working copies, so the usual cleanup of those never touches the cache.
+THUMB_CACHE_DIR = os.path.join(SCRIPT_DIR, '.thumb_cache')
+THUMB_CACHE_MAX_ENTRIES = 200
+
+def _thumb_cache_path(url: str) -> str:
+    return os.path.join(THUMB_CACHE_DIR, hashlib.blake2b(url.encode(), digest_size=16).hexdigest() + '.jpg')
+
+def _link_or_copy(src: str, dst: str):
+    """Hard-links src to a new path dst, copying if the filesystem has no hard links. Never writes over an existing dst."""
+    try: os.link(src, dst)
+    except FileExistsError: raise # copyfile would rewrite dst in place, and with it every file hard-linked to it
+    except OSError: shutil.copyfile(src, dst) # No hard links on this filesystem
+
+def thumb_cache_fetch(url: str, output_path: str) -> bool:
+    """Synchronously places a cached crop of `url` at output_path. Returns False on a cache miss."""
+    cached_path = _thumb_cache_path(url)
+    if not os.path.isfile(cached_path): return False
+    try:
+        _link_or_copy(cached_path, output_path)
+        os.utime(cached_path) # mtime doubles as last-used time for eviction
+        return True
+    except OSError as e:
+        logger.warning(f"Could not use cached thumbnail {cached_path}: {e}")
+        return False
+
+def thumb_cache_store(url: str, output_path: str):
+    """Synchronously adds a freshly cropped thumbnail to the cache, evicting the least recently used entries."""
+    try:
+        os.makedirs(THUMB_CACHE_DIR, exist_ok=True)
+        cached_path = _thumb_cache_path(url)
+        if not os.path.exists(cached_path):
+            # Staged under a unique name and renamed into place: a concurrent store of the same URL only swaps the
+            # directory entry, never rewrites a cached file that is already hard-linked to a working copy
+            staging_path = f"{cached_path}.{unique_file_suffix()}.tmp"
+            try:
+                _link_or_copy(output_path, staging_path)
+                os.replace(staging_path, cached_path)
+            finally:
+                if os.path.exists(staging_path): os.remove(staging_path)
+        with os.scandir(THUMB_CACHE_DIR) as it:
+            entries = [(e.stat().st_mtime, e.path) for e in it if e.name.endswith('.jpg') and e.is_file()] # Skips in-flight .tmp files
+        if len(entries) > THUMB_CACHE_MAX_ENTRIES:
+            for _, stale_path in sorted(entries)[:len(entries) - THUMB_CACHE_MAX_ENTRIES]:
+                os.remove(stale_path)
+    except OSError as e:
+        logger.warning(f"Could not update thumbnail cache for {url}: {e}")
+
+
+@retry(max_tries=3, delay=1.0, exceptions=(requests.exceptions.RequestException, Exception))
+async def fetch_and_crop_thumbnail(url: str, output_dir: str = SCRIPT_DIR) -> Optional[str]:
+    """
+    Downloads a thumbnail and saves it cropped to a square JPEG in a single pass:
+    the image is decoded once from memory and the uncropped original never touches the disk.
     """
-    if not image_path or not os.path.exists(image_path):
-        logger.error(f"Cannot crop thumbnail, file not found: {image_path}")
+    if not url or not isinstance(url, str) or not url.startswith(('http://', 'https://')):
+        logger.warning(f"Invalid or non-HTTP/S thumbnail URL provided: {url}")
         return None
 
-    logger.debug(f"Processing thumbnail (cropping to square): {image_path}")
-    # Ensure output path is unique enough to avoid clashes if original name is short
-    base, ext = os.path.splitext(image_path)
-    output_path = f"{base}_cropped_{datetime.datetime.now().strftime('%f')}.jpg" # Add microsecs for uniqueness
-    img_rgb = None # Initialize to avoid UnboundLocalError
+    logger.debug(f"Attempting to download and crop thumbnail: {url}")
+    base_name, _ = _thumbnail_name_parts(url)
+    output_path = os.path.join(output_dir, f"temp_thumb_{base_name}_{unique_file_suffix()}_cropped.jpg")
 
     loop = asyncio.get_running_loop()
-
     try:
-        # Image.open is blocking
-        img = await loop.run_in_executor(None, Image.open, image_path)
-
-        # All Pillow operations are blocking, run in executor
-        try:
-            img_rgb = img
-            if img.mode != 'RGB':
-                logger.debug(f"Image mode is '{img.mode}', converting to RGB for cropping.")
-                try:
-                    # Create a white background for transparency handling
-                    bg = await loop.run_in_executor(None, Image.new, "RGB", img.size, (255, 255, 255))
-                    if img.mode in ('RGBA', 'LA') and len(img.split()) > 3: # Check if alpha channel exists
-                        bands = await loop.run_in_executor(None, img.split)
-                        alpha_band = bands[-1]
-                        # Paste using alpha band as mask
-                        await loop.run_in_executor(None, functools.partial(bg.paste, img, mask=alpha_band))
-                    else: # No alpha or not RGBA/LA, simple paste
-                        await loop.run_in_executor(None, functools.partial(bg.paste, img))
-                    img_rgb = bg
-                except Exception as conv_e:
-                     logger.warning(f"Could not convert image {os.path.basename(image_path)} from {img.mode} to RGB using background paste: {conv_e}. Attempting basic conversion.")
-                     try: img_rgb = await loop.run_in_executor(None, functools.partial(img.convert, 'RGB'))
-                     except Exception as basic_conv_e:
-                         logger.error(f"Failed basic RGB conversion for {os.path.basename(image_path)}: {basic_conv_e}. Cannot crop.")
-                         return None # Cannot proceed if RGB conversion fails
-
-            width, height = img_rgb.size
-            min_dim = min(width, height)
-            left = (width - min_dim) / 2
-            top = (height - min_dim) / 2
-            right = (width + min_dim) / 2
-            bottom = (height + min_dim) / 2
-            crop_box = tuple(map(int, (left, top, right, bottom))) # Ensure integer coordinates
-            img_cropped = await loop.run_in_executor(None, functools.partial(img_rgb.crop, crop_box))
-
-            # Save the cropped image
-            await loop.run_in_executor(None, functools.partial(img_cropped.save, output_path, "JPEG", quality=90))
-
-            logger.debug(f"Thumbnail cropped and saved successfully: {output_path}")
+        if await loop.run_in_executor(None, thumb_cache_fetch, url, output_path):
+            logger.debug(f"Thumbnail cache hit for {url}: {output_path}")
             return output_path
 
-        except (UnidentifiedImageError, SyntaxError, OSError, ValueError) as e: # Pillow specific errors
-            logger.error(f"Cannot process thumbnail, invalid image file format or processing error during Pillow ops: {image_path} - {e}")
-            raise # Re-raise for @retry or caller
-        except Exception as e: # Other unexpected errors during Pillow ops
-            logger.error(f"Unexpected error during Pillow operations on thumbnail {os.path.basename(image_path)}: {e}", exc_info=True)
-            if os.path.exists(output_path): # Cleanup partially created file
+        thumb_bytes = await fetch_thumbnail_bytes(url)
+        try:
+            # All Pillow operations are blocking: decode, convert, crop and encode in one executor call
+            await loop.run_in_executor(None, functools.partial(crop_image_bytes, thumb_bytes, output_path))
+        except (UnidentifiedImageError, SyntaxError, OSError, ValueError) as img_e: # OSError: truncated/broken image data
+            logger.error(f"Downloaded thumbnail is not a valid image ({url}): {img_e}. Discarding.")
+            if os.path.exists(output_path):
                 try: asyncio.create_task(cleanup_files(output_path))
                 except Exception as rm_e: logger.warning(f"Could not remove partial cropped thumb {output_path}: {rm_e}")
-            raise # Re-raise
+            return None
+        logger.debug(f"Thumbnail cropped and saved successfully: {output_path}")
+        await loop.run_in_executor(None, thumb_cache_store, url, output_path)
+        return output_path
 
-    except FileNotFoundError: # If Image.open fails because file disappeared
-        logger.error(f"Cannot process thumbnail, file not found during Pillow ops: {image_path}")
-        raise # Re-raise
-    except Exception as e: # Catch-all for other errors in this block
-        logger.error(f"Error processing (cropping) thumbnail {os.path.basename(image_path)} (outer block): {e}", exc_info=True)
-        if os.path.exists(output_path): # Cleanup on outer error
+    except (requests.exceptions.RequestException, *_AIOHTTP_ERRORS) as e:
+        logger.error(f"Network error downloading thumbnail {url}: {e}")
+        raise # Re-raise to be caught by @retry or caller
+    except Exception as e_outer:
+        logger.error(f"Error downloading/cropping thumbnail {url}: {e_outer}", exc_info=True)
+        if os.path.exists(output_path): # Cleanup partially created file
             try: asyncio.create_task(cleanup_files(output_path))
             except Exception as rm_e: logger.warning(f"Could not remove partial cropped thumb {output_path}: {rm_e}")
         raise # Re-raise
@@ -1392,22 +1806,14 @@ async def crop_thumbnail(image_path: str) -> Optional[str]:
 #                         FILE CLEANUP UTILITY
 # =============================================================================
 
-async def cleanup_files(*files: Optional[str]):
-    """
-    Safely removes specified files and files matching common temporary patterns.
-    Ensures files are within SCRIPT_DIR.
-    """
-    temp_patterns = [
-        os.path.join(SCRIPT_DIR, "temp_thumb_*"),    # Downloaded original thumbnails
-        os.path.join(SCRIPT_DIR, "*_cropped_*.jpg"), # Cropped thumbnails (format from crop_thumbnail)
-        os.path.join(SCRIPT_DIR, "*.part"),          # yt-dlp partial files
-        os.path.join(SCRIPT_DIR, "*.ytdl"),          # yt-dlp temporary files
-        os.path.join(SCRIPT_DIR, "*.webp"),          # Common temp image format from web
-        os.path.join(SCRIPT_DIR, "lyrics_*.html"),   # Lyrics HTML files
-        os.path.join(SCRIPT_DIR, "N_A.jpg"),         # Placeholder thumbnails sometimes created
-        os.path.join(SCRIPT_DIR, "N_A.png"),
-    ]
+# Temporary files swept by every cleanup, matched in one directory pass (dotfiles never match, as with glob):
+# downloaded thumbnails (original or cropped), cropped thumbnails (older naming), yt-dlp partial/temp files,
+# common temp image format from web, lyrics HTML files (older versions), placeholder thumbnails sometimes created
+_CLEANUP_RE = re.compile(r'(?!\.)(?:temp_thumb_.*|.*_cropped_.*\.jpg|.*\.part|.*\.ytdl|.*\.webp|lyrics_.*\.html|N_A\.jpg|N_A\.png)', re.DOTALL)
 
+def _cleanup_files_sync(files: Tuple[Optional[str], ...]) -> Tuple[int, int]:
+    """Blocking part of cleanup_files. Returns (removed, candidates)."""
+    script_abs_path = os.path.abspath(SCRIPT_DIR) # Cache for comparison
     all_files_to_remove = set()
     # Add explicitly passed files first, ensuring they are in SCRIPT_DIR
     for f_path in files:
@@ -1416,71 +1822,79 @@ async def cleanup_files(*files: Optional[str]):
                 # Resolve to absolute path to prevent relative path issues (e.g., "temp_thumb_123.jpg")
                 abs_f_path = os.path.abspath(f_path)
                 # Ensure the file is within the SCRIPT_DIR for safety
-                if abs_f_path.startswith(os.path.abspath(SCRIPT_DIR)):
+                if abs_f_path.startswith(script_abs_path):
                      all_files_to_remove.add(abs_f_path)
                 else:
                      logger.warning(f"Skipping cleanup of file outside script directory: {f_path} (resolved: {abs_f_path})")
             except Exception as path_e:
                  logger.warning(f"Could not process path for file '{f_path}' during cleanup prep: {path_e}")
 
+    # Add temp files from a single scan of SCRIPT_DIR (non-recursive, like the patterns always were)
+    try:
+        with os.scandir(script_abs_path) as it:
+            for entry in it:
+                if _CLEANUP_RE.fullmatch(entry.name) and entry.is_file():
+                    all_files_to_remove.add(entry.path)
+    except OSError as e:
+        logger.error(f"Error scanning '{script_abs_path}' for temporary files: {e}")
 
-    # Add files matching glob patterns
-    loop = asyncio.get_running_loop()
-    script_abs_path = os.path.abspath(SCRIPT_DIR) # Cache for comparison
-
-    for pattern in temp_patterns:
-        try:
-            # Ensure pattern is absolute for glob and starts within SCRIPT_DIR
-            abs_pattern = os.path.abspath(pattern)
-            if not abs_pattern.startswith(script_abs_path):
-                logger.warning(f"Skipping glob pattern outside script directory: {pattern}")
-                continue
-
-            matched_files = await loop.run_in_executor(None, glob.glob, abs_pattern)
-            if matched_files:
-                logger.debug(f"Globbed {len(matched_files)} files for cleanup pattern: {pattern}")
-                for mf in matched_files:
-                    abs_mf = os.path.abspath(mf)
-                    if abs_mf.startswith(script_abs_path): # Double check resolved path
-                        all_files_to_remove.add(abs_mf)
-                    # else: (should not happen if abs_pattern was checked)
-        except Exception as e:
-            logger.error(f"Error during glob matching for pattern '{pattern}': {e}")
-
-    removed_count = 0
     if not all_files_to_remove:
-        logger.debug("Cleanup called, but no files specified or matched for removal.")
-        return
+        return 0, 0
 
     logger.info(f"Attempting to clean up {len(all_files_to_remove)} potential files...")
-    files_list = list(all_files_to_remove) # Convert set to list for iteration
-
-    # Perform deletions (os.remove is blocking)
-    for file_path_to_remove in files_list:
+    removed_count = 0
+    for file_path_to_remove in all_files_to_remove:
         try:
-            if await loop.run_in_executor(None, os.path.isfile, file_path_to_remove): # Check if it's a file
-                 await loop.run_in_executor(None, os.remove, file_path_to_remove)
-                 logger.debug(f"Removed file: {file_path_to_remove}")
-                 removed_count += 1
-                 await asyncio.sleep(0.01) # Tiny sleep to yield if many files
+            os.remove(file_path_to_remove)
+            logger.debug(f"Removed file: {file_path_to_remove}")
+            removed_count += 1
         except FileNotFoundError:
              logger.debug(f"File not found for removal (already deleted?): {file_path_to_remove}")
-        except OSError as e: # Catch permission errors etc.
+        except OSError as e: # Catch permission errors, directories etc.
             logger.error(f"Error removing file {file_path_to_remove}: {e}")
         except Exception as e_remove: # Catch other unexpected errors
             logger.error(f"Unexpected error removing file {file_path_to_remove}: {e_remove}")
+    return removed_count, len(all_files_to_remove)
+
+
+async def cleanup_files(*files: Optional[str]):
+    """
+    Safely removes specified files and files matching common temporary patterns.
+    Ensures files are within SCRIPT_DIR. The scan and the deletions run in a worker thread.
+    """
+    removed_count, candidate_count = await asyncio.to_thread(_cleanup_files_sync, files)
 
     if removed_count > 0:
         logger.info(f"Successfully cleaned up {removed_count} files.")
-    elif all_files_to_remove: # If there were files to remove but none were
-        logger.info(f"Cleanup finished. No files were actually removed (checked {len(all_files_to_remove)}).")
+    elif candidate_count: # If there were files to remove but none were
+        logger.info(f"Cleanup finished. No files were actually removed (checked {candidate_count}).")
+    else:
+        logger.debug("Cleanup called, but no files specified or matched for removal.")
 
 
 # =============================================================================
 #                         TELEGRAM MESSAGE UTILITIES
 # =============================================================================
 
-previous_bot_messages: Dict[int, List[types.Message]] = {}
+# chat_id -> {message_id: message}; keyed by ID for O(1) de-duplication, dict order keeps the send order
+previous_bot_messages: Dict[int, Dict[int, types.Message]] = {}
+
+# Status icons replaced in a single pass when a command fails
+_ERROR_ICON_RE = re.compile('|'.join(map(re.escape, ["🔄", "✅", "⏳", "⏸️"])))
+# Download statuses also carry per-track icons; these are marked as stopped rather than failed
+_STOPPED_ICON_RE = re.compile('|'.join(map(re.escape, ["🔄", "✅", "⏳", "▶️", "📥", "📤", "✔️", "⏸️"])))
+
+def to_error_status(status) -> str:
+    """Marks in-progress/pending/done icons in a status string as failed (❌)."""
+    return _ERROR_ICON_RE.sub("❌", str(status))
+
+def to_stopped_status(status) -> str:
+    """Marks in-progress/pending/done icons in a status string as stopped (⏹️)."""
+    return _STOPPED_ICON_RE.sub("⏹️", str(status))
+
+def render_statuses(statuses: Dict[str, str]) -> str:
+    """Renders a statuses dict as 'task: status' lines for a progress message."""
+    return "\n".join(f"{task}: {status}" for task, status in statuses.items())
 
 async def update_progress(progress_message: Optional[types.Message], statuses: Dict[str, str]):
     """
@@ -1489,7 +1903,7 @@ async def update_progress(progress_message: Optional[types.Message], statuses: D
     if not progress_message or not isinstance(progress_message, types.Message):
         return
 
-    text = "\n".join(f"{task}: {status}" for task, status in statuses.items())
+    text = render_statuses(statuses)
 
     try:
         current_text = getattr(progress_message, 'text', None)
@@ -1505,6 +1919,133 @@ async def update_progress(progress_message: Optional[types.Message], statuses: D
     except Exception as e:
         logger.warning(f"Failed to update progress message {progress_message.id}: {type(e).__name__} - {e}")
 
+class ProgressCoalescer:
+    """
+    Batches status updates for a progress message: changes made via set() within
+    a short window are applied with a single edit instead of one edit per change.
+    Without a progress message (progress_messages off) it is a no-op, so callers need no guards.
+    """
+    def __init__(self, progress_message: Optional[types.Message], statuses: Dict[str, str], window: float = 0.25):
+        self.progress_message = progress_message
+        self.statuses = statuses
+        self.window = window
+        self._dirty = asyncio.Event()
+        self._lock = asyncio.Lock() # Prevents flush() and the background task from editing at the same time
+        self._task = asyncio.create_task(self._run()) if progress_message else None
+
+    def set(self, task: str, status: str):
+        """Updates a status and schedules an edit for the current window."""
+        if not self.progress_message or self.statuses.get(task) == status: # Nothing to show, or no change to wake the task for
+            return
+        self.statuses[task] = status
+        self.touch()
+
+    def touch(self):
+        """Schedules an edit for statuses that were changed directly in the shared dict."""
+        if self._task:
+            self._dirty.set()
+
+    async def _run(self):
+        try:
+            while True:
+                await self._dirty.wait()
+                await asyncio.sleep(self.window) # Collect further updates before editing
+                self._dirty.clear()
+                async with self._lock:
+                    await update_progress(self.progress_message, self.statuses)
+        except asyncio.CancelledError:
+            pass
+
+    async def flush(self):
+        """Applies pending updates immediately (e.g. before a final status is shown for a while)."""
+        if not self.progress_message:
+            return
+        self._dirty.clear()
+        async with self._lock:
+            await update_progress(self.progress_message, self.statuses)
+
+    async def close(self):
+        """Stops the background task without applying pending updates."""
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+class RateLimiter:
+    """
+    Spaces actions at least `interval` seconds apart. Unlike a fixed sleep after each
+    action, it only waits for the part of the interval the previous action hasn't already used up.
+    """
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next_slot = 0.0
+
+    async def wait(self):
+        """Reserves the next free slot and sleeps until it comes (returns at once if it already has)."""
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.interval # Reserved before sleeping, so concurrent callers queue up in order
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+# Paces album track uploads (Telegram flood limits); a slow upload already counts towards the gap
+ALBUM_SEND_LIMITER = RateLimiter(0.7)
+
+# Strong references to fire-and-forget tasks (the event loop only keeps weak ones); cancelled on shutdown
+_background_tasks: Set[asyncio.Task] = set()
+
+def schedule_delete(message: Optional[types.Message], delay: float = 7.0):
+    """Deletes a message after `delay` seconds in the background, so the caller doesn't wait for it."""
+    if not message or not isinstance(message, types.Message):
+        return
+
+    async def _delete_later():
+        await asyncio.sleep(delay)
+        try:
+            await message.delete()
+        except Exception as e_del: # Already deleted by user/Telegram, etc.
+            logger.debug(f"Scheduled deletion of message {getattr(message, 'id', 'N/A')} failed: {e_del}")
+
+    task = asyncio.create_task(_delete_later())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+async def start_progress(event: events.NewMessage.Event, statuses: Dict[str, str]) -> types.Message:
+    """Sends the initial progress message for a command and stores it for auto-clear."""
+    progress_message = await event.reply(render_statuses(statuses))
+    await store_response_message(event.chat_id, progress_message)
+    return progress_message
+
+async def show_progress_error(event: events.NewMessage.Event, progress_message: Optional[types.Message], statuses: Dict[str, str], error_text: str) -> Optional[types.Message]:
+    """
+    Marks unfinished statuses as failed and appends error_text to the progress message.
+    Falls back to a new reply if there is no progress message or it can't be edited.
+    Returns the message that carries the error.
+    """
+    if not progress_message:
+        return await event.reply(error_text)
+    for task_key in statuses: statuses[task_key] = to_error_status(statuses[task_key])
+    try: await update_progress(progress_message, statuses)
+    except Exception: pass
+    try:
+        await progress_message.edit(f"{getattr(progress_message, 'text', '')}\n\n{error_text}")
+        return progress_message
+    except Exception:
+        return await event.reply(error_text)
+
+async def finish_progress(event: events.NewMessage.Event, progress_message: Optional[types.Message], final_sent_message: Optional[types.Message], use_progress: bool, delete_delay: float = 2.0):
+    """
+    Stores the final response for auto-clear. If the progress message was not reused
+    as the final response, it is deleted after a short delay (in the background).
+    """
+    if final_sent_message and (final_sent_message != progress_message or not use_progress):
+        await store_response_message(event.chat_id, final_sent_message)
+    elif use_progress and progress_message and progress_message != final_sent_message:
+        schedule_delete(progress_message, delete_delay) # Give a moment
+
 async def clear_previous_responses(chat_id: int):
     """
     Deletes previously sent bot messages stored for a specific chat.
@@ -1513,7 +2054,7 @@ async def clear_previous_responses(chat_id: int):
     if chat_id not in previous_bot_messages or not previous_bot_messages[chat_id]:
         return
 
-    messages_to_delete = previous_bot_messages.pop(chat_id, []) # Get and clear list for this chat
+    messages_to_delete = list(previous_bot_messages.pop(chat_id, {}).values()) # Get and clear messages for this chat
     if not messages_to_delete: return
 
     # Filter out None or invalid message objects (though unlikely if stored correctly)
@@ -1536,14 +2077,17 @@ async def clear_previous_responses(chat_id: int):
         if not message_ids: continue
 
         try:
-            await client.delete_messages(chat_id, message_ids)
+            try:
+                await client.delete_messages(chat_id, message_ids)
+            except telethon_errors.FloodWaitError as e:
+                logger.warning(f"Flood wait ({e.seconds}s) during message clearing chunk in chat {chat_id}. Retrying this chunk after pause.")
+                await asyncio.sleep(e.seconds + 1.5)
+                await client.delete_messages(chat_id, message_ids) # One retry, a second flood wait lands below
             deleted_count += len(message_ids)
             logger.debug(f"Deleted {len(message_ids)} messages in chat {chat_id} (Chunk {i//chunk_size + 1}).")
         except telethon_errors.FloodWaitError as e:
-             wait_time = e.seconds
-             logger.warning(f"Flood wait ({wait_time}s) during message clearing chunk in chat {chat_id}. Pausing and will retry this chunk later if needed (currently, these are lost).")
-             failed_to_delete_ids.extend(message_ids) # Mark these as failed for now
-             await asyncio.sleep(wait_time + 1.5)
+             logger.warning(f"Flood wait ({e.seconds}s) again while clearing chunk in chat {chat_id}. Giving up on these messages.")
+             failed_to_delete_ids.extend(message_ids) # Mark these as failed
         except (telethon_errors.MessageDeleteForbiddenError, telethon_errors.MessageIdInvalidError) as e:
              # Some messages might have been deleted by user, or bot lacks permission
              logger.warning(f"Cannot delete some messages in chunk for chat {chat_id} ({len(message_ids)} IDs): {type(e).__name__} - {e}. These will be skipped.")
@@ -1565,64 +2109,105 @@ async def store_response_message(chat_id: int, message: Optional[types.Message])
     if not message or not isinstance(message, types.Message) or not chat_id:
         return
 
-    if not config.get("auto_clear", True): # If auto_clear is off, don't store.
+    if not AUTO_CLEAR: # If auto_clear is off, don't store.
         return
 
     global previous_bot_messages
-    if chat_id not in previous_bot_messages:
-        previous_bot_messages[chat_id] = []
+    chat_messages = previous_bot_messages.setdefault(chat_id, {})
+
+    # Avoid duplicate storage (by ID: comparing Telethon messages themselves compares their whole contents)
+    if message.id not in chat_messages:
+        chat_messages[message.id] = message
+        logger.debug(f"Stored message {message.id} for clearing in chat {chat_id}. (Total tracked for chat: {len(chat_messages)})")
 
-    # Avoid duplicate storage
-    if message not in previous_bot_messages[chat_id]:
-        previous_bot_messages[chat_id].append(message)
-        logger.debug(f"Stored message {message.id} for clearing in chat {chat_id}. (Total tracked for chat: {len(previous_bot_messages[chat_id])})")
+
+def split_message_chunks(text: str, prefix: str = "", max_len: int = 4096) -> List[str]:
+    """
+    Greedily packs the lines of text into chunks of at most max_len characters.
+    Every chunk starts with the (stripped) prefix, if one is given.
+    """
+    prefix = prefix.strip()
+    prefix_len = len(prefix)
+    chunks: List[str] = []
+    buffer: List[str] = [prefix] if prefix else []
+    current_len = prefix_len # Length of '\n'.join(buffer), tracked instead of re-measuring the string
+
+    for line in text.split('\n'):
+        line_len = len(line)
+        # Add 1 for the newline character if the current chunk already has content
+        if current_len + line_len + (1 if current_len else 0) > max_len:
+            if current_len > 0: # Ensure there's something to flush
+                chunks.append('\n'.join(buffer))
+            # Start new chunk with prefix (if any) and current line
+            if prefix:
+                buffer, current_len = [prefix, line], prefix_len + 1 + line_len
+            else:
+                buffer, current_len = [line], line_len
+        elif current_len:
+            buffer.append(line)
+            current_len += 1 + line_len
+        else: # Chunk is empty (e.g., first line without prefix), just start it with the line
+            buffer, current_len = [line], line_len
+
+    # Keep the remaining part unless it's empty or just the prefix
+    last_chunk = '\n'.join(buffer)
+    if last_chunk.strip() and (not prefix or last_chunk.strip() != prefix):
+        chunks.append(last_chunk)
+    return chunks
 
 
 async def send_long_message(event: events.NewMessage.Event, text: str, prefix: str = ""):
     """Sends a long message by splitting it into chunks, respecting Telegram's limits."""
     MAX_LEN = 4096 # Telegram's max message length
     sent_msgs = []
-    current_message = prefix.strip() # Start with prefix
-    lines = text.split('\n')
-
-    for line in lines:
-        # Check if adding the new line (plus a newline character) exceeds MAX_LEN
-        # Add 1 for the potential newline character if current_message is not empty
-        space_needed = len(line) + (1 if current_message else 0)
+    chunks = split_message_chunks(text, prefix, MAX_LEN)
 
-        if len(current_message) + space_needed > MAX_LEN:
-            # Current message + new line is too long. Send current message.
-            if len(current_message) > 0: # Ensure there's something to send
-                try:
-                    msg = await event.respond(current_message)
-                    sent_msgs.append(msg)
-                    await asyncio.sleep(0.3) # Small delay between sending parts
-                except Exception as e:
-                    logger.error(f"Failed to send part of long message: {e}")
-            # Start new message with prefix (if any) and current line
-            current_message = (prefix.strip() + "\n" + line) if prefix.strip() else line
-        else:
-            # Append line to current message
-            if current_message: # If message already has content, add newline first
-                 current_message += "\n" + line
-            else: # If message is empty (e.g., first line after prefix), just add line
-                 current_message += line
-
-
-    # Send any remaining part of the message
-    # Ensure it's not just the prefix or empty
-    if current_message.strip() and (not prefix.strip() or current_message.strip() != prefix.strip()):
-         try:
-            msg = await event.respond(current_message)
+    # Parts are sent back to back (concurrent sends could arrive out of order);
+    # pacing is left to Telegram: on flood wait the part is retried once after the requested delay.
+    for i, chunk in enumerate(chunks):
+        try:
+            try:
+                msg = await event.respond(chunk)
+            except telethon_errors.FloodWaitError as e_flood:
+                logger.warning(f"Flood wait ({e_flood.seconds}s) while sending part {i + 1}/{len(chunks)} of long message. Retrying after pause.")
+                await asyncio.sleep(e_flood.seconds + 1.0)
+                msg = await event.respond(chunk)
             sent_msgs.append(msg)
-         except Exception as e:
-             logger.error(f"Failed to send final part of long message: {e}")
+        except Exception as e:
+            logger.error(f"Failed to send part {i + 1}/{len(chunks)} of long message: {e}")
 
     # Store all sent messages for auto-clear
     for m in sent_msgs:
         await store_response_message(event.chat_id, m)
 
 
+# Page used when lyrics are too long for a message (str.format placeholders; CSS braces are doubled)
+LYRICS_HTML_TEMPLATE = """<!DOCTYPE html>
+<html lang="ru">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>{title} - текст песни</title>
+    <style>
+        body {{ font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Helvetica, Arial, sans-serif; line-height: 1.6; padding: 20px; background-color: #f8f9fa; color: #212529; margin: 0; }}
+        .container {{ max-width: 800px; margin: 20px auto; background: #ffffff; padding: 30px; border-radius: 8px; box-shadow: 0 4px 15px rgba(0,0,0,0.07); }}
+        h1 {{ color: #343a40; border-bottom: 2px solid #dee2e6; padding-bottom: 15px; margin-top: 0; margin-bottom: 10px; font-size: 2em; font-weight: 600; }}
+        .artist-info {{ font-size: 1.2em; color: #495057; margin-bottom: 20px; font-weight: 500; }}
+        .source {{ font-size: 0.9em; color: #6c757d; margin-bottom: 30px; font-style: italic; }}
+        pre {{ white-space: pre-wrap; word-wrap: break-word; background: #e9ecef; padding: 20px; border-radius: 5px; font-family: 'Menlo', 'Consolas', 'Courier New', monospace; font-size: 1.05em; line-height: 1.7; border: 1px solid #ced4da; overflow-x: auto; }}
+        ::-webkit-scrollbar {{ width: 8px; height: 8px; }} ::-webkit-scrollbar-track {{ background: #f1f1f1; border-radius: 10px; }} ::-webkit-scrollbar-thumb {{ background: #adb5bd; border-radius: 10px; }} ::-webkit-scrollbar-thumb:hover {{ background: #868e96; }}
+    </style>
+</head>
+<body><div class="container"><h1>{title}</h1>
+{artist_block}
+{source_block}
+<pre>{lyrics}</pre>
+</div></body></html>"""
+# Parsing of the lyrics header built by the lyrics commands, e.g. "📜 **Текст песни:** Song Title - Artist Name"
+_LYRICS_HEADER_RE = re.compile(r"\*\*Текст песни:\*\*\s*(.+?)\s*-\s*(.+)")
+_LYRICS_SOURCE_RE = re.compile(r"\(Источник:\s*(.*?)\)_")
+_UNSAFE_FILENAME_RE = re.compile(r'[^\w\-]+')
+
 async def send_lyrics(event: events.NewMessage.Event, lyrics_text: str, lyrics_header: str, track_title: str, video_id: str):
     """
     Sends lyrics. If too long, sends as an HTML file.
@@ -1647,7 +2232,7 @@ async def send_lyrics(event: events.NewMessage.Event, lyrics_text: str, lyrics_h
         header_lines = lyrics_header.split('\n')
         if header_lines:
             # Example header: "📜 **Текст песни:** Song Title - Artist Name"
-            title_artist_match = re.search(r"\*\*Текст песни:\*\*\s*(.+?)\s*-\s*(.+)", header_lines[0])
+            title_artist_match = _LYRICS_HEADER_RE.search(header_lines[0])
             if title_artist_match:
                 html_display_title = title_artist_match.group(1).strip()
                 html_display_artist = title_artist_match.group(2).strip()
@@ -1658,7 +2243,7 @@ async def send_lyrics(event: events.NewMessage.Event, lyrics_text: str, lyrics_h
         html_source_line_text = ""
         source_line_from_header = next((line for line in header_lines if "Источник:" in line), None)
         if source_line_from_header:
-             source_match_html = re.search(r"\(Источник:\s*(.*?)\)_", source_line_from_header)
+             source_match_html = _LYRICS_SOURCE_RE.search(source_line_from_header)
              if source_match_html:
                   html_source_line_text = source_match_html.group(1).strip()
 
@@ -1670,49 +2255,23 @@ async def send_lyrics(event: events.NewMessage.Event, lyrics_text: str, lyrics_h
         escaped_lyrics_text = html.escape(lyrics_text)
 
 
-        html_content = f"""<!DOCTYPE html>
-<html lang="ru">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>{escaped_html_title} - текст песни</title>
-    <style>
-        body {{ font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Helvetica, Arial, sans-serif; line-height: 1.6; padding: 20px; background-color: #f8f9fa; color: #212529; margin: 0; }}
-        .container {{ max-width: 800px; margin: 20px auto; background: #ffffff; padding: 30px; border-radius: 8px; box-shadow: 0 4px 15px rgba(0,0,0,0.07); }}
-        h1 {{ color: #343a40; border-bottom: 2px solid #dee2e6; padding-bottom: 15px; margin-top: 0; margin-bottom: 10px; font-size: 2em; font-weight: 600; }}
-        .artist-info {{ font-size: 1.2em; color: #495057; margin-bottom: 20px; font-weight: 500; }}
-        .source {{ font-size: 0.9em; color: #6c757d; margin-bottom: 30px; font-style: italic; }}
-        pre {{ white-space: pre-wrap; word-wrap: break-word; background: #e9ecef; padding: 20px; border-radius: 5px; font-family: 'Menlo', 'Consolas', 'Courier New', monospace; font-size: 1.05em; line-height: 1.7; border: 1px solid #ced4da; overflow-x: auto; }}
-        ::-webkit-scrollbar {{ width: 8px; height: 8px; }} ::-webkit-scrollbar-track {{ background: #f1f1f1; border-radius: 10px; }} ::-webkit-scrollbar-thumb {{ background: #adb5bd; border-radius: 10px; }} ::-webkit-scrollbar-thumb:hover {{ background: #868e96; }}
-    </style>
-</head>
-<body><div class="container"><h1>{escaped_html_title}</h1>
-{f'<p class="artist-info">{escaped_html_artist}</p>' if escaped_html_artist and escaped_html_artist != "Неизвестный исполнитель" else ''}
-{f'<p class="source">Источник: {escaped_html_source}</p>' if escaped_html_source else ''}
-<pre>{escaped_lyrics_text}</pre>
-</div></body></html>"""
+        artist_block = f'<p class="artist-info">{escaped_html_artist}</p>' if escaped_html_artist and escaped_html_artist != "Неизвестный исполнитель" else ''
+        source_block = f'<p class="source">Источник: {escaped_html_source}</p>' if escaped_html_source else ''
+        html_content = LYRICS_HTML_TEMPLATE.format(title=escaped_html_title, artist_block=artist_block, source_block=source_block, lyrics=escaped_lyrics_text)
 
         # Create a safe filename
-        safe_title_for_file = re.sub(r'[^\w\-]+', '_', track_title)[:50] # Sanitize and shorten
-        timestamp_file = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-        # video_id can be None if called from download -s before ID is known for lyrics header.
-        safe_video_id_part = f"_{video_id}" if video_id and video_id != 'N/A' else ""
-        temp_filename = f"lyrics_{safe_title_for_file}{safe_video_id_part}_{timestamp_file}.html"
-        temp_filepath = os.path.join(SCRIPT_DIR, temp_filename)
-        sent_file_msg = None
+        safe_title_for_file = _UNSAFE_FILENAME_RE.sub('_', track_title)[:50] # Sanitize and shorten
+        display_filename_tg = f"{safe_title_for_file}_lyrics.html" # Filename shown in Telegram
 
         try:
-            loop = asyncio.get_running_loop()
-            # Write file (blocking I/O)
-            await loop.run_in_executor(None, functools.partial(write_text_file, temp_filepath, html_content))
-            logger.debug(f"Saved temporary HTML lyrics file: {temp_filepath}")
-
+            # Uploaded straight from memory, no temporary file to write and clean up
+            html_file = BytesIO(html_content.encode('utf-8'))
+            html_file.name = display_filename_tg # Telethon derives the file name and MIME type from this
             caption_for_file = f"📜 Текст песни '{track_title}' (слишком длинный, отправлен в виде файла)"
-            display_filename_tg = f"{safe_title_for_file}_lyrics.html" # Filename shown in Telegram
 
             sent_file_msg = await client.send_file(
                 event.chat_id,
-                file=temp_filepath,
+                file=html_file,
                 caption=caption_for_file,
                 attributes=[types.DocumentAttributeFilename(file_name=display_filename_tg)],
                 force_document=True, # Send as a document
@@ -1725,28 +2284,24 @@ async def send_lyrics(event: events.NewMessage.Event, lyrics_text: str, lyrics_h
             logger.error(f"Failed to create/send HTML lyrics file for {video_id or 'unknown track'}: {e_html}", exc_info=True)
             fail_msg = await event.reply(f"❌ Не удалось отправить текст песни '{track_title}' в виде файла.")
             await store_response_message(event.chat_id, fail_msg)
-        finally:
-            # Schedule cleanup of the temporary HTML file
-            if os.path.exists(temp_filepath): # Check existence before scheduling
-                logger.debug(f"Scheduling cleanup for temporary HTML file: {temp_filepath}")
-                asyncio.create_task(cleanup_files(temp_filepath))
-
-
-def write_text_file(filepath: str, content: str):
-    """Synchronously writes text content to a file."""
-    with open(filepath, 'w', encoding='utf-8') as f:
-        f.write(content)
 
 
 # =============================================================================
 #                         COMMAND HANDLERS
 # =============================================================================
 
+# Commands whose new response replaces the previous ones when auto_clear is on
+# ("ping" or other simple commands might not need auto-clear)
+AUTO_CLEAR_COMMANDS = frozenset({
+    "search", "see", "last", "host", "download", "help", "dl",
+    "rec", "alast", "likes", "text", "lyrics", "clear",
+})
+
 @client.on(events.NewMessage)
 async def handle_message(event: events.NewMessage.Event):
     """Main handler for incoming messages."""
 
-    if not config.get("bot_enabled", True): return
+    if not BOT_ENABLED: return
     if not event.message or not event.message.text or event.message.via_bot or not event.sender_id:
         return
 
@@ -1764,25 +2319,21 @@ async def handle_message(event: events.NewMessage.Event):
 
     if not is_authorised:
         message_text_check = event.message.text.strip()
-        prefix = config.get("prefix", ",")
-        if message_text_check.startswith(prefix): # Log if an unauthorized user tries a command
+        if message_text_check.startswith(COMMAND_PREFIX): # Log if an unauthorized user tries a command
              logger.warning(f"Ignoring unauthorized command attempt from user: {sender_id} in chat {event.chat_id}: '{message_text_check[:50]}...'")
         return
 
     # --- Command Handling ---
     message_text = event.message.text
-    prefix = config.get("prefix", ",")
+    prefix = COMMAND_PREFIX
     if not message_text.startswith(prefix): return # Not a command
 
-    command_string = message_text[len(prefix):].strip()
-    if not command_string: return # Empty command after prefix
-
-    parts = command_string.split(maxsplit=1)
-    command = parts[0].lower()
-    args_str = parts[1] if len(parts) > 1 else ""
-    # Smart split args, considering quotes for multi-word arguments (though not heavily used yet)
-    # For now, simple split is fine as most commands take IDs/links or simple flags.
-    args = args_str.split() # Basic split by space
+    # One whitespace split yields the command and its args; no strip or second pass needed.
+    # Quoted multi-word arguments are not supported; commands take IDs/links or simple flags.
+    tokens = message_text[len(prefix):].split()
+    if not tokens: return # Empty command after prefix
+    command = tokens[0].lower()
+    args = tokens[1:]
 
     logger.info(f"Received command: '{command}', Args: {args}, User: {sender_id}, Chat: {event.chat_id} (Owner: {is_owner}, Self: {is_self})")
 
@@ -1794,25 +2345,18 @@ async def handle_message(event: events.NewMessage.Event):
         except Exception as e_del:
             logger.warning(f"Failed to delete user/owner command message {event.message.id}: {e_del}")
 
-    commands_to_clear_for = (
-        "search", "see", "last", "host", "download", "help", "dl",
-        "rec", "alast", "likes", "text", "lyrics", "clear"
-        # "ping" or other simple commands might not need auto-clear
-    )
-    if config.get("auto_clear", True) and command in commands_to_clear_for:
+    if AUTO_CLEAR and command in AUTO_CLEAR_COMMANDS:
          logger.debug(f"Auto-clearing previous responses for '{command}' in chat {event.chat_id}")
          await clear_previous_responses(event.chat_id)
 
-    # Command handlers dictionary (defined globally or imported if modularized)
-    # handlers = { ... } # Defined later or in main
+    # Module-level command table, defined after all handler functions (see MAIN EXECUTION & LIFECYCLE)
     handler_func = handlers.get(command)
 
     if handler_func:
         try:
             await handler_func(event, args)
         except Exception as e_handler:
-            error_details = traceback.format_exc()
-            logger.error(f"Error executing handler for command '{command}': {e_handler}\n{error_details}")
+            logger.error(f"Error executing handler for command '{command}': {e_handler}", exc_info=True)
             try:
                 error_msg_text = (f"❌ Произошла внутренняя ошибка при обработке команды `{command}`.\n"
                                   f"```\n{type(e_handler).__name__}: {str(e_handler)[:200]}\n```" # Limit length of error message
@@ -1832,7 +2376,7 @@ async def handle_message(event: events.NewMessage.Event):
 # -------------------------
 async def handle_clear(event: events.NewMessage.Event, args: List[str]):
     """Clears previous bot responses in the chat."""
-    if config.get("auto_clear", True):
+    if AUTO_CLEAR:
         # If auto-clear is on, this command is somewhat redundant but can confirm behavior.
         confirm_msg = await event.respond("ℹ️ Предыдущие ответы этого бота обычно очищаются автоматически перед новым ответом на команду.", delete_in=15) # Increased time
         logger.info(f"Executed 'clear' command (auto-clear enabled) in chat {event.chat_id}.")
@@ -1847,20 +2391,64 @@ async def handle_clear(event: events.NewMessage.Event, args: List[str]):
     # No explicit deletion of confirm_msg needed due to delete_in.
 
 
+# --- Command flag tables (constant, shared by the handlers below) ---
+# Entity type flags for search/see: -t tracks, -a albums, -p playlists, -e artists/endpoints
+ENTITY_TYPE_FLAGS = frozenset({"-t", "-a", "-p", "-e"})
+ENTITY_TYPE_HINTS = {"-t": "track", "-a": "album", "-p": "playlist", "-e": "artist"}
+# Results header label per ytmusicapi search filter
+SEARCH_FILTER_LABELS = {"songs": "Треки", "albums": "Альбомы", "playlists": "Плейлисты", "artists": "Исполнители", "videos": "Видео"}
+DOWNLOAD_FLAGS = frozenset({"-t", "-a", "-s"}) # -s for search and download
+
+# --- Search result formatters: item -> (line parts, link or None), one per ytmusicapi search filter ---
+def _format_song_result(item: Dict) -> Tuple[List[str], Optional[str]]:
+    parts = [f"**{item.get('title', 'Неизвестно')}** - {format_artists(item.get('artists'))}"]
+    if item.get('duration'): parts.append(f"({item['duration']})") # "M:SS" or "H:MM:SS"
+    video_id = item.get('videoId') or item.get('browseId')
+    return parts, f"https://music.youtube.com/watch?v={video_id}" if video_id else None
+
+def _format_video_result(item: Dict) -> Tuple[List[str], Optional[str]]:
+    parts = [f"**{item.get('title', 'Неизвестно')}** - {format_artists(item.get('artists'))}"]
+    if item.get('duration'): parts.append(f"({item['duration']})")
+    if item.get('views'): parts.append(f"[{item['views']}]")
+    video_id = item.get('videoId') or item.get('browseId')
+    return parts, f"https://www.youtube.com/watch?v={video_id}" if video_id else None
+
+def _format_album_result(item: Dict) -> Tuple[List[str], Optional[str]]:
+    parts = [f"**{item.get('title', 'Неизвестно')}** - {format_artists(item.get('artists'))}"]
+    if item.get('year'): parts.append(f"({item['year']})")
+    browse_id = item.get('videoId') or item.get('browseId')
+    return parts, f"https://music.youtube.com/browse/{browse_id}" if browse_id else None
+
+def _format_artist_result(item: Dict) -> Tuple[List[str], Optional[str]]:
+    # 'artist' key for name (fallback to title), 'browseId' for ID; artist pages are channels
+    channel_id = item.get('videoId') or item.get('browseId')
+    return [f"**{item.get('artist', item.get('title', 'Неизвестно'))}**"], f"https://music.youtube.com/channel/{channel_id}" if channel_id else None
+
+def _format_playlist_result(item: Dict) -> Tuple[List[str], Optional[str]]:
+    parts = [f"**{item.get('title', 'Неизвестно')}** (Автор: {format_artists(item.get('author'))})"]
+    if item.get('itemCount'): parts.append(f"[{item['itemCount']} треков]")
+    playlist_id = item.get('videoId') or item.get('browseId')
+    if playlist_id and playlist_id.startswith("VL"): playlist_id = playlist_id[2:] # Playlist browseId might start with 'VL', remove it for link
+    return parts, f"https://music.youtube.com/playlist?list={playlist_id}" if playlist_id else None
+
+SEARCH_RESULT_FORMATTERS = {
+    "songs": _format_song_result, "videos": _format_video_result, "albums": _format_album_result,
+    "artists": _format_artist_result, "playlists": _format_playlist_result,
+}
+
 # -------------------------
 # Command: search (-t, -a, -p, -e, -v)
 # -------------------------
 async def handle_search(event: events.NewMessage.Event, args: List[str]):
     """Handles the search command."""
-    valid_type_flags = {"-t", "-a", "-p", "-e"} # -t: tracks, -a: albums, -p: playlists, -e: artists/endpoints
-    prefix = config.get("prefix", ",")
+    prefix = COMMAND_PREFIX
 
     search_type_flag = None # e.g., "-t"
     is_video_search = False # for -v flag
     query_parts = []
 
     for arg in args:
-        if arg in valid_type_flags:
+        if arg in ENTITY_TYPE_FLAGS:
             if search_type_flag is None: # Take the first type flag encountered
                 search_type_flag = arg
             else:
@@ -1903,92 +2491,44 @@ async def handle_search(event: events.NewMessage.Event, args: List[str]):
         search_category_display = "видеоклипов" if is_video_search else "треков"
 
 
-    progress_message, statuses, use_progress = None, {}, config.get("progress_messages", True)
+    progress_message, statuses, use_progress = None, {}, USE_PROGRESS_MESSAGES
+    progress = None # Coalesces status edits; closed before the progress message is replaced with the result
     sent_message = None # To store the final message for auto-clear
 
     try:
-        if use_progress:
-            statuses = {"Поиск": "⏳ Ожидание...", "Форматирование": "⏸️"}
-            progress_message = await event.reply("\n".join(f"{task}: {status}" for task, status in statuses.items()))
-            await store_response_message(event.chat_id, progress_message)
-
         if use_progress:
             query_display = (query[:30] + '...') if len(query) > 33 else query
-            statuses["Поиск"] = f"🔄 Поиск {search_category_display} '{query_display}'..."
-            await update_progress(progress_message, statuses)
+            statuses = {"Поиск": f"🔄 Поиск {search_category_display} '{query_display}'...", "Форматирование": "⏸️"}
+            progress_message = await event.reply(render_statuses(statuses))
+            await store_response_message(event.chat_id, progress_message)
+        progress = ProgressCoalescer(progress_message, statuses)
 
-        search_limit = min(max(1, config.get("default_search_limit", 8)), 20) # YTMusic API limit usually 20
+        search_limit = min(max(1, DEFAULT_SEARCH_LIMIT), 20) # YTMusic API limit usually 20
         results = await _api_search(query, filter_type=filter_type_api, limit=search_limit)
 
-        if use_progress:
-            search_status_msg = f"✅ Найдено: {len(results)}" if results else "ℹ️ Ничего не найдено"
-            statuses["Поиск"] = search_status_msg
-            statuses["Форматирование"] = "🔄 Подготовка..." if results else "➖"
-            await update_progress(progress_message, statuses)
+        progress.set("Поиск", f"✅ Найдено: {len(results)}" if results else "ℹ️ Ничего не найдено")
+        progress.set("Форматирование", "🔄 Подготовка..." if results else "➖")
 
         if not results:
             final_message_text = f"ℹ️ По запросу `{query}` ({search_category_display}) ничего не найдено."
+            await progress.close()
             if progress_message: await progress_message.edit(final_message_text); sent_message = progress_message
             else: sent_message = await event.reply(final_message_text)
         else:
             response_lines = []
-            display_limit = min(len(results), MAX_SEARCH_RESULTS_DISPLAY) # Max items to show in TG message
-            type_labels_header = {"songs": "Треки", "albums": "Альбомы", "playlists": "Плейлисты", "artists": "Исполнители", "videos": "Видео"}
-            header_label = type_labels_header.get(filter_type_api, search_category_display.capitalize())
+            # Max items to show in TG message; invalid items are skipped lazily, stopping once enough valid ones are found
+            display_results = list(itertools.islice((r for r in results if r and isinstance(r, dict)), MAX_SEARCH_RESULTS_DISPLAY))
+            display_limit = len(display_results)
+            header_label = SEARCH_FILTER_LABELS.get(filter_type_api, search_category_display.capitalize())
             response_text_final = f"**🔎 Результаты поиска ({header_label}) для `{query}`:**\n"
 
-            for i, item in enumerate(results[:display_limit]):
-                if not item or not isinstance(item, dict):
-                    logger.warning(f"Skipping invalid item in search results: {item}")
-                    continue
-
-                line_parts = [f"{i + 1}. "]
+            format_item = SEARCH_RESULT_FORMATTERS[filter_type_api] # Chosen once, not per result
+            for i, item in enumerate(display_results):
                 try:
-                    title = item.get('title', 'Неизвестно')
-                    item_id = item.get('videoId') or item.get('browseId') # videoId for songs/videos, browseId for others
-                    link_prefix = ""
-
-                    if filter_type_api in ["songs", "videos"]:
-                        artists_formatted = format_artists(item.get('artists'))
-                        duration_str = item.get('duration') # "M:SS" or "H:MM:SS"
-                        views = item.get('views') # For videos
-                        link_prefix = "https://music.youtube.com/watch?v=" if filter_type_api == "songs" else "https://www.youtube.com/watch?v="
-
-                        line_parts.append(f"**{title}** - {artists_formatted}")
-                        if duration_str: line_parts.append(f"({duration_str})")
-                        if views and filter_type_api == "videos": line_parts.append(f"[{views}]")
-
-                    elif filter_type_api == "albums":
-                        artists_formatted = format_artists(item.get('artists'))
-                        year = item.get('year')
-                        link_prefix = "https://music.youtube.com/browse/"
-                        line_parts.append(f"**{title}** - {artists_formatted}")
-                        if year: line_parts.append(f"({year})")
-
-                    elif filter_type_api == "artists":
-                        # 'artist' key for name, 'browseId' for ID
-                        artist_name = item.get('artist', title) # Fallback to title if 'artist' key missing
-                        link_prefix = "https://music.youtube.com/channel/" # Artist pages are channels
-                        line_parts.append(f"**{artist_name}**")
-                        # Artist results might not have much other info directly in search item
-
-                    elif filter_type_api == "playlists":
-                        author_formatted = format_artists(item.get('author')) # 'author' for playlists
-                        item_count = item.get('itemCount') # Number of tracks in playlist
-                        # Playlist browseId might start with 'VL', remove it for link
-                        if item_id and item_id.startswith("VL"): item_id_for_link = item_id[2:]
-                        else: item_id_for_link = item_id
-                        link_prefix = "https://music.youtube.com/playlist?list="
-                        item_id = item_id_for_link # Use modified ID for link
-
-                        line_parts.append(f"**{title}** (Автор: {author_formatted})")
-                        if item_count: line_parts.append(f"[{item_count} треков]")
-
-
+                    line_parts, full_link = format_item(item)
                     # Construct the line
-                    full_line = " ".join(part for part in line_parts if part) # Join non-empty parts
-                    if item_id and link_prefix:
-                        full_link = f"{link_prefix}{item_id}"
+                    full_line = " ".join(part for part in (f"{i + 1}. ", *line_parts) if part) # Join non-empty parts
+                    if full_link:
                         full_line += f"\n   └ [Ссылка]({full_link})"
                     response_lines.append(full_line)
 
@@ -2000,9 +2540,8 @@ async def handle_search(event: events.NewMessage.Event, args: List[str]):
             if len(results) > display_limit:
                 response_text_final += f"\n\n... и еще {len(results) - display_limit}."
 
+            await progress.close() # Pending status edits would only be overwritten by the results
             if use_progress:
-                statuses["Форматирование"] = "✅ Готово"
-                await update_progress(progress_message, statuses)
                 await progress_message.edit(response_text_final, link_preview=False)
                 sent_message = progress_message
             else:
@@ -2011,8 +2550,9 @@ async def handle_search(event: events.NewMessage.Event, args: List[str]):
     except ValueError as e: # e.g., from invalid limit parsing in config
         error_text = f"⚠️ Ошибка конфигурации поиска: {e}"
         logger.warning(error_text)
+        if progress: await progress.close()
         if use_progress and progress_message:
-            statuses["Поиск"] = str(statuses.get("Поиск", "⏸️")).replace("🔄", "❌").replace("✅", "❌").replace("⏳", "❌")
+            statuses["Поиск"] = to_error_status(statuses.get("Поиск", "⏸️"))
             statuses["Форматирование"] = "❌"
             try: await update_progress(progress_message, statuses)
             except Exception: pass
@@ -2022,8 +2562,9 @@ async def handle_search(event: events.NewMessage.Event, args: List[str]):
     except Exception as e:
         logger.error(f"Неожиданная ошибка в команде search: {e}", exc_info=True)
         error_text = f"❌ Произошла неожиданная ошибка при поиске:\n`{type(e).__name__}: {str(e)[:100]}`"
+        if progress: await progress.close()
         if use_progress and progress_message:
-            for task_key in statuses: statuses[task_key] = str(statuses[task_key]).replace("🔄", "❌").replace("✅", "❌").replace("⏳", "❌").replace("⏸️", "❌")
+            for task_key in statuses: statuses[task_key] = to_error_status(statuses[task_key])
             try: await update_progress(progress_message, statuses)
             except Exception: pass
             try:
@@ -2034,6 +2575,7 @@ async def handle_search(event: events.NewMessage.Event, args: List[str]):
         else:
             sent_message = await event.reply(error_text)
     finally:
+        if progress: await progress.close()
         if sent_message: # Ensure the final message (success or error) is stored
             await store_response_message(event.chat_id, sent_message)
 
@@ -2042,8 +2584,7 @@ async def handle_search(event: events.NewMessage.Event, args: List[str]):
 # -------------------------
 async def handle_see(event: events.NewMessage.Event, args: List[str]):
     """Handles the 'see' command."""
-    valid_flags = {"-t", "-a", "-p", "-e"}
-    prefix = config.get("prefix", ",")
+    prefix = COMMAND_PREFIX
 
     if not args:
         usage = (f"**Использование:** `{prefix}see [-t|-a|-p|-e] [-i] [-txt] <ID или ссылка>`\n"
@@ -2056,61 +2597,55 @@ async def handle_see(event: events.NewMessage.Event, args: List[str]):
     include_cover = False
     include_lyrics = False
     link_or_id_arg = None
-    remaining_args = list(args) # Work with a copy
-
-    # Parse flags first
-    if "-i" in remaining_args:
-        include_cover = True
-        remaining_args.remove("-i")
-    if "-txt" in remaining_args:
-        include_lyrics = True
-        remaining_args.remove("-txt")
+    extra_args = []
 
-    # Parse entity type hint flag
-    for arg_idx, arg_val in enumerate(remaining_args):
-        if arg_val in valid_flags:
-            entity_type_hint_flag = arg_val
-            remaining_args.pop(arg_idx) # Remove the flag from args
-            break # Take the first one
-
-    # The first remaining argument should be the link or ID
-    if remaining_args:
-        link_or_id_arg = remaining_args[0]
-        if len(remaining_args) > 1:
-             logger.warning(f"Ignoring extra arguments in see command after link/ID: {remaining_args[1:]}")
+    # Single pass over the args: flags may appear anywhere, the first non-flag argument is the link or ID
+    for arg in args:
+        if arg == "-i": include_cover = True
+        elif arg == "-txt": include_lyrics = True
+        elif arg in ENTITY_TYPE_FLAGS:
+            if entity_type_hint_flag is None: entity_type_hint_flag = arg # Take the first one
+            else: extra_args.append(arg)
+        elif link_or_id_arg is None: link_or_id_arg = arg
+        else: extra_args.append(arg)
+
+    if link_or_id_arg is not None:
+        if extra_args:
+             logger.warning(f"Ignoring extra arguments in see command: {extra_args}")
     else: # No link/ID provided after parsing flags
         await store_response_message(event.chat_id, await event.reply(f"⚠️ Не указана ссылка или ID для команды `see`."))
         return
 
 
-    hint_map = {"-t": "track", "-a": "album", "-p": "playlist", "-e": "artist"}
-    entity_type_hint = hint_map.get(entity_type_hint_flag) if entity_type_hint_flag else None
+    entity_type_hint = ENTITY_TYPE_HINTS.get(entity_type_hint_flag) if entity_type_hint_flag else None
 
     entity_id = extract_entity_id(link_or_id_arg)
     if not entity_id:
         await store_response_message(event.chat_id, await event.reply(f"⚠️ Не удалось распознать ID из `{link_or_id_arg}`."))
         return
 
-    progress_message, statuses, use_progress = None, {}, config.get("progress_messages", True)
-    temp_thumb_file, processed_thumb_file = None, None # For thumbnail processing
+    progress_message, statuses, use_progress = None, {}, USE_PROGRESS_MESSAGES
+    progress = None # Coalesces status edits; closed before the progress message is replaced or deleted
+    processed_thumb_file = None # For thumbnail processing
+    cover_task = None # Cover download, started as soon as the URL is known
     final_info_message_object = None # Will hold the message object for the main info (text or with picture)
     files_to_clean_on_exit = []
     lyrics_message_handled_storage = False # True if send_lyrics sends a message and stores it
 
     try:
         if use_progress:
-            statuses = {"Получение данных": "⏳ Ожидание...", "Форматирование": "⏸️"}
+            statuses = {"Получение данных": "🔄 Запрос...", "Форматирование": "⏸️"}
             if include_cover: statuses["Обложка"] = "⏸️"
             if include_lyrics: statuses["Текст"] = "⏸️"
-            progress_message = await event.reply("\n".join(f"{task}: {status}" for task, status in statuses.items()))
+            progress_message = await event.reply(render_statuses(statuses))
             await store_response_message(event.chat_id, progress_message) # Store initial progress message
-
-        if use_progress: statuses["Получение данных"] = "🔄 Запрос..."; await update_progress(progress_message, statuses)
+        progress = ProgressCoalescer(progress_message, statuses)
 
         entity_info = await get_entity_info(entity_id, entity_type_hint)
 
         if not entity_info:
             result_text = f"ℹ️ Не удалось найти информацию для ID: `{entity_id}` (Подсказка: {entity_type_hint or 'авто'})"
+            await progress.close()
             if use_progress and progress_message:
                 await progress_message.edit(result_text)
                 final_info_message_object = progress_message # Progress message became the final message
@@ -2127,10 +2662,8 @@ async def handle_see(event: events.NewMessage.Event, args: List[str]):
             if not include_lyrics and "Текст" in statuses:
                  del statuses["Текст"]
 
-            if use_progress:
-                 statuses["Получение данных"] = f"✅ ({actual_entity_type})"
-                 statuses["Форматирование"] = "🔄 Подготовка..." if actual_entity_type != 'unknown' else "➖"
-                 await update_progress(progress_message, statuses)
+            progress.set("Получение данных", f"✅ ({actual_entity_type})")
+            progress.set("Форматирование", "🔄 Подготовка..." if actual_entity_type != 'unknown' else "➖")
 
             response_text_parts = []
             thumbnail_url = None
@@ -2145,11 +2678,17 @@ async def handle_see(event: events.NewMessage.Event, args: List[str]):
                 thumbnails_data = entity_info['thumbnail']['thumbnails']
             if isinstance(thumbnails_data, list) and thumbnails_data:
                 try:
-                    highest_res_thumb = sorted(thumbnails_data, key=lambda x: x.get('width', 0) * x.get('height', 0), reverse=True)[0]
+                    highest_res_thumb = max(thumbnails_data, key=lambda t: (t.get('width') or 0) * (t.get('height') or 0)) # First of the largest, like a stable sort
                     thumbnail_url = highest_res_thumb.get('url')
                 except (IndexError, KeyError, TypeError, AttributeError):
                     thumbnail_url = thumbnails_data[-1].get('url') if thumbnails_data else None
             if thumbnail_url: logger.debug(f"Selected thumbnail URL for {actual_entity_type} '{entity_id}': {thumbnail_url}")
+            if include_cover and thumbnail_url:
+                # Fetched while the text below is built (artist pages need more API calls first)
+                # Artist photos are sent as is, other covers are cropped to a square in the same pass as the download
+                cover_coro = download_thumbnail(thumbnail_url) if actual_entity_type == 'artist' else fetch_and_crop_thumbnail(thumbnail_url)
+                cover_task = asyncio.create_task(cover_coro)
+                progress.set("Обложка", "🔄 Загрузка...")
 
             if actual_entity_type == 'track':
                 details_to_use = entity_info
@@ -2345,24 +2884,17 @@ async def handle_see(event: events.NewMessage.Event, args: List[str]):
                 response_text_parts.append(f"⚠️ Тип сущности '{actual_entity_type}' не полностью поддерживается для детального просмотра.")
                 response_text_parts.append(f"ID: `{entity_id}`"); response_text_parts.append(f"Данные: ```json\n{json.dumps(entity_info, indent=2, ensure_ascii=False)[:1000]}\n...```")
                 logger.warning(f"Unsupported entity type for 'see': {actual_entity_type}, ID: {entity_id}")
-                if use_progress and progress_message : statuses["Форматирование"] = "⚠️ Неподдерживаемый тип"; await update_progress(progress_message, statuses)
+                progress.set("Форматирование", "⚠️ Неподдерживаемый тип")
 
             final_response_text = "\n".join(response_text_parts)
-            if use_progress and progress_message: statuses["Форматирование"] = "✅ Готово"; await update_progress(progress_message, statuses)
-
-            if include_cover and thumbnail_url:
-                if use_progress and progress_message: statuses["Обложка"] = "🔄 Загрузка..."; await update_progress(progress_message, statuses)
-                temp_thumb_file = await download_thumbnail(thumbnail_url)
-                if temp_thumb_file:
-                    files_to_clean_on_exit.append(temp_thumb_file)
-                    if use_progress and progress_message: statuses["Обложка"] = "🔄 Обработка..."; await update_progress(progress_message, statuses)
-                    processed_thumb_file = temp_thumb_file if actual_entity_type == 'artist' else await crop_thumbnail(temp_thumb_file)
-                    if actual_entity_type == 'artist': logger.debug(f"Using original thumbnail for artist: {temp_thumb_file}")
-                    if processed_thumb_file and processed_thumb_file != temp_thumb_file: files_to_clean_on_exit.append(processed_thumb_file)
-                    elif not processed_thumb_file and actual_entity_type != 'artist': logger.warning(f"Cropping failed for {temp_thumb_file}, using original."); processed_thumb_file = temp_thumb_file
-                    if use_progress and progress_message:
-                        thumb_status_icon = "✅" if processed_thumb_file and os.path.exists(processed_thumb_file) else "⚠️"
-                        statuses["Обложка"] = f"{thumb_status_icon} Готово к отправке"; await update_progress(progress_message, statuses)
+            progress.set("Форматирование", "✅ Готово")
+
+            if cover_task:
+                processed_thumb_file = await cover_task
+                # Every branch below replaces or deletes the progress message, so pending status edits are dropped
+                await progress.close()
+                if processed_thumb_file:
+                    files_to_clean_on_exit.append(processed_thumb_file)
                     if processed_thumb_file and os.path.exists(processed_thumb_file):
                         try:
                             final_info_message_object = await client.send_file(event.chat_id, file=processed_thumb_file, caption=final_response_text, link_preview=False, reply_to=event.message.id)
@@ -2371,52 +2903,47 @@ async def handle_see(event: events.NewMessage.Event, args: List[str]):
                                 except Exception: pass
                         except Exception as send_e:
                             logger.error(f"Failed to send file with cover {os.path.basename(processed_thumb_file)}: {send_e}", exc_info=True)
-                            if use_progress and progress_message and "Обложка" in statuses: statuses["Обложка"] = "❌ Ошибка отправки"; await update_progress(progress_message, statuses)
                             final_response_text_fallback = f"{final_response_text}\n\n_(Ошибка при отправке обложки)_"
                             final_info_message_object = await (progress_message.edit(final_response_text_fallback, link_preview=False) if progress_message else event.reply(final_response_text_fallback, link_preview=False))
                     else:
                         logger.warning(f"Thumbnail processing failed or file not found for {entity_id}. Sending text only.")
-                        if use_progress and progress_message and "Обложка" in statuses: statuses["Обложка"] = "❌ Ошибка обработки"; await update_progress(progress_message, statuses)
                         final_response_text_fallback = f"{final_response_text}\n\n_(Ошибка при обработке обложки)_"
                         final_info_message_object = await (progress_message.edit(final_response_text_fallback, link_preview=False) if progress_message else event.reply(final_response_text_fallback, link_preview=False))
                 else:
                      logger.warning(f"Thumbnail download failed for {entity_id}. Sending text only.")
-                     if use_progress and progress_message and "Обложка" in statuses: statuses["Обложка"] = "❌ Ошибка загрузки"; await update_progress(progress_message, statuses)
                      final_response_text_fallback = f"{final_response_text}\n\n_(Ошибка при загрузке обложки)_"
                      final_info_message_object = await (progress_message.edit(final_response_text_fallback, link_preview=False) if progress_message else event.reply(final_response_text_fallback, link_preview=False))
             else:
+                 await progress.close()
                  final_info_message_object = await (progress_message.edit(final_response_text, link_preview=False) if progress_message else event.reply(final_response_text, link_preview=False))
             if final_info_message_object: await store_response_message(event.chat_id, final_info_message_object)
+            # The progress message is now either deleted or the info message itself, which must not be edited or deleted below
+            progress_message = None
 
             if include_lyrics and video_id_for_lyrics_later:
-                if use_progress and progress_message: statuses["Текст"] = "🔄 Запрос..."; await update_progress(progress_message, statuses)
                 lyrics_data = await get_lyrics_for_track(video_id_for_lyrics_later, lyrics_browse_id_from_main_entity)
                 if lyrics_data and lyrics_data.get('lyrics'):
-                    if use_progress and progress_message: statuses["Текст"] = "✅ Отправка..."; await update_progress(progress_message, statuses)
                     lyrics_text_content = lyrics_data['lyrics']; lyrics_source_content = lyrics_data.get('source')
                     lyrics_header_text = f"📜 **Текст песни:** {title_display} - {artists_display}" + (f"\n_(Источник: {lyrics_source_content})_" if lyrics_source_content else "")
-                    if progress_message:
-                        try: await progress_message.delete(); progress_message = None
-                        except Exception: pass
                     await send_lyrics(event, lyrics_text_content, lyrics_header_text, title_display, video_id_for_lyrics_later)
                     lyrics_message_handled_storage = True
                 else:
                     logger.info(f"Текст не найден для '{title_display}' ({video_id_for_lyrics_later}).")
                     no_lyrics_text_reply = f"_Текст для '{title_display}' не найден._"
-                    if use_progress and progress_message: statuses["Текст"] = "ℹ️ Не найден"; await update_progress(progress_message, statuses)
                     reply_to_msg_id_lyrics = final_info_message_object.id if final_info_message_object else event.message.id
                     no_lyrics_msg_obj_sent = await event.respond(no_lyrics_text_reply, reply_to=reply_to_msg_id_lyrics)
                     await store_response_message(event.chat_id, no_lyrics_msg_obj_sent)
             elif include_lyrics and not video_id_for_lyrics_later:
-                if use_progress and progress_message and "Текст" in statuses: statuses["Текст"] = "⚠️ Не удалось определить трек"; await update_progress(progress_message, statuses)
+                logger.info(f"No track to fetch lyrics for in '{entity_id}' ({actual_entity_type}).")
 
     except Exception as e:
         logger.error(f"Unexpected error in handle_see for ID '{entity_id}': {e}", exc_info=True)
         error_prefix = "⚠️" if isinstance(e, (ValueError, FileNotFoundError, TypeError)) else "❌"
         error_text = f"{error_prefix} Ошибка при получении информации '{entity_id}':\n`{type(e).__name__}: {str(e)[:150]}`"
+        if progress: await progress.close()
         current_progress_text = getattr(progress_message, 'text', '') if use_progress and progress_message else ""
         if use_progress and progress_message:
-             for task_key_err in statuses: statuses[task_key_err] = str(statuses[task_key_err]).replace("🔄", "❌").replace("✅", "❌").replace("⏳", "❌").replace("⏸️", "❌")
+             for task_key_err in statuses: statuses[task_key_err] = to_error_status(statuses[task_key_err])
              try: await update_progress(progress_message, statuses)
              except Exception: pass
              try:
@@ -2430,6 +2957,11 @@ async def handle_see(event: events.NewMessage.Event, args: List[str]):
             await store_response_message(event.chat_id, final_info_message_object)
 
     finally:
+        if progress: await progress.close()
+        if cover_task and not cover_task.done(): cover_task.cancel() # Failed before the cover was needed
+        elif cover_task and not cover_task.cancelled() and not cover_task.exception():
+            leftover_thumb = cover_task.result()
+            if leftover_thumb and leftover_thumb not in files_to_clean_on_exit: files_to_clean_on_exit.append(leftover_thumb)
         if files_to_clean_on_exit:
             logger.debug(f"Scheduling cleanup for handle_see (Files: {len(files_to_clean_on_exit)})")
             asyncio.create_task(cleanup_files(*files_to_clean_on_exit))
@@ -2440,13 +2972,13 @@ async def handle_see(event: events.NewMessage.Event, args: List[str]):
 async def send_single_track(event: events.NewMessage.Event, info: Dict, file_path: str):
     """
     Handles sending a single downloaded audio file via Telegram.
-    Updates last.csv.
+    Updates last.json.
     """
-    temp_telegram_thumb, processed_telegram_thumb = None, None
+    processed_telegram_thumb = None
     files_to_clean_after_send = [file_path] # Initially, only the audio file itself
     title, performer, duration_sec = "Неизвестно", "Неизвестно", 0
     sent_audio_msg = None
-    video_id_for_last = "N/A" # For last.csv
+    video_id_for_last = "N/A" # For last.json
 
     try:
         if not info or not file_path or not os.path.exists(file_path):
@@ -2472,14 +3004,14 @@ async def send_single_track(event: events.NewMessage.Event, info: Dict, file_pat
 
 
         if isinstance(thumbnails_list_from_info, list) and thumbnails_list_from_info:
-            try: # Sort by area to get largest, prefer webp or jpg
+            try: # Largest by area, prefer webp or jpg
                 def sort_key_thumb(t):
                     pref = 0
                     if 'url' in t and t['url'].endswith('.webp'): pref = 2
                     elif 'url' in t and t['url'].endswith('.jpg'): pref = 1
-                    return (t.get('width', 0) * t.get('height', 0), pref)
+                    return ((t.get('width') or 0) * (t.get('height') or 0), pref)
 
-                best_thumb_info = sorted(thumbnails_list_from_info, key=sort_key_thumb, reverse=True)[0]
+                best_thumb_info = max(thumbnails_list_from_info, key=sort_key_thumb) # Single pass, no sorted copy
                 thumb_url = best_thumb_info.get('url')
             except (IndexError, KeyError, TypeError, AttributeError):
                 if thumbnails_list_from_info: # Fallback to just the last one if sorting or access fails
@@ -2489,17 +3021,11 @@ async def send_single_track(event: events.NewMessage.Event, info: Dict, file_pat
 
         if thumb_url:
             logger.debug(f"Attempting download/process thumbnail for Telegram audio preview ('{title}')")
-            temp_telegram_thumb = await download_thumbnail(thumb_url) # Downloads to SCRIPT_DIR
-            if temp_telegram_thumb:
-                files_to_clean_after_send.append(temp_telegram_thumb) # Add downloaded thumb for cleanup
-                processed_telegram_thumb = await crop_thumbnail(temp_telegram_thumb) # Crops and saves with _cropped suffix
-                if processed_telegram_thumb and processed_telegram_thumb != temp_telegram_thumb:
-                    files_to_clean_after_send.append(processed_telegram_thumb) # Add cropped thumb for cleanup
-                elif not processed_telegram_thumb: # Crop failed
-                     logger.warning(f"crop_thumbnail returned None for {temp_telegram_thumb}. Will send without specific Telegram thumbnail, relying on file's embedded or none.")
-                     processed_telegram_thumb = None # Ensure it's None
+            processed_telegram_thumb = await fetch_and_crop_thumbnail(thumb_url) # Square JPEG in SCRIPT_DIR, no uncropped temp file
+            if processed_telegram_thumb:
+                files_to_clean_after_send.append(processed_telegram_thumb) # Add cropped thumb for cleanup
             else:
-                 logger.warning(f"Failed to download thumbnail for track '{title}'. Sending without specific Telegram thumbnail.")
+                 logger.warning(f"Failed to download/crop thumbnail for track '{title}'. Sending without specific Telegram thumbnail.")
         else:
              logger.info(f"No suitable thumbnail URL found in metadata for track '{title}'. Sending without specific Telegram thumbnail.")
 
@@ -2521,7 +3047,7 @@ async def send_single_track(event: events.NewMessage.Event, info: Dict, file_pat
         )
         logger.info(f"Аудио успешно отправлено: {os.path.basename(file_path)} (Msg ID: {sent_audio_msg.id})")
 
-        # --- Update last.csv ---
+        # --- Update last.json ---
         if config.get("recent_downloads", True):
              try:
                 last_tracks_list = load_last_tracks()
@@ -2560,8 +3086,8 @@ async def send_single_track(event: events.NewMessage.Event, info: Dict, file_pat
               )
               logger.info(f"Повторная отправка без явного превью успешна: {os.path.basename(file_path)}")
               await store_response_message(event.chat_id, sent_audio_msg_no_thumb) # Store retry message
-              # Update last.csv for this successful send too (if not already done, but it should be if this path is reached)
-              # The original call to update last.csv would have happened if we get here.
+              # Update last.json for this successful send too (if not already done, but it should be if this path is reached)
+              # The original call to update last.json would have happened if we get here.
               return sent_audio_msg_no_thumb
           except Exception as retry_e:
               logger.error(f"Повторная отправка {os.path.basename(file_path)} без превью не удалась: {retry_e}", exc_info=True)
@@ -2619,8 +3145,7 @@ async def send_single_track(event: events.NewMessage.Event, info: Dict, file_pat
 # -------------------------
 async def handle_download(event: 'events.NewMessage.Event', args: List[str]):
     """Handles the download command. Supports -t (track), -a (album/playlist), -s (search then download track)."""
-    valid_flags = {"-t", "-a", "-s"} # -s for search and download
-    prefix = config.get("prefix", ",")
+    prefix = COMMAND_PREFIX
 
     if not args:
         usage = (f"**Использование:** `{prefix}dl <флаг> <аргумент> [-txt]`\n"
@@ -2646,7 +3171,7 @@ async def handle_download(event: 'events.NewMessage.Event', args: List[str]):
     # Parse main download type flag (-t, -a, -s)
     if remaining_args:
         potential_flag = remaining_args[0].lower()
-        if potential_flag in valid_flags:
+        if potential_flag in DOWNLOAD_FLAGS:
             download_type_flag = potential_flag
             remaining_args.pop(0) # Remove the flag
         else: # No valid flag found at the start
@@ -2675,7 +3200,8 @@ async def handle_download(event: 'events.NewMessage.Event', args: List[str]):
          logger.warning("-txt flag is ignored for album/playlist downloads (-a).")
          include_lyrics = False # Lyrics only for single tracks (-t or -s)
 
-    progress_message, statuses, use_progress = None, {}, config.get("progress_messages", True)
+    progress_message, statuses, use_progress = None, {}, USE_PROGRESS_MESSAGES
+    progress: Optional[ProgressCoalescer] = None # Batches status edits for single-track downloads
     # final_sent_message is not consistently used here as sending happens in helpers or per track
 
     loop = asyncio.get_running_loop() # Get loop once
@@ -2686,8 +3212,9 @@ async def handle_download(event: 'events.NewMessage.Event', args: List[str]):
             if use_progress:
                 statuses = {"Поиск трека": f"⏳ '{search_query[:30]}...'", "Скачивание/Обработка": "⏸️", "Отправка Аудио": "⏸️"}
                 if include_lyrics: statuses["Отправка Текста"] = "⏸️"
-                progress_message = await event.reply("\n".join(f"{task}: {status}" for task, status in statuses.items()))
+                progress_message = await event.reply(render_statuses(statuses))
                 await store_response_message(event.chat_id, progress_message)
+                progress = ProgressCoalescer(progress_message, statuses)
 
             logger.info(f"Search and download requested for query: '{search_query}'")
             # Search for songs first, then videos if no songs found
@@ -2696,31 +3223,30 @@ async def handle_download(event: 'events.NewMessage.Event', args: List[str]):
             if search_results_s and search_results_s[0].get('videoId'):
                 found_item = search_results_s[0]
                 logger.info(f"Found song match for '{search_query}': {found_item.get('title')}")
-                if use_progress: statuses["Поиск трека"] = f"✅ Трек: {found_item.get('title', 'Без названия')[:30]}..."
+                if use_progress: progress.set("Поиск трека", f"✅ Трек: {found_item.get('title', 'Без названия')[:30]}...")
             else:
-                if use_progress: statuses["Поиск трека"] = f"ℹ️ Песня не найдена, ищем видео '{search_query[:20]}...'"; await update_progress(progress_message, statuses)
+                if use_progress: progress.set("Поиск трека", f"ℹ️ Песня не найдена, ищем видео '{search_query[:20]}...'")
                 search_results_v = await _api_search(search_query, filter_type="videos", limit=1)
                 if search_results_v and search_results_v[0].get('videoId'):
                     found_item = search_results_v[0]
                     logger.info(f"Found video match for '{search_query}': {found_item.get('title')}")
-                    if use_progress: statuses["Поиск трека"] = f"✅ Видео: {found_item.get('title', 'Без названия')[:30]}..."
+                    if use_progress: progress.set("Поиск трека", f"✅ Видео: {found_item.get('title', 'Без названия')[:30]}...")
                 else:
                     logger.warning(f"No track or video found for search query: '{search_query}'")
-                    if use_progress: statuses["Поиск трека"] = f"❌ Не найдено: '{search_query[:30]}...'"
-                    await update_progress(progress_message, statuses)
+                    if use_progress:
+                        progress.set("Поиск трека", f"❌ Не найдено: '{search_query[:30]}...'")
+                        await progress.flush()
                     error_msg_search = await event.reply(f"❌ Не удалось найти трек или видео по запросу: `{search_query}`")
                     await store_response_message(event.chat_id, error_msg_search)
                     return # Exit if nothing found
 
-            await update_progress(progress_message, statuses) # Update after search result
-
             video_id_to_dl = found_item.get('videoId')
             track_title_from_search = found_item.get('title', 'Неизвестный трек')
             download_link_from_search = f"https://music.youtube.com/watch?v={video_id_to_dl}"
 
             # Now, proceed like -t download
-            if use_progress: statuses["Скачивание/Обработка"] = "🔄 Запрос..."; await update_progress(progress_message, statuses)
-            info_s, file_path_s = await loop.run_in_executor(None, functools.partial(download_track, download_link_from_search))
+            if use_progress: progress.set("Скачивание/Обработка", "🔄 Запрос...")
+            info_s, file_path_s = await loop.run_in_executor(_YDL_POOL, functools.partial(download_track, download_link_from_search))
 
             if not file_path_s or not info_s:
                 fail_reason_s = "yt-dlp не смог скачать/обработать"
@@ -2728,9 +3254,9 @@ async def handle_download(event: 'events.NewMessage.Event', args: List[str]):
                 elif not info_s: fail_reason_s = "yt-dlp не вернул информацию"
                 logger.error(f"Download failed for searched track {track_title_from_search} ({download_link_from_search}). Reason: {fail_reason_s}")
                 if use_progress:
-                    statuses["Скачивание/Обработка"] = f"❌ Ошибка ({fail_reason_s[:20]}...)"
-                    statuses["Отправка Аудио"] = "❌"; statuses["Отправка Текста"] = "❌" # Ensure status is set
-                    await update_progress(progress_message, statuses)
+                    progress.set("Скачивание/Обработка", f"❌ Ошибка ({fail_reason_s[:20]}...)")
+                    progress.set("Отправка Аудио", "❌"); progress.set("Отправка Текста", "❌") # Ensure status is set
+                    await progress.flush()
                 error_msg_dl_s = await event.reply(f"❌ Не удалось скачать или обработать найденный трек '{track_title_from_search}':\n`{download_link_from_search}`\n_{fail_reason_s}_")
                 await store_response_message(event.chat_id, error_msg_dl_s)
             else: # Download successful
@@ -2739,44 +3265,38 @@ async def handle_download(event: 'events.NewMessage.Event', args: List[str]):
                 logger.info(f"Track from search download successful: {file_basename_s}")
                 if use_progress:
                     display_title_s = (actual_title_s[:30] + '...') if len(actual_title_s) > 33 else actual_title_s
-                    statuses["Скачивание/Обработка"] = f"✅ ({display_title_s})"
-                    statuses["Отправка Аудио"] = "🔄 Подготовка..."; await update_progress(progress_message, statuses)
+                    progress.set("Скачивание/Обработка", f"✅ ({display_title_s})")
+                    progress.set("Отправка Аудио", "🔄 Подготовка...")
 
                 sent_audio_msg_s = await send_single_track(event, info_s, file_path_s)
                 if sent_audio_msg_s:
-                    if use_progress: statuses["Отправка Аудио"] = "✅ Готово"; await update_progress(progress_message, statuses)
+                    if use_progress: progress.set("Отправка Аудио", "✅ Готово")
                     if include_lyrics: # Handle lyrics for -s
-                        if use_progress: statuses["Отправка Текста"] = "🔄 Запрос..."; await update_progress(progress_message, statuses)
+                        if use_progress: progress.set("Отправка Текста", "🔄 Запрос...")
                         lyrics_browse_id_s = info_s.get('lyricsBrowseId') or info_s.get('lyrics')
                         lyrics_data_s = await get_lyrics_for_track(video_id_to_dl, lyrics_browse_id_s)
                         if lyrics_data_s and lyrics_data_s.get('lyrics'):
-                            if use_progress: statuses["Отправка Текста"] = "✅ Отправка..."; await update_progress(progress_message, statuses)
+                            if use_progress: progress.set("Отправка Текста", "✅ Отправка...")
                             artists_s = format_artists(info_s.get('artists') or info_s.get('artist') or info_s.get('uploader') or info_s.get('creator'))
                             lyrics_header_s = f"📜 **Текст песни:** {actual_title_s} - {artists_s}"
                             if lyrics_data_s.get('source'): lyrics_header_s += f"\n_(Источник: {lyrics_data_s['source']})_"
                             await send_lyrics(event, lyrics_data_s['lyrics'], lyrics_header_s, actual_title_s, video_id_to_dl)
-                            if use_progress: statuses["Отправка Текста"] = "✅ Отправлено"
+                            if use_progress: progress.set("Отправка Текста", "✅ Отправлено")
                             # If lyrics sent (especially as HTML file), progress_message might have been deleted by send_lyrics
                             # We check below and handle deletion if it wasn't.
                         else:
-                            if use_progress: statuses["Отправка Текста"] = "ℹ️ Не найден"
+                            if use_progress:
+                                progress.set("Отправка Текста", "ℹ️ Не найден")
+                                await progress.flush()
                             no_lyrics_msg_s = await event.respond(f"_Текст для '{actual_title_s}' не найден._", reply_to=sent_audio_msg_s.id)
                             await store_response_message(event.chat_id, no_lyrics_msg_s)
-                            await asyncio.sleep(7)
-                            try:
-                                await no_lyrics_msg_s.delete()
-                            except Exception: # Catch any error during deletion
-                                pass
-                        await update_progress(progress_message, statuses) # Final update for lyrics status
+                            schedule_delete(no_lyrics_msg_s, 7)
             # Explicitly delete progress_message after all single-track operations (audio + optional lyrics)
             if progress_message: # Check if the progress message object is still valid
-                await asyncio.sleep(5) # Give user a moment to see final status
-                try:
-                    await progress_message.delete()
-                    progress_message = None # Mark as None after successful deletion
-                except Exception as e_del_prog:
-                    logger.debug(f"Failed to delete progress message {getattr(progress_message, 'id', 'N/A')} for -s command: {e_del_prog}")
-                    pass # Ignore if deletion fails (e.g., already deleted by user/Telegram)
+                await progress.flush() # Final status must be visible before the pause
+                await progress.close()
+                schedule_delete(progress_message, 5) # Give user a moment to see final status
+                progress_message = None # Deletion is now owned by the background task
 
 
         elif download_type_flag == "-t": # Download single track by link
@@ -2784,11 +3304,12 @@ async def handle_download(event: 'events.NewMessage.Event', args: List[str]):
             if use_progress:
                 statuses = {"Скачивание/Обработка": "⏳ Ожидание...", "Отправка Аудио": "⏸️"}
                 if include_lyrics: statuses["Отправка Текста"] = "⏸️"
-                progress_message = await event.reply("\n".join(f"{task}: {status}" for task, status in statuses.items()))
+                progress_message = await event.reply(render_statuses(statuses))
                 await store_response_message(event.chat_id, progress_message)
+                progress = ProgressCoalescer(progress_message, statuses)
 
-            if use_progress: statuses["Скачивание/Обработка"] = "🔄 Запрос..."; await update_progress(progress_message, statuses)
-            info_t, file_path_t = await loop.run_in_executor(None, functools.partial(download_track, track_link))
+            if use_progress: progress.set("Скачивание/Обработка", "🔄 Запрос...")
+            info_t, file_path_t = await loop.run_in_executor(_YDL_POOL, functools.partial(download_track, track_link))
 
             if not file_path_t or not info_t:
                 fail_reason_t = "yt-dlp не смог скачать/обработать"
@@ -2796,10 +3317,10 @@ async def handle_download(event: 'events.NewMessage.Event', args: List[str]):
                 elif not info_t: fail_reason_t = "yt-dlp не вернул информацию"
                 logger.error(f"Download failed for {track_link}. Reason: {fail_reason_t}")
                 if use_progress:
-                    statuses["Скачивание/Обработка"] = f"❌ Ошибка ({fail_reason_t[:20]}...)"
-                    statuses["Отправка Аудио"] = "❌"
-                    if include_lyrics: statuses["Отправка Текста"] = "❌"
-                    await update_progress(progress_message, statuses)
+                    progress.set("Скачивание/Обработка", f"❌ Ошибка ({fail_reason_t[:20]}...)")
+                    progress.set("Отправка Аудио", "❌")
+                    if include_lyrics: progress.set("Отправка Текста", "❌")
+                    await progress.flush()
                 error_msg_dl_t = await event.reply(f"❌ Не удалось скачать или обработать трек:\n`{track_link}`\n_{fail_reason_t}_")
                 await store_response_message(event.chat_id, error_msg_dl_t)
             else: # Download successful
@@ -2808,50 +3329,44 @@ async def handle_download(event: 'events.NewMessage.Event', args: List[str]):
                  logger.info(f"Track download successful: {file_basename_t}")
                  if use_progress:
                       display_title_t = (track_title_t[:30] + '...') if len(track_title_t) > 33 else track_title_t
-                      statuses["Скачивание/Обработка"] = f"✅ ({display_title_t})"
-                      statuses["Отправка Аудио"] = "🔄 Подготовка..."; await update_progress(progress_message, statuses)
+                      progress.set("Скачивание/Обработка", f"✅ ({display_title_t})")
+                      progress.set("Отправка Аудио", "🔄 Подготовка...")
 
                  sent_audio_msg_t = await send_single_track(event, info_t, file_path_t)
                  if sent_audio_msg_t:
-                     if use_progress: statuses["Отправка Аудио"] = "✅ Готово"; await update_progress(progress_message, statuses)
+                     if use_progress: progress.set("Отправка Аудио", "✅ Готово")
                      if include_lyrics:
-                         if use_progress: statuses["Отправка Текста"] = "🔄 Запрос..."; await update_progress(progress_message, statuses)
+                         if use_progress: progress.set("Отправка Текста", "🔄 Запрос...")
                          video_id_t = info_t.get('id') or info_t.get('videoId')
                          lyrics_browse_id_t = info_t.get('lyricsBrowseId') or info_t.get('lyrics')
 
                          if video_id_t:
                              lyrics_data_t = await get_lyrics_for_track(video_id_t, lyrics_browse_id_t)
                              if lyrics_data_t and lyrics_data_t.get('lyrics'):
-                                  if use_progress: statuses["Отправка Текста"] = "✅ Отправка..."; await update_progress(progress_message, statuses)
+                                  if use_progress: progress.set("Отправка Текста", "✅ Отправка...")
                                   artists_t = format_artists(info_t.get('artists') or info_t.get('artist') or info_t.get('uploader') or info_t.get('creator'))
                                   lyrics_header_t = f"📜 **Текст песни:** {track_title_t} - {artists_t}"
                                   if lyrics_data_t.get('source'): lyrics_header_t += f"\n_(Источник: {lyrics_data_t['source']})_"
                                   await send_lyrics(event, lyrics_data_t['lyrics'], lyrics_header_t, track_title_t, video_id_t)
-                                  if use_progress: statuses["Отправка Текста"] = "✅ Отправлено"
+                                  if use_progress: progress.set("Отправка Текста", "✅ Отправлено")
                                   # Progress message might have been deleted by send_lyrics
                              else: # Lyrics not found
                                   logger.info(f"Текст не найден для '{track_title_t}' ({video_id_t}) при скачивании.")
-                                  if use_progress: statuses["Отправка Текста"] = "ℹ️ Не найден"
+                                  if use_progress:
+                                      progress.set("Отправка Текста", "ℹ️ Не найден")
+                                      await progress.flush()
                                   no_lyrics_msg_t = await event.respond(f"_Текст для '{track_title_t}' не найден._", reply_to=sent_audio_msg_t.id)
                                   await store_response_message(event.chat_id, no_lyrics_msg_t)
-                                  await asyncio.sleep(7)
-                                  try:
-                                      await no_lyrics_msg_t.delete()
-                                  except Exception: # Catch any error during deletion
-                                      pass
-                             await update_progress(progress_message, statuses) # Final update for lyrics status
+                                  schedule_delete(no_lyrics_msg_t, 7)
                          else: # No video ID from info_t
                               logger.warning(f"Cannot fetch lyrics for downloaded track '{track_title_t}': No video ID available in yt-dlp info.")
-                              if use_progress: statuses["Отправка Текста"] = "⚠️ Нет Video ID"; await update_progress(progress_message, statuses)
+                              if use_progress: progress.set("Отправка Текста", "⚠️ Нет Video ID")
             # Explicitly delete progress_message after all single-track operations (audio + optional lyrics)
             if progress_message: # Check if the progress message object is still valid
-                await asyncio.sleep(5) # Give user a moment to see final status
-                try:
-                    await progress_message.delete()
-                    progress_message = None # Mark as None after successful deletion
-                except Exception as e_del_prog:
-                    logger.debug(f"Failed to delete progress message {getattr(progress_message, 'id', 'N/A')} for -t command: {e_del_prog}")
-                    pass # Ignore if deletion fails (e.g., already deleted by user/Telegram)
+                await progress.flush() # Final status must be visible before the pause
+                await progress.close()
+                schedule_delete(progress_message, 5) # Give user a moment to see final status
+                progress_message = None # Deletion is now owned by the background task
 
 
         elif download_type_flag == "-a": # Download album/playlist
@@ -2909,16 +3424,17 @@ async def handle_download(event: 'events.NewMessage.Event', args: List[str]):
                                  current_statuses_album["Отправка Треков"] = f"❌ Не отправлен '{title_fail}' ({reason_fail})"
                             else:
                                  current_statuses_album["Прогресс Скачивания"] = f"❌ Ошибка '{title_fail}' ({reason_fail})"
-                        await update_progress(progress_message, current_statuses_album)
+                        progress.touch() # Per-track events are frequent (parallel downloads): edits are coalesced
                     except Exception as e_prog_album:
                         logger.error(f"Ошибка при обновлении прогресса альбома: {e_prog_album}", exc_info=True)
 
                 progress_callback_album = album_progress_updater_local
                 statuses = {"Альбом/Плейлист": f"🔄 Анализ ID '{album_or_playlist_id[:30]}...'...", "Прогресс Скачивания": "⏸️", "Отправка Треков": "⏸️"}
-                progress_message = await event.reply("\n".join(f"{task}: {value}" for task, value in statuses.items()))
+                progress_message = await event.reply(render_statuses(statuses))
                 await store_response_message(event.chat_id, progress_message)
+                progress = ProgressCoalescer(progress_message, statuses, window=1.5) # At most one edit per 1.5s, latest statuses win
 
-            logger.info(f"Starting sequential download for album/playlist: {album_or_playlist_id} (Link: {album_playlist_link})")
+            logger.info(f"Starting download for album/playlist: {album_or_playlist_id} (Link: {album_playlist_link})")
             downloaded_tuples_album = await download_album_tracks(album_or_playlist_id, progress_callback_album)
             downloaded_count_album = len(downloaded_tuples_album)
 
@@ -2927,11 +3443,13 @@ async def handle_download(event: 'events.NewMessage.Event', args: List[str]):
                  statuses["Прогресс Скачивания"] = f"{dl_status_icon} Скачано {downloaded_count_album}/{total_tracks_album or '?'}"
                  if downloaded_count_album == 0: statuses["Отправка Треков"] = "➖ (Нет треков для отправки)"
                  else: statuses["Отправка Треков"] = f"📤 Ожидание отправки {downloaded_count_album} треков..."
-                 await update_progress(progress_message, statuses)
+                 await progress.flush()
                  await asyncio.sleep(1)
 
             if downloaded_count_album == 0:
-                if progress_callback_album: await progress_callback_album("album_error", error="Треки не скачаны или ошибка анализа")
+                if progress_callback_album:
+                    await progress_callback_album("album_error", error="Треки не скачаны или ошибка анализа")
+                    await progress.flush() # Must be visible before finally stops the coalescer
                 error_msg_no_dl = await event.reply(f"❌ Не удалось скачать ни одного трека для `{album_title_display or album_or_playlist_id}`.")
                 await store_response_message(event.chat_id, error_msg_no_dl)
                 return
@@ -2949,27 +3467,22 @@ async def handle_download(event: 'events.NewMessage.Event', args: List[str]):
                 if progress_callback_album:
                     await progress_callback_album("track_sending", current_index=i_send, total_downloaded=downloaded_count_album, title=short_title_send)
 
+                await ALBUM_SEND_LIMITER.wait()
                 sent_msg_album_track = await send_single_track(event, info_album_track, file_path_album_track)
                 if sent_msg_album_track:
                     sent_count_album += 1
                     if progress_callback_album:
                          await progress_callback_album("track_sent", current_sent=sent_count_album, total_downloaded=downloaded_count_album, title=short_title_send)
-                await asyncio.sleep(0.7)
 
             if use_progress and progress_message:
                 final_album_icon = "✅" if sent_count_album == downloaded_count_album and downloaded_count_album > 0 else ("⚠️" if sent_count_album > 0 else "❌")
                 statuses["Альбом/Плейлист"] = f"{final_album_icon} '{album_title_display}'"
                 statuses["Прогресс Скачивания"] = f"🏁 Скачано {downloaded_count_album}/{total_tracks_album or '?'}"
                 statuses["Отправка Треков"] = f"🏁 Отправлено {sent_count_album}/{downloaded_count_album}"
-                await update_progress(progress_message, statuses)
-                # FIX: Separate sleep and try-except for final album progress message deletion
-                await asyncio.sleep(5)
-                try:
-                    await progress_message.delete()
-                    progress_message = None # Mark as deleted
-                except Exception as e_del_prog: # Catch any error during deletion
-                    logger.debug(f"Failed to delete progress message {getattr(progress_message, 'id', 'N/A')} for album command: {e_del_prog}")
-                    pass
+                await progress.flush()
+                await progress.close()
+                schedule_delete(progress_message, 5) # Give user a moment to see final status
+                progress_message = None # Deletion is now owned by the background task
 
 
     except Exception as e_dl_main:
@@ -2977,8 +3490,9 @@ async def handle_download(event: 'events.NewMessage.Event', args: List[str]):
         error_prefix_dl = "⚠️" if isinstance(e_dl_main, (ValueError, FileNotFoundError, TypeError)) else "❌"
         error_text_dl = f"{error_prefix_dl} Ошибка при скачивании/отправке:\n`{type(e_dl_main).__name__}: {str(e_dl_main)[:150]}`"
         final_error_message = None
+        if progress: await progress.close() # Stop pending edits so they don't overwrite the error
         if use_progress and progress_message:
-            for task_key_err_dl in statuses: statuses[task_key_err_dl] = str(statuses[task_key_err_dl]).replace("🔄", "⏹️").replace("✅", "⏹️").replace("⏳", "⏹️").replace("▶️", "⏹️").replace("📥", "⏹️").replace("📤", "⏹️").replace("✔️", "⏹️").replace("⏸️", "⏹️")
+            for task_key_err_dl in statuses: statuses[task_key_err_dl] = to_stopped_status(statuses[task_key_err_dl])
             statuses["Состояние"] = "❌ Глобальная ошибка!"
             try: await update_progress(progress_message, statuses)
             except Exception: pass
@@ -2994,25 +3508,50 @@ async def handle_download(event: 'events.NewMessage.Event', args: List[str]):
         if final_error_message and (final_error_message != progress_message or not use_progress):
             await store_response_message(event.chat_id, final_error_message)
     finally:
-        pass # Cleanup is handled by send_single_track for each file
+        if progress: await progress.close()
+        # File cleanup is handled by send_single_track for each file
 
 
 # =============================================================================
 #              AUTHENTICATED COMMAND HANDLERS (rec, alast, likes)
 # =============================================================================
 
+def format_track_list(items: List[Any], item_label: str) -> str:
+    """Formats numbered track entries (title - artists (album) + link) for rec/history/likes responses."""
+    response_lines = []
+    for i_item, item in enumerate(items):
+        if not item or not isinstance(item, dict):
+            logger.warning(f"Skipping invalid {item_label} {i_item+1}: {item}")
+            response_lines.append(f"{i_item + 1}. ⚠️ Неверный формат данных")
+            continue
+        try:
+            title_item = item.get('title', 'Unknown Title')
+            artists_item = format_artists(item.get('artists') or item.get('author'))
+            vid_item = item.get('videoId')
+            album_data_item = item.get('album') # dict with 'name', 'id'
+            album_name_item = album_data_item.get('name') if isinstance(album_data_item, dict) else None
+            album_part_item = f" (Альбом: {album_name_item})" if album_name_item else ""
+
+            full_line_item = f"{i_item + 1}.  **{title_item}** - {artists_item}{album_part_item}"
+            if vid_item: full_line_item += f"\n   └ [Ссылка](https://music.youtube.com/watch?v={vid_item})"
+            response_lines.append(full_line_item)
+
+        except Exception as fmt_e_item:
+             logger.error(f"Error formatting {item_label} {i_item+1}: {item} - {fmt_e_item}", exc_info=True)
+             response_lines.append(f"{i_item + 1}. ⚠️ Ошибка форматирования.")
+    return "\n\n".join(response_lines)
+
 @require_ytmusic_auth
 async def handle_recommendations(event: events.NewMessage.Event, args: List[str]):
     """Fetches personalized music recommendations."""
     limit = config.get("recommendations_limit", 8)
-    progress_message, statuses, use_progress = None, {}, config.get("progress_messages", True)
+    progress_message, statuses, use_progress = None, {}, USE_PROGRESS_MESSAGES
     final_sent_message = None # To store the message that will be kept for auto-clear
 
     try:
         if use_progress:
             statuses = {"Получение рекомендаций": "⏳ Ожидание...", "Форматирование": "⏸️"}
-            progress_message = await event.reply("\n".join(f"{task}: {value}" for task, value in statuses.items()))
-            await store_response_message(event.chat_id, progress_message) # Store progress message
+            progress_message = await start_progress(event, statuses)
 
         if use_progress: statuses["Получение рекомендаций"] = "🔄 Запрос истории для основы..."; await update_progress(progress_message, statuses)
 
@@ -3097,7 +3636,7 @@ async def handle_recommendations(event: events.NewMessage.Event, args: List[str]
              if track_item and isinstance(track_item, dict) and track_item.get('videoId'):
                  vid_rec = track_item['videoId']
                  # Ensure it's a valid 11-char ID (common for songs/videos)
-                 if re.fullmatch(r'[A-Za-z0-9_-]{11}', vid_rec):
+                 if _ID_RE.fullmatch(vid_rec):
                       if vid_rec not in seen_track_ids:
                          final_filtered_recs.append(track_item)
                          seen_track_ids.add(vid_rec)
@@ -3119,35 +3658,8 @@ async def handle_recommendations(event: events.NewMessage.Event, args: List[str]
             else:
                  final_sent_message = await event.reply(final_message_text_no_recs)
         else:
-            response_lines_recs = []
             header_text_recs = f"🎧 **Рекомендации для вас ({recommendation_source_info}):**\n"
-            response_text_final_recs = header_text_recs
-
-            for i_rec, item_rec in enumerate(results_to_display):
-                line_rec_parts = [f"{i_rec + 1}. "]
-                if not item_rec or not isinstance(item_rec, dict):
-                    logger.warning(f"Skipping invalid recommendation item {i_rec+1}: {item_rec}")
-                    response_lines_recs.append(f"{i_rec + 1}. ⚠️ Неверный формат данных")
-                    continue
-                try:
-                    title_rec = item_rec.get('title', 'Unknown Title')
-                    artists_rec = format_artists(item_rec.get('artists') or item_rec.get('author'))
-                    vid_rec_link = item_rec.get('videoId')
-                    link_url_rec = f"https://music.youtube.com/watch?v={vid_rec_link}" if vid_rec_link else None
-                    album_info_rec = item_rec.get('album') # dict with 'name', 'id'
-                    album_name_rec = album_info_rec.get('name') if isinstance(album_info_rec, dict) else None
-                    album_part_rec = f" (Альбом: {album_name_rec})" if album_name_rec else ""
-
-                    line_rec_parts.append(f"**{title_rec}** - {artists_rec}{album_part_rec}")
-                    full_line_rec = " ".join(part for part in line_rec_parts if part)
-                    if link_url_rec: full_line_rec += f"\n   └ [Ссылка]({link_url_rec})"
-                    response_lines_recs.append(full_line_rec)
-
-                except Exception as fmt_e_rec:
-                     logger.error(f"Error formatting recommendation item {i_rec+1}: {item_rec} - {fmt_e_rec}", exc_info=True)
-                     response_lines_recs.append(f"{i_rec + 1}. ⚠️ Ошибка форматирования.")
-
-            response_text_final_recs += "\n\n".join(response_lines_recs)
+            response_text_final_recs = header_text_recs + format_track_list(results_to_display, "recommendation item")
 
             if use_progress:
                 statuses["Форматирование"] = "✅ Готово"
@@ -3161,41 +3673,24 @@ async def handle_recommendations(event: events.NewMessage.Event, args: List[str]
         logger.error(f"Ошибка в команде recommendations: {e_recs_main}", exc_info=True)
         error_prefix_recs = "⚠️" if isinstance(e_recs_main, (ValueError, TypeError)) else "❌"
         error_text_recs = f"{error_prefix_recs} Ошибка при получении рекомендаций:\n`{type(e_recs_main).__name__}: {str(e_recs_main)[:100]}`"
-        if use_progress and progress_message:
-            for task_key_recs in statuses:
-                 statuses[task_key_recs] = str(statuses[task_key_recs]).replace("🔄", "❌").replace("✅", "❌").replace("⏳", "❌").replace("⏸️", "❌")
-            try: await update_progress(progress_message, statuses)
-            except Exception: pass
-            try:
-                await progress_message.edit(f"{getattr(progress_message, 'text', '')}\n\n{error_text_recs}")
-                final_sent_message = progress_message
-            except Exception: final_sent_message = await event.reply(error_text_recs)
-        else: final_sent_message = await event.reply(error_text_recs)
+        final_sent_message = await show_progress_error(event, progress_message, statuses, error_text_recs)
     finally:
-        # Ensure the final message (success or error, which might be the progress message itself) is stored.
-        # If progress_message was used and became final_sent_message, it's already stored.
-        # If a new message was sent as final_sent_message, store it.
-        if final_sent_message and (final_sent_message != progress_message or not use_progress):
-            await store_response_message(event.chat_id, final_sent_message)
-        # If progress_message exists and is different from final_sent_message, it means it should be deleted.
-        elif use_progress and progress_message and progress_message != final_sent_message:
-             await asyncio.sleep(2) # Give a moment
-             try: await progress_message.delete()
-             except Exception: pass
+        # Ensure the final message (success or error, which might be the progress message itself) is stored;
+        # a progress message that didn't become the final one is deleted.
+        await finish_progress(event, progress_message, final_sent_message, use_progress)
 
 
 @require_ytmusic_auth
 async def handle_history(event: events.NewMessage.Event, args: List[str]):
     """Fetches user's listening history."""
     limit = config.get("history_limit", 10)
-    progress_message, statuses, use_progress = None, {}, config.get("progress_messages", True)
+    progress_message, statuses, use_progress = None, {}, USE_PROGRESS_MESSAGES
     final_sent_message = None # To store the final message for auto-clear
 
     try:
         if use_progress:
             statuses = {"Получение истории": "⏳ Ожидание...", "Форматирование": "⏸️"}
-            progress_message = await event.reply("\n".join(f"{task}: {value}" for task, value in statuses.items()))
-            await store_response_message(event.chat_id, progress_message) # Store initial progress msg
+            progress_message = await start_progress(event, statuses)
 
         if use_progress: statuses["Получение истории"] = "🔄 Запрос..."; await update_progress(progress_message, statuses)
 
@@ -3216,35 +3711,9 @@ async def handle_history(event: events.NewMessage.Event, args: List[str]):
             if progress_message: await progress_message.edit(final_message_text_hist); final_sent_message = progress_message
             else: final_sent_message = await event.reply(final_message_text_hist)
         else:
-            response_lines_hist = []
             display_limit_hist = min(len(results_history), limit)
             response_text_final_hist = f"📜 **Недавняя история (последние {display_limit_hist}):**\n"
-
-            for i_hist, item_hist in enumerate(results_history[:display_limit_hist]):
-                line_hist_parts = [f"{i_hist + 1}. "]
-                if not item_hist or not isinstance(item_hist, dict):
-                    logger.warning(f"Skipping invalid history item {i_hist+1}: {item_hist}")
-                    response_lines_hist.append(f"{i_hist + 1}. ⚠️ Неверный формат данных")
-                    continue
-                try:
-                    title_hist = item_hist.get('title', 'Unknown Title')
-                    artists_hist = format_artists(item_hist.get('artists'))
-                    vid_hist = item_hist.get('videoId')
-                    link_url_hist = f"https://music.youtube.com/watch?v={vid_hist}" if vid_hist else None
-                    album_data_hist = item_hist.get('album') # dict with 'name', 'id'
-                    album_name_hist = album_data_hist.get('name') if isinstance(album_data_hist, dict) else None
-                    album_part_hist = f" (Альбом: {album_name_hist})" if album_name_hist else ""
-
-                    line_hist_parts.append(f"**{title_hist}** - {artists_hist}{album_part_hist}")
-                    full_line_hist = " ".join(part for part in line_hist_parts if part)
-                    if link_url_hist: full_line_hist += f"\n   └ [Ссылка]({link_url_hist})"
-                    response_lines_hist.append(full_line_hist)
-
-                except Exception as fmt_e_hist:
-                     logger.error(f"Error formatting history item {i_hist+1}: {item_hist} - {fmt_e_hist}", exc_info=True)
-                     response_lines_hist.append(f"{i_hist + 1}. ⚠️ Ошибка форматирования.")
-
-            response_text_final_hist += "\n\n".join(response_lines_hist)
+            response_text_final_hist += format_track_list(results_history[:display_limit_hist], "history item")
 
             if use_progress:
                 statuses["Форматирование"] = "✅ Готово"
@@ -3257,36 +3726,21 @@ async def handle_history(event: events.NewMessage.Event, args: List[str]):
     except Exception as e_hist_main:
         logger.error(f"Ошибка в команде history: {e_hist_main}", exc_info=True)
         error_text_hist = f"❌ Ошибка при получении истории:\n`{type(e_hist_main).__name__}: {str(e_hist_main)[:100]}`"
-        if use_progress and progress_message:
-            for task_key_hist in statuses: statuses[task_key_hist] = str(statuses[task_key_hist]).replace("🔄", "❌").replace("✅", "❌").replace("⏳", "❌").replace("⏸️", "❌")
-            try: await update_progress(progress_message, statuses)
-            except Exception: pass
-            try: await progress_message.edit(f"{getattr(progress_message, 'text', '')}\n\n{error_text_hist}"); final_sent_message = progress_message
-            except Exception: final_sent_message = await event.reply(error_text_hist)
-        else: final_sent_message = await event.reply(error_text_hist)
+        final_sent_message = await show_progress_error(event, progress_message, statuses, error_text_hist)
     finally:
-        if final_sent_message and (final_sent_message != progress_message or not use_progress):
-            await store_response_message(event.chat_id, final_sent_message)
-        elif use_progress and progress_message and progress_message != final_sent_message:
-            # FIX: Separate sleep and try-except on different lines
-            await asyncio.sleep(2)
-            try:
-                await progress_message.delete()
-            except Exception: # Catch any error during deletion
-                pass
+        await finish_progress(event, progress_message, final_sent_message, use_progress)
 
 @require_ytmusic_auth
 async def handle_liked_songs(event: events.NewMessage.Event, args: List[str]):
     """Fetches user's liked songs playlist."""
     limit = config.get("liked_songs_limit", 15)
-    progress_message, statuses, use_progress = None, {}, config.get("progress_messages", True)
+    progress_message, statuses, use_progress = None, {}, USE_PROGRESS_MESSAGES
     final_sent_message = None # To store the final message for auto-clear
 
     try:
         if use_progress:
             statuses = {"Получение лайков": "⏳ Ожидание...", "Форматирование": "⏸️"}
-            progress_message = await event.reply("\n".join(f"{task}: {status}" for task, status in statuses.items()))
-            await store_response_message(event.chat_id, progress_message)
+            progress_message = await start_progress(event, statuses)
 
         if use_progress: statuses["Получение лайков"] = "🔄 Запрос..."; await update_progress(progress_message, statuses)
 
@@ -3309,35 +3763,9 @@ async def handle_liked_songs(event: events.NewMessage.Event, args: List[str]):
             if progress_message: await progress_message.edit(final_message_text_liked); final_sent_message = progress_message
             else: final_sent_message = await event.reply(final_message_text_liked)
         else:
-            response_lines_liked = []
             display_limit_liked = min(len(results_liked), limit) # Apply display limit
             response_text_final_liked = f"👍 **Треки 'Мне понравилось' (последние {display_limit_liked}):**\n"
-
-            for i_liked, item_liked in enumerate(results_liked[:display_limit_liked]):
-                line_liked_parts = [f"{i_liked + 1}. "]
-                if not item_liked or not isinstance(item_liked, dict):
-                    logger.warning(f"Skipping invalid liked song item {i_liked+1}: {item_liked}")
-                    response_lines_liked.append(f"{i_liked + 1}. ⚠️ Неверный формат данных")
-                    continue
-                try:
-                    title_liked = item_liked.get('title', 'Unknown Title')
-                    artists_liked = format_artists(item_liked.get('artists'))
-                    vid_liked = item_liked.get('videoId')
-                    link_url_liked = f"https://music.youtube.com/watch?v={vid_liked}" if vid_liked else None
-                    album_data_liked = item_liked.get('album') # dict with 'name', 'id'
-                    album_name_liked = album_data_liked.get('name') if isinstance(album_data_liked, dict) else None
-                    album_part_liked = f" (Альбом: {album_name_liked})" if album_name_liked else ""
-
-                    line_liked_parts.append(f"**{title_liked}** - {artists_liked}{album_part_liked}")
-                    full_line_liked = " ".join(part for part in line_liked_parts if part)
-                    if link_url_liked: full_line_liked += f"\n   └ [Ссылка]({link_url_liked})"
-                    response_lines_liked.append(full_line_liked)
-
-                except Exception as fmt_e_liked:
-                     logger.error(f"Error formatting liked song item {i_liked+1}: {item_liked} - {fmt_e_liked}", exc_info=True)
-                     response_lines_liked.append(f"{i_liked + 1}. ⚠️ Ошибка форматирования.")
-
-            response_text_final_liked += "\n\n".join(response_lines_liked)
+            response_text_final_liked += format_track_list(results_liked[:display_limit_liked], "liked song item")
 
             if use_progress:
                 statuses["Форматирование"] = "✅ Готово"
@@ -3350,30 +3778,16 @@ async def handle_liked_songs(event: events.NewMessage.Event, args: List[str]):
     except Exception as e_liked_main:
         logger.error(f"Ошибка в команде liked_songs: {e_liked_main}", exc_info=True)
         error_text_liked = f"❌ Ошибка при получении лайков:\n`{type(e_liked_main).__name__}: {str(e_liked_main)[:100]}`"
-        if use_progress and progress_message:
-            for task_key_liked in statuses: statuses[task_key_liked] = str(statuses[task_key_liked]).replace("🔄", "❌").replace("✅", "❌").replace("⏳", "❌").replace("⏸️", "❌")
-            try: await update_progress(progress_message, statuses)
-            except Exception: pass
-            try: await progress_message.edit(f"{getattr(progress_message, 'text', '')}\n\n{error_text_liked}"); final_sent_message = progress_message
-            except Exception: final_sent_message = await event.reply(error_text_liked)
-        else: final_sent_message = await event.reply(error_text_liked)
+        final_sent_message = await show_progress_error(event, progress_message, statuses, error_text_liked)
     finally:
-        if final_sent_message and (final_sent_message != progress_message or not use_progress):
-            await store_response_message(event.chat_id, final_sent_message)
-        elif use_progress and progress_message and progress_message != final_sent_message:
-            # FIX: Separate sleep and try-except on different lines
-            await asyncio.sleep(2)
-            try:
-                await progress_message.delete()
-            except Exception: # Catch any error during deletion
-                pass
+        await finish_progress(event, progress_message, final_sent_message, use_progress)
 
 # -------------------------
 # Command: text / lyrics
 # -------------------------
 async def handle_lyrics(event: events.NewMessage.Event, args: List[str]):
     """Fetches and displays lyrics for a track ID or link."""
-    prefix = config.get("prefix", ",")
+    prefix = COMMAND_PREFIX
 
     if not args:
         usage_lyrics = f"**Использование:** `{prefix}text <ID трека или ссылка на трек>`"
@@ -3384,17 +3798,17 @@ async def handle_lyrics(event: events.NewMessage.Event, args: List[str]):
     # Extract video ID, expecting an 11-character ID for tracks
     video_id_lyrics = extract_entity_id(link_or_id_lyrics_arg)
 
-    if not video_id_lyrics or not re.fullmatch(r'[A-Za-z0-9_-]{11}', video_id_lyrics):
+    if not video_id_lyrics or not _ID_RE.fullmatch(video_id_lyrics):
         await store_response_message(event.chat_id, await event.reply(f"⚠️ Не удалось распознать ID видео трека из `{link_or_id_lyrics_arg}`. Убедитесь, что это ID или ссылка на трек."))
         return
 
-    progress_message, statuses, use_progress = None, {}, config.get("progress_messages", True)
+    progress_message, statuses, use_progress = None, {}, USE_PROGRESS_MESSAGES
     lyrics_message_sent_and_stored = False # Track if send_lyrics handled storage
 
     try:
         if use_progress:
             statuses = {"Поиск информации о треке": "⏳ Ожидание...", "Получение текста": "⏸️"} # "Отправка" handled by send_lyrics
-            progress_message = await event.reply("\n".join(f"{task}: {status}" for task, status in statuses.items()))
+            progress_message = await event.reply(render_statuses(statuses))
             await store_response_message(event.chat_id, progress_message) # Store progress message
 
         # Fetch track info to get title and artist for the lyrics header
@@ -3462,7 +3876,7 @@ async def handle_lyrics(event: events.NewMessage.Event, args: List[str]):
         error_text_lyrics = f"❌ Ошибка при получении текста для `{video_id_lyrics}`:\n`{type(e_lyrics_main).__name__}: {str(e_lyrics_main)[:100]}`"
         final_error_msg_obj = None
         if use_progress and progress_message:
-            for task_key_lyrics in statuses: statuses[task_key_lyrics] = str(statuses[task_key_lyrics]).replace("🔄", "❌").replace("✅", "❌").replace("⏳", "❌").replace("⏸️", "❌")
+            for task_key_lyrics in statuses: statuses[task_key_lyrics] = to_error_status(statuses[task_key_lyrics])
             try: await update_progress(progress_message, statuses)
             except Exception: pass
             try:
@@ -3482,9 +3896,7 @@ async def handle_lyrics(event: events.NewMessage.Event, args: List[str]):
               current_text = getattr(progress_message, 'text', '')
               is_final_outcome = "Ошибка при получении текста" in current_text or "Не удалось найти текст для трека" in current_text
               if not is_final_outcome:
-                   await asyncio.sleep(3) # Delay before deleting intermediate progress
-                   try: await progress_message.delete()
-                   except Exception: pass
+                   schedule_delete(progress_message, 3) # Delay before deleting intermediate progress
 
 
 # Removed handle_add, handle_delete, handle_list
@@ -3492,17 +3904,26 @@ async def handle_lyrics(event: events.NewMessage.Event, args: List[str]):
 # -------------------------
 # Command: help
 # -------------------------
+# Formatted help text, rebuilt only when help.txt, the prefix or the auth status changes
+_HELP_CACHE: Dict[str, Any] = {"mtime": None, "prefix": None, "auth": None, "text": ""}
+
+def _read_help_file(help_path: str) -> str:
+    with open(help_path, "r", encoding="utf-8") as f_help:
+        return f_help.read().strip()
+
 async def handle_help(event: events.NewMessage.Event, args=None):
     """Displays the help message from help.txt."""
-    help_path = os.path.join(SCRIPT_DIR, 'help.txt')
+    help_path = HELP_FILE
     try:
-        if not os.path.exists(help_path):
+        try:
+            help_mtime = os.stat(help_path).st_mtime
+        except FileNotFoundError:
              logger.error(f"Файл справки не найден: {help_path}")
              error_msg_help = await event.reply(f"❌ Ошибка: Файл справки (`{os.path.basename(help_path)}`) не найден.")
              await store_response_message(event.chat_id, error_msg_help)
              # Fallback to basic command list
              try:
-                 prefix = config.get("prefix", ",")
+                 prefix = COMMAND_PREFIX
                  # Get command names from the handlers dict keys
                  available_commands_help = sorted([cmd_name for cmd_name in handlers.keys()])
                  basic_help_text = f"**Доступные команды (базовый список):**\n" + \
@@ -3513,14 +3934,19 @@ async def handle_help(event: events.NewMessage.Event, args=None):
                  logger.error(f"Не удалось сгенерировать базовую справку: {basic_e_help}", exc_info=True)
              return
 
-        with open(help_path, "r", encoding="utf-8") as f_help: help_text_content = f_help.read().strip()
-
-        current_prefix_help = config.get("prefix", ",")
-        # YTMusic auth status for help text
-        auth_status_indicator_help = "✅ Авторизация YTMusic: Активна" if ytmusic_authenticated else "⚠️ Авторизация YTMusic: Неактивна (некоторые команды могут не работать или работать с ограничениями)"
-
-        formatted_help_text = help_text_content.replace("{prefix}", current_prefix_help)
-        formatted_help_text = formatted_help_text.replace("{auth_status_indicator}", auth_status_indicator_help)
+        current_prefix_help = COMMAND_PREFIX
+        if (help_mtime != _HELP_CACHE["mtime"] or current_prefix_help != _HELP_CACHE["prefix"]
+                or ytmusic_authenticated != _HELP_CACHE["auth"]):
+            help_text_content = await asyncio.to_thread(_read_help_file, help_path)
+            # YTMusic auth status for help text
+            auth_status_indicator_help = "✅ Авторизация YTMusic: Активна" if ytmusic_authenticated else "⚠️ Авторизация YTMusic: Неактивна (некоторые команды могут не работать или работать с ограничениями)"
+
+            formatted_help_text = help_text_content.replace("{prefix}", current_prefix_help)
+            formatted_help_text = formatted_help_text.replace("{auth_status_indicator}", auth_status_indicator_help)
+            _HELP_CACHE.update(mtime=help_mtime, prefix=current_prefix_help, auth=ytmusic_authenticated, text=formatted_help_text)
+            logger.debug("Help text (re)loaded from disk.")
+        else:
+            formatted_help_text = _HELP_CACHE["text"]
 
         # send_long_message handles storing its own messages
         await send_long_message(event, formatted_help_text, prefix="") # No prefix needed for help message itself
@@ -3534,8 +3960,11 @@ async def handle_help(event: events.NewMessage.Event, args=None):
 # -------------------------
 # Command: last
 # -------------------------
+# Artist placeholders that are not worth showing in the list (compared lowercased)
+_UNKNOWN_ARTIST_NAMES = frozenset({'неизвестно', 'unknown artist', 'n/a', ''})
+
 async def handle_last(event: events.NewMessage.Event, args=None):
-    """Displays the list of recently downloaded tracks from last.csv."""
+    """Displays the list of recently downloaded tracks from last.json."""
     if not config.get("recent_downloads", True):
         no_tracking_msg = await event.reply("ℹ️ Отслеживание недавних скачиваний отключено в конфигурации.")
         await store_response_message(event.chat_id, no_tracking_msg)
@@ -3551,35 +3980,33 @@ async def handle_last(event: events.NewMessage.Event, args=None):
     # New format: Track Title, Artists, Video ID, Track URL, Duration Seconds, Timestamp
     for i_last, entry_last in enumerate(tracks_history): # Iterate up to 5 (handled by save_last_tracks)
         if len(entry_last) >= EXPECTED_LAST_TRACKS_COLUMNS: # Check for new 6-column format
-            track_title_csv, artists_csv, video_id_csv, track_url_csv, duration_s_csv, timestamp_csv = entry_last[:EXPECTED_LAST_TRACKS_COLUMNS]
+            # Strip every cell once up front instead of in each check below
+            track_title_csv, artists_csv, video_id_csv, track_url_csv, duration_s_csv, timestamp_csv = (
+                cell.strip() if cell else "" for cell in entry_last[:EXPECTED_LAST_TRACKS_COLUMNS]
+            )
 
             # Clean up display values
-            display_title_csv = track_title_csv.strip() if track_title_csv and track_title_csv.strip() != 'Неизвестно' else 'N/A'
-            display_artists_csv = artists_csv.strip() if artists_csv and artists_csv.strip().lower() not in ['неизвестно', 'unknown artist', 'n/a', ''] else ''
+            display_title_csv = track_title_csv if track_title_csv and track_title_csv != 'Неизвестно' else 'N/A'
+            display_artists_csv = artists_csv if artists_csv.lower() not in _UNKNOWN_ARTIST_NAMES else ''
 
-            name_part_csv = f"**{display_title_csv}**"
-            if display_artists_csv: name_part_csv += f" - {display_artists_csv}"
+            name_part_csv = f"**{display_title_csv}** - {display_artists_csv}" if display_artists_csv else f"**{display_title_csv}**"
 
             # Link part using Track URL
             link_part_csv = ""
-            if track_url_csv and track_url_csv.strip() != 'N/A' and track_url_csv.startswith("http"):
-                link_part_csv = f"[Ссылка на трек]({track_url_csv.strip()})"
-            elif video_id_csv and video_id_csv.strip() != 'N/A': # Fallback to constructing link from video_id if URL is bad
-                fallback_url = f"https://music.youtube.com/watch?v={video_id_csv.strip()}"
-                link_part_csv = f"[Ссылка на трек]({fallback_url})"
-            elif video_id_csv and video_id_csv.strip() != 'N/A': # Just show ID if no valid URL
-                 link_part_csv = f"(ID: `{video_id_csv.strip()}`)"
+            if track_url_csv and track_url_csv != 'N/A' and track_url_csv.startswith("http"):
+                link_part_csv = f"[Ссылка на трек]({track_url_csv})"
+            elif video_id_csv and video_id_csv != 'N/A': # Fallback to constructing link from video_id if URL is bad
+                link_part_csv = f"[Ссылка на трек](https://music.youtube.com/watch?v={video_id_csv})"
 
 
             duration_display_csv = ""
-            if duration_s_csv and duration_s_csv.strip().isdigit() and int(duration_s_csv) > 0:
-                try:
-                    dur_s = int(duration_s_csv)
+            if duration_s_csv.isdigit():
+                dur_s = int(duration_s_csv)
+                if dur_s > 0:
                     mins_dur, secs_dur = divmod(dur_s, 60)
                     duration_display_csv = f"({mins_dur}:{secs_dur:02})"
-                except ValueError: pass # Ignore if duration is not a valid int
 
-            ts_part_csv = f"`({timestamp_csv.strip()})`" if timestamp_csv and timestamp_csv.strip() else ""
+            ts_part_csv = f"`({timestamp_csv})`" if timestamp_csv else ""
 
             # Combine parts for the line
             line_entry_csv = f"{i_last + 1}. {name_part_csv} {duration_display_csv}".strip()
@@ -3590,7 +4017,7 @@ async def handle_last(event: events.NewMessage.Event, args=None):
             logger.warning(f"Skipping malformed entry in last tracks display (expected {EXPECTED_LAST_TRACKS_COLUMNS} columns): {entry_last}")
 
     if len(response_lines_last) == 1: # Only header means no valid tracks
-        no_valid_hist_msg = await event.reply("ℹ️ Не найдено валидных записей в истории скачиваний (возможно, старый формат файла last.csv).")
+        no_valid_hist_msg = await event.reply("ℹ️ Не найдено валидных записей в истории скачиваний (возможно, файл last.json поврежден).")
         await store_response_message(event.chat_id, no_valid_hist_msg)
     else:
         response_msg_last = await event.reply("\n".join(response_lines_last), link_preview=False)
@@ -3722,6 +4149,144 @@ def get_git_repo_info(repo_path: str) -> Dict[str, str]:
     return info
 
 
+# Helper function to collect library versions (sync, cached: they can't change without a restart)
+@functools.lru_cache(maxsize=1)
+def get_library_versions() -> Dict[str, Optional[str]]:
+    """Returns versions of the key libraries; None for any that could not be determined."""
+    probes = {
+        "Python": platform.python_version,
+        "Telethon": lambda: telethon.__version__,
+        "yt-dlp": lambda: yt_dlp.version.__version__,
+        "ytmusicapi": lambda: importlib_metadata.version('ytmusicapi'),
+        "Pillow": lambda: Image.__version__,
+        "psutil": lambda: psutil.__version__,
+        "Requests": lambda: requests.__version__,
+        "python-dotenv": lambda: getattr(dotenv, '__version__', 'да'),
+        "GitPython": lambda: git.__version__,
+    }
+    versions: Dict[str, Optional[str]] = {}
+    for lib_name, probe in probes.items():
+        try: versions[lib_name] = str(probe())
+        except Exception: versions[lib_name] = None
+    return versions
+
+
+# Helper function to capture host details that don't change while the bot runs (sync, called once at import)
+def _snapshot_static_host() -> Dict[str, str]:
+    """Synchronously collects OS name, kernel, architecture and hostname."""
+    system_info_val = platform.system()
+    os_name_val = system_info_val # Default
+    try: # More detailed OS name
+        if system_info_val == 'Linux':
+             try: os_name_val = platform.freedesktop_os_release().get('PRETTY_NAME', system_info_val)
+             except AttributeError: # Fallback if freedesktop_os_release not available
+                  if os.path.exists('/etc/os-release'):
+                      with open('/etc/os-release', 'r') as f_os:
+                           lines_os = f_os.readlines()
+                           os_name_line_val = next((line for line in lines_os if line.startswith('PRETTY_NAME=')), None)
+                           if os_name_line_val: os_name_val = os_name_line_val.split('=', 1)[1].strip().strip('"\'')
+                  elif os.path.exists('/etc/issue'):
+                      with open('/etc/issue', 'r') as f_issue_os: os_name_val = f_issue_os.readline().strip().replace('\\n', '').replace('\\l', '').strip()
+                  if os_name_val == system_info_val: os_name_val = f"{system_info_val} ({platform.platform()})" # Generic
+        elif system_info_val == 'Windows': os_name_val = f"{platform.system()} {platform.release()} ({platform.version()})"
+        elif system_info_val == 'Darwin': os_name_val = f"macOS {platform.mac_ver()[0]}"
+    except Exception as e_os_detail: logger.warning(f"Could not get detailed OS name: {e_os_detail}")
+    return {
+        "system": system_info_val,
+        "os_name": os_name_val,
+        "kernel": platform.release(),
+        "architecture": platform.machine(),
+        "hostname": platform.node(),
+    }
+
+HOST_STATIC = _snapshot_static_host()
+
+# Helper function to collect resource usage and uptime (sync, run in a thread)
+def _collect_host_info() -> Dict[str, str]:
+    """Synchronously collects RAM, CPU, disk and uptime info for the host command."""
+    info = {"ram": "N/A", "cpu": "N/A", "disk": "N/A", "disk_path": SCRIPT_DIR, "uptime": "N/A"}
+
+    try: # RAM
+        mem_val = psutil.virtual_memory()
+        info["ram"] = f"{mem_val.used / (1024 ** 3):.2f} ГБ / {mem_val.total / (1024 ** 3):.2f} ГБ ({mem_val.percent}%)"
+    except Exception as e_ram_host: logger.warning(f"Could not get RAM info: {e_ram_host}")
+    try: # CPU. Non-blocking: usage since the previous call (primed at startup)
+        cpu_count_logical_val = psutil.cpu_count(True)
+        cpu_usage_val = psutil.cpu_percent(interval=None)
+        info["cpu"] = f"{cpu_count_logical_val} ядер, загрузка {cpu_usage_val:.1f}%"
+    except Exception as e_cpu_host: logger.warning(f"Could not get CPU info: {e_cpu_host}")
+    disk_check_path_val = SCRIPT_DIR # Default path for disk check
+    try: # Disk
+        disk_check_path_val = os.path.expanduser('~') # User's home directory
+        if not os.path.exists(disk_check_path_val):
+             disk_check_path_val = SCRIPT_DIR # Fallback to script dir
+        if hasattr(os, 'statvfs'): # POSIX: read the counters directly, same math as psutil.disk_usage
+            st_disk = os.statvfs(disk_check_path_val)
+            disk_total = st_disk.f_blocks * st_disk.f_frsize
+            disk_used = (st_disk.f_blocks - st_disk.f_bfree) * st_disk.f_frsize
+            disk_avail = st_disk.f_bavail * st_disk.f_frsize
+            disk_percent = round(disk_used / (disk_used + disk_avail) * 100, 1) if (disk_used + disk_avail) else 0.0
+        else: # Windows has no statvfs
+            disk_val = psutil.disk_usage(disk_check_path_val)
+            disk_total, disk_used, disk_percent = disk_val.total, disk_val.used, disk_val.percent
+        info["disk"] = f"{disk_used / (1024 ** 3):.2f} ГБ / {disk_total / (1024 ** 3):.2f} ГБ ({disk_percent}%)"
+    except Exception as e_disk_host:
+         logger.error(f"Could not get disk usage for {disk_check_path_val}: {e_disk_host}", exc_info=True)
+         info["disk"] = f"Ошибка ({type(e_disk_host).__name__})"
+    info["disk_path"] = disk_check_path_val
+
+    try: # Uptime
+        uptime_seconds_val = datetime.datetime.now().timestamp() - psutil.boot_time()
+        if uptime_seconds_val > 0:
+            td_uptime = datetime.timedelta(seconds=int(uptime_seconds_val))
+            days_up, rem_s_up = td_uptime.days, td_uptime.seconds
+            hours_up, rem_min_s_up = divmod(rem_s_up, 3600)
+            minutes_up, _ = divmod(rem_min_s_up, 60) # Seconds not usually shown for long uptimes
+            parts_up = []
+            if days_up > 0: parts_up.append(f"{days_up} дн.")
+            if hours_up > 0 or days_up > 0: parts_up.append(f"{hours_up:02} ч.") # Show hours if days > 0
+            if minutes_up > 0 or hours_up > 0 or days_up > 0: parts_up.append(f"{minutes_up:02} мин.")
+            if not parts_up: parts_up.append(f"{int(uptime_seconds_val)} сек.") # Show seconds if very short uptime
+            info["uptime"] = " ".join(parts_up).strip()
+        else: info["uptime"] = "< 1 сек."
+    except Exception as e_uptime_host: logger.warning(f"Could not get uptime: {e_uptime_host}")
+    return info
+
+# Helper function to ping a host (async, never raises)
+async def _ping_host(ping_target_val: str, system_info_val: str) -> str:
+    """Pings the target once and returns a formatted result string for the host command."""
+    ping_result_val = "N/A"
+    proc_ping = None
+    try:
+        ping_cmd_path_val = await asyncio.to_thread(shutil.which, 'ping')
+        if ping_cmd_path_val:
+            startupinfo_ping = None
+            if platform.system() == 'Windows':
+                 startupinfo_ping = subprocess.STARTUPINFO(); startupinfo_ping.dwFlags |= subprocess.STARTF_USESHOWWINDOW; startupinfo_ping.wShowWindow = subprocess.SW_HIDE
+            ping_args_val = [ping_cmd_path_val, '-n', '1', '-w', '2000', ping_target_val] if system_info_val == 'Windows' else [ping_cmd_path_val, '-c', '1', '-W', '2', ping_target_val]
+
+            proc_ping = await asyncio.create_subprocess_exec(*ping_args_val, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, startupinfo=startupinfo_ping)
+            stdout_ping, stderr_ping = await asyncio.wait_for(proc_ping.communicate(), timeout=4.0)
+            if proc_ping.returncode == 0:
+                stdout_str_ping = stdout_ping.decode('utf-8', errors='ignore')
+                match_ping_time = re.search(r'time[=<]([^ ]+?) ?ms', stdout_str_ping, re.IGNORECASE) # More generic time match
+                if not match_ping_time and system_info_val == 'Windows':
+                     match_ping_time = re.search(r'Average = (\d+)ms', stdout_str_ping, re.IGNORECASE)
+                ping_result_val = f"✅ {match_ping_time.group(1)} мс ({ping_target_val})" if match_ping_time else f"✅ OK ({ping_target_val}, RTT ?)"
+            else:
+                stderr_str_ping = stderr_ping.decode('utf-8', errors='ignore').strip()
+                ping_result_val = f"❌ Ошибка ({ping_target_val}, код={proc_ping.returncode}{f': {stderr_str_ping[:30]}...' if stderr_str_ping else ''})"
+        else: ping_result_val = "⚠️ 'ping' не найден"
+    except asyncio.TimeoutError:
+         try:
+             if proc_ping: proc_ping.terminate(); await proc_ping.wait()
+         except Exception: pass
+         ping_result_val = f"⌛ Таймаут 4с ({ping_target_val})"
+    except FileNotFoundError: ping_result_val = f"⚠️ 'ping' не найден (FNF)"
+    except Exception as e_ping_host:
+         logger.warning(f"Ping test failed: {e_ping_host}"); ping_result_val = f"❓ Ошибка ({ping_target_val})"
+    return ping_result_val
+
 # -------------------------
 # Command: host
 # -------------------------
@@ -3736,147 +4301,45 @@ async def handle_host(event: events.NewMessage.Event, args: List[str]):
         "YTM": "⏸️",
         "Репозиторий YTMG": "⏸️" # Changed icon and added to statuses
     }
-    progress_message_host = await event.reply("\n".join(f"{task}: {status}" for task, status in statuses_host.items()))
+    progress_message_host = await event.reply(render_statuses(statuses_host))
     await store_response_message(event.chat_id, progress_message_host) # Store initial progress
 
     loop_host = asyncio.get_running_loop() # Get current event loop
 
     try:
-        # --- System Info ---
-        statuses_host["Система"] = "🔄 Сбор инфо..."
-        await update_progress(progress_message_host, statuses_host)
-        system_info_val = platform.system()
-        os_name_val = system_info_val # Default
-        kernel_val = platform.release()
-        architecture_val = platform.machine()
-        hostname_val = platform.node()
-
-        try: # More detailed OS name
-            if system_info_val == 'Linux':
-                 try: os_name_val = (await loop_host.run_in_executor(None, platform.freedesktop_os_release)).get('PRETTY_NAME', system_info_val)
-                 except AttributeError: # Fallback if freedesktop_os_release not available
-                      if os.path.exists('/etc/os-release'):
-                          with open('/etc/os-release', 'r') as f_os:
-                               lines_os = f_os.readlines()
-                               os_name_line_val = next((line for line in lines_os if line.startswith('PRETTY_NAME=')), None)
-                               if os_name_line_val: os_name_val = os_name_line_val.split('=', 1)[1].strip().strip('"\'')
-                      elif os.path.exists('/etc/issue'):
-                          with open('/etc/issue', 'r') as f_issue_os: os_name_val = f_issue_os.readline().strip().replace('\\n', '').replace('\\l', '').strip()
-                      if os_name_val == system_info_val: os_name_val = f"{system_info_val} ({platform.platform()})" # Generic
-            elif system_info_val == 'Windows': os_name_val = f"{platform.system()} {platform.release()} ({platform.version()})"
-            elif system_info_val == 'Darwin': os_name_val = f"macOS {(await loop_host.run_in_executor(None, platform.mac_ver))[0]}"
-        except Exception as e_os_detail: logger.warning(f"Could not get detailed OS name: {e_os_detail}")
+        # --- System Info (invariant, captured once at startup) ---
+        system_info_val, os_name_val = HOST_STATIC["system"], HOST_STATIC["os_name"]
+        kernel_val, architecture_val, hostname_val = HOST_STATIC["kernel"], HOST_STATIC["architecture"], HOST_STATIC["hostname"]
         statuses_host["Система"] = f"✅ {os_name_val} ({architecture_val})"
         await update_progress(progress_message_host, statuses_host)
 
 
-        # --- Resources ---
+        # --- Resources, Uptime & Network Ping (collected concurrently) ---
         statuses_host["Ресурсы (ЦПУ/ОЗУ/Диск)"] = "🔄 Сбор данных..."
-        await update_progress(progress_message_host, statuses_host)
-        ram_info_val, cpu_info_val, disk_info_val = "N/A", "N/A", "N/A"
-        disk_check_path_val = SCRIPT_DIR # Default path for disk check
-
-        try: # RAM
-             mem_val = await loop_host.run_in_executor(None, psutil.virtual_memory)
-             ram_info_val = f"{mem_val.used / (1024 ** 3):.2f} ГБ / {mem_val.total / (1024 ** 3):.2f} ГБ ({mem_val.percent}%)"
-        except Exception as e_ram_host: logger.warning(f"Could not get RAM info: {e_ram_host}")
-        try: # CPU
-            cpu_count_logical_val = await loop_host.run_in_executor(None, psutil.cpu_count, True)
-            cpu_usage_val = await loop_host.run_in_executor(None, functools.partial(psutil.cpu_percent, interval=0.5))
-            cpu_info_val = f"{cpu_count_logical_val} ядер, загрузка {cpu_usage_val:.1f}%"
-        except Exception as e_cpu_host: logger.warning(f"Could not get CPU info: {e_cpu_host}")
-        try: # Disk
-            disk_check_path_val = os.path.expanduser('~') # User's home directory
-            if not await loop_host.run_in_executor(None, os.path.exists, disk_check_path_val):
-                 disk_check_path_val = SCRIPT_DIR # Fallback to script dir
-            disk_val = await loop_host.run_in_executor(None, functools.partial(psutil.disk_usage, disk_check_path_val))
-            disk_info_val = f"{disk_val.used / (1024 ** 3):.2f} ГБ / {disk_val.total / (1024 ** 3):.2f} ГБ ({disk_val.percent}%)"
-        except Exception as e_disk_host:
-             logger.error(f"Could not get disk usage for {disk_check_path_val}: {e_disk_host}", exc_info=True)
-             disk_info_val = f"Ошибка ({type(e_disk_host).__name__})"
-        statuses_host["Ресурсы (ЦПУ/ОЗУ/Диск)"] = "✅ Данные получены" # Single update after all resource checks
-        await update_progress(progress_message_host, statuses_host)
-
-
-        # --- Uptime ---
-        uptime_str_val = "N/A"
-        try:
-            boot_time_val = await loop_host.run_in_executor(None, psutil.boot_time)
-            uptime_seconds_val = datetime.datetime.now().timestamp() - boot_time_val
-            if uptime_seconds_val > 0:
-                td_uptime = datetime.timedelta(seconds=int(uptime_seconds_val))
-                days_up, rem_s_up = td_uptime.days, td_uptime.seconds
-                hours_up, rem_min_s_up = divmod(rem_s_up, 3600)
-                minutes_up, _ = divmod(rem_min_s_up, 60) # Seconds not usually shown for long uptimes
-                parts_up = []
-                if days_up > 0: parts_up.append(f"{days_up} дн.")
-                if hours_up > 0 or days_up > 0: parts_up.append(f"{hours_up:02} ч.") # Show hours if days > 0
-                if minutes_up > 0 or hours_up > 0 or days_up > 0: parts_up.append(f"{minutes_up:02} мин.")
-                if not parts_up: parts_up.append(f"{int(uptime_seconds_val)} сек.") # Show seconds if very short uptime
-                uptime_str_val = " ".join(parts_up).strip()
-            else: uptime_str_val = "< 1 сек."
-        except Exception as e_uptime_host: logger.warning(f"Could not get uptime: {e_uptime_host}")
-
-
-        # --- Network Ping ---
         statuses_host["Сеть"] = "🔄 Пинг до 8.8.8.8..."
         await update_progress(progress_message_host, statuses_host)
-        ping_result_val = "N/A"
         ping_target_val = "8.8.8.8"
-        try:
-            ping_cmd_path_val = await loop_host.run_in_executor(None, shutil.which, 'ping')
-            if ping_cmd_path_val:
-                startupinfo_ping = None
-                if platform.system() == 'Windows':
-                     startupinfo_ping = subprocess.STARTUPINFO(); startupinfo_ping.dwFlags |= subprocess.STARTF_USESHOWWINDOW; startupinfo_ping.wShowWindow = subprocess.SW_HIDE
-                ping_args_val = [ping_cmd_path_val, '-n', '1', '-w', '2000', ping_target_val] if system_info_val == 'Windows' else [ping_cmd_path_val, '-c', '1', '-W', '2', ping_target_val]
-
-                proc_ping = await asyncio.create_subprocess_exec(*ping_args_val, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, startupinfo=startupinfo_ping)
-                stdout_ping, stderr_ping = await asyncio.wait_for(proc_ping.communicate(), timeout=4.0)
-                if proc_ping.returncode == 0:
-                    stdout_str_ping = stdout_ping.decode('utf-8', errors='ignore')
-                    match_ping_time = re.search(r'time[=<]([^ ]+?) ?ms', stdout_str_ping, re.IGNORECASE) # More generic time match
-                    if not match_ping_time and system_info_val == 'Windows':
-                         match_ping_time = re.search(r'Average = (\d+)ms', stdout_str_ping, re.IGNORECASE)
-                    ping_result_val = f"✅ {match_ping_time.group(1)} мс ({ping_target_val})" if match_ping_time else f"✅ OK ({ping_target_val}, RTT ?)"
-                else:
-                    stderr_str_ping = stderr_ping.decode('utf-8', errors='ignore').strip()
-                    ping_result_val = f"❌ Ошибка ({ping_target_val}, код={proc_ping.returncode}{f': {stderr_str_ping[:30]}...' if stderr_str_ping else ''})"
-            else: ping_result_val = "⚠️ 'ping' не найден"
-        except asyncio.TimeoutError:
-             try: proc_ping.terminate(); await proc_ping.wait() # type: ignore
-             except Exception: pass
-             ping_result_val = f"⌛ Таймаут 4с ({ping_target_val})"
-        except FileNotFoundError: ping_result_val = f"⚠️ 'ping' не найден (FNF)"
-        except Exception as e_ping_host:
-             logger.warning(f"Ping test failed: {e_ping_host}"); ping_result_val = f"❓ Ошибка ({ping_target_val})"
+        host_info, ping_result_val = await asyncio.gather(
+            asyncio.to_thread(_collect_host_info),
+            _ping_host(ping_target_val, system_info_val)
+        )
+        ram_info_val, cpu_info_val, disk_info_val = host_info["ram"], host_info["cpu"], host_info["disk"]
+        disk_check_path_val, uptime_str_val = host_info["disk_path"], host_info["uptime"]
+        statuses_host["Ресурсы (ЦПУ/ОЗУ/Диск)"] = "✅ Данные получены" # Single update after all resource checks
         statuses_host["Сеть"] = ping_result_val
         await update_progress(progress_message_host, statuses_host)
 
         # --- Software Versions ---
         statuses_host["ПО (Версии)"] = "🔄 Сбор версий..."
         await update_progress(progress_message_host, statuses_host)
-        python_v_val = platform.python_version()
-        telethon_v_val, yt_dlp_v_val, ytmusicapi_v_val, pillow_v_val, psutil_v_val, requests_v_val, gitpython_v_val = ("Неизвестно",) * 7
+        lib_versions = {lib_name: lib_v or "Неизвестно" for lib_name, lib_v in get_library_versions().items()}
+        python_v_val, telethon_v_val, yt_dlp_v_val = lib_versions["Python"], lib_versions["Telethon"], lib_versions["yt-dlp"]
+        ytmusicapi_v_val, pillow_v_val, psutil_v_val = lib_versions["ytmusicapi"], lib_versions["Pillow"], lib_versions["psutil"]
+        requests_v_val, gitpython_v_val = lib_versions["Requests"], lib_versions["GitPython"]
         ffmpeg_v_str_val, ffmpeg_loc_str_val = "Неизвестно", "Неизвестно"
 
-        try: telethon_v_val = telethon.__version__
-        except Exception: pass
-        try: yt_dlp_v_val = yt_dlp.version.__version__
-        except Exception: pass
-        try: from importlib import metadata as imeta; ytmusicapi_v_val = imeta.version('ytmusicapi')
-        except Exception: pass
-        try: pillow_v_val = Image.__version__
-        except Exception: pass
-        try: psutil_v_val = psutil.__version__
-        except Exception: pass
-        try: requests_v_val = requests.__version__
-        except Exception: pass
-        try: gitpython_v_val = git.__version__
-        except Exception: pass
 
-
-        ffmpeg_path_to_check = YDL_OPTS.get('ffmpeg_location') or await loop_host.run_in_executor(None, shutil.which, 'ffmpeg')
+        ffmpeg_path_to_check = YDL_OPTS.get('ffmpeg_location') or await loop_host.run_in_executor(None, _find_ffmpeg)
         if ffmpeg_path_to_check:
              ffmpeg_loc_str_val = ffmpeg_path_to_check
              ffmpeg_v_str_val = await loop_host.run_in_executor(None, get_ffmpeg_version, ffmpeg_path_to_check)
@@ -4003,28 +4466,39 @@ async def main():
     # ytmusic, ytmusic_authenticated
 
     logger.info("--- Запуск бота YTMG ---")
+    asyncio.get_running_loop().set_default_executor(_DEFAULT_POOL) # Before anything is offloaded (config loading below)
+    startup_tasks: List[asyncio.Task] = [] # Run alongside the Telegram login; settled in finally if startup fails midway
     try:
-        versions_startup = [f"Python: {platform.python_version()}"]
-        try: versions_startup.append(f"Telethon: {telethon.__version__}")
-        except Exception: versions_startup.append("Telethon: ?")
-        try: versions_startup.append(f"yt-dlp: {yt_dlp.version.__version__}")
-        except Exception: versions_startup.append("yt-dlp: ?")
-        try: from importlib import metadata as imeta_startup; versions_startup.append(f"ytmusicapi: {imeta_startup.version('ytmusicapi')}")
-        except Exception: versions_startup.append("ytmusicapi: ?")
-        try: versions_startup.append(f"Pillow: {Image.__version__}")
-        except Exception: versions_startup.append("Pillow: ?")
-        try: versions_startup.append(f"psutil: {psutil.__version__}")
-        except Exception: versions_startup.append("psutil: ?")
-        try: versions_startup.append(f"Requests: {requests.__version__}")
-        except Exception: versions_startup.append("Requests: ?")
-        try: versions_startup.append(f"python-dotenv: {dotenv.__version__ if hasattr(dotenv, '__version__') else 'да'}") # Check for version
-        except Exception: versions_startup.append("python-dotenv: ?")
-
+        # Computed once and reused by ,host
+        versions_startup = [f"{lib_name}: {lib_v or '?'}" for lib_name, lib_v in get_library_versions().items() if lib_name != "GitPython"]
 
         logger.info("Версии библиотек: " + " | ".join(versions_startup))
 
+        try: psutil.cpu_percent(interval=None) # Prime the CPU usage counter so ,host can read it without blocking
+        except Exception: pass
+
+        if _HAS_AIOHTTP:
+            global AIOHTTP_SESSION
+            AIOHTTP_SESSION = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=100, limit_per_host=32, ttl_dns_cache=300))
+
+        # Config files are parsed and YTMusic is initialized (including the get_history auth probe) while we log in to Telegram
+        config_task = asyncio.create_task(asyncio.to_thread(load_config))
+        ydl_opts_task = asyncio.create_task(asyncio.to_thread(load_ydl_opts))
+        ytmusic_init_task = asyncio.create_task(initialize_ytmusic_client())
+        startup_tasks += (config_task, ydl_opts_task, ytmusic_init_task)
+
         logger.info("Подключение к Telegram...")
         await client.start()
+        # Must be in place before BOT_OWNER_ID is set below, handle_message ignores everything until then
+        global config, YDL_OPTS, BOT_CREDIT, DEFAULT_SEARCH_LIMIT
+        global BOT_ENABLED, COMMAND_PREFIX, AUTO_CLEAR, USE_PROGRESS_MESSAGES
+        config, YDL_OPTS = await config_task, await ydl_opts_task
+        BOT_CREDIT = config.get("bot_credit", "")
+        DEFAULT_SEARCH_LIMIT = config.get("default_search_limit", 8)
+        BOT_ENABLED = config.get("bot_enabled", True)
+        COMMAND_PREFIX = config.get("prefix", ",")
+        AUTO_CLEAR = config.get("auto_clear", True)
+        USE_PROGRESS_MESSAGES = config.get("progress_messages", True)
         me_info = await client.get_me()
         if me_info:
             global BOT_OWNER_ID
@@ -4038,7 +4512,7 @@ async def main():
 
         # --- YTMusic API Initialization ---
         # initialize_ytmusic_client is async and handles setting ytmusic and ytmusic_authenticated
-        await initialize_ytmusic_client()
+        await ytmusic_init_task
         # Log status after initialization attempt
         if ytmusic:
             auth_status_log = "Активна" if ytmusic_authenticated else "Неактивна (или ошибка инициализации)"
@@ -4080,6 +4554,13 @@ async def main():
         logger.critical(f"КРИТИЧЕСКАЯ ОШИБКА в главном цикле (main): {e_main_loop}", exc_info=True)
     finally:
         logger.info("--- Завершение работы бота YTMG ---")
+        # Startup tasks left behind by a failed login/get_me: cancel and await them, so none is destroyed while
+        # pending or leaves an exception unretrieved
+        for startup_task in startup_tasks:
+            if not startup_task.done(): startup_task.cancel()
+        if startup_tasks: await asyncio.gather(*startup_tasks, return_exceptions=True)
+        for task_bg in list(_background_tasks): # Pending scheduled deletions, etc.
+            task_bg.cancel()
         if client and client.is_connected():
             logger.info("Отключение от Telegram...")
             try:
@@ -4087,7 +4568,15 @@ async def main():
                 logger.info("Клиент Telegram успешно отключен.")
             except Exception as e_disc_main:
                  logger.error(f"Ошибка при отключении клиента Telegram: {e_disc_main}")
-        logging.shutdown() # Ensure all log handlers are closed properly
+        for executor_pool in (_YTM_POOL, _YDL_POOL): # Don't wait on in-flight blocking calls, drop queued ones
+            executor_pool.shutdown(wait=False, cancel_futures=True)
+        close_ydl_instances()
+        if AIOHTTP_SESSION is not None:
+            try: await AIOHTTP_SESSION.close()
+            except Exception as e_http_close: logger.warning(f"Ошибка при закрытии HTTP-сессии: {e_http_close}")
+        HTTP_SESSION.close()
+        YTM_SESSION.close()
+        # LOG_LISTENER is stopped (and logging shut down) at exit, after any later records are written
         print("--- Бот YTMG остановлен ---")
 
 